@@ -1,20 +1,39 @@
+from array import array
+from ipaddress import IPv4Address
+from itertools import repeat
+import socket
+import sys
+
 def IP4ToUInt(string):
-    numbers = string.split(".")
-    integer =0
-    integer += int(numbers[0])*256*256*256
-    integer += int(numbers[1])*256*256
-    integer += int(numbers[2])*256
-    integer += int(numbers[3])
-    return integer
+    return int(IPv4Address(string))
 
 def uIntToIP4(integer):
-    num1 = integer % 256
-    num2 = (integer)//256 % 256
-    num3 = (integer)// (256*256) %256 
-    num4 = (integer)//(256*256*256)%256
-    return str(num4) +"."+ str(num3)+"."+str(num2) +"."+ str(num1)
+    return str(IPv4Address(integer))
 
+# Many addresses at once, packed 4 bytes each instead of one int object per
+# address. Both directions go through one network order buffer that is byte
+# swapped as a whole, not address by address.
+def IP4sToUInts(strings):
+    integers = array('I')
+    if integers.itemsize != 4:
+        return array('I', map(IP4ToUInt, strings))
+    try:
+        integers.frombytes(b"".join(map(socket.inet_pton, repeat(socket.AF_INET), strings)))
+    except OSError as e:
+        raise ValueError(f"Not an IPv4 address: {e}")
+    if sys.byteorder == "little":
+        integers.byteswap()
+    return integers
 
+def uIntsToIP4s(integers):
+    integers = array('I', integers)
+    if integers.itemsize != 4:
+        return list(map(uIntToIP4, integers))
+    if sys.byteorder == "little":
+        integers.byteswap()
+    packed = integers.tobytes()
+    return list(map(socket.inet_ntoa, (packed[offset:offset + 4] for offset in range(0, len(packed), 4))))
 
-print(IP4ToUInt("192.168.1.1"))
-print(uIntToIP4(3232235777))
+if __name__ == "__main__":
+    print(IP4ToUInt("192.168.1.1"))
+    print(uIntToIP4(3232235777))
@@ -1,106 +1,259 @@
-import socket
+import asyncio
+import queue
+import struct
 import threading
+import time
 import tkinter as tk
 from tkinter import scrolledtext, filedialog, messagebox, ttk
 import os
 import hashlib
 
+from p2p.lib.frame import encode_frame, frame_header, read_frame
+from p2p.lib.hash_index import WHOLE_FILE, HashIndex, hash_whole_file
+
+# Messages between nodes are frames as in p2p.lib.frame. A file is sent as
+# a FILE frame with its size, hash and name, then one CHUNK frame per
+# CHUNK_SIZE bytes and an END frame, all carrying the same transfer id in
+# the request id field, so several files can arrive over one connection.
+MESSAGE = b"MSG:"
+FILE = b"FIL:"
+CHUNK = b"CHK:"
+END = b"END:"
+FILE_HEADER = struct.Struct(">Q32s")
+
+class IncomingFile:
+    def __init__(self, name: str, size: int, file_hash: bytes, directory: str):
+        self.name = name
+        self.size = size
+        self.file_hash = file_hash
+        self.path = os.path.join(directory, name)
+        self.file = open(self.path + ".part", "wb")
+        self.hash = hashlib.sha256()
+        self.received = 0
+
+    def write(self, data: bytes):
+        self.file.write(data)
+        self.hash.update(data)
+        self.received += len(data)
+
+    def finish(self) -> bool:
+        self.file.close()
+        if self.received != self.size or self.hash.digest() != self.file_hash:
+            os.remove(self.path + ".part")
+            return False
+        os.replace(self.path + ".part", self.path)
+        return True
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.path + ".part")
+
 class P2PNode:
+    # Bytes per CHUNK frame. Each chunk goes out with socket.sendfile, so
+    # files are never read into memory.
+    CHUNK_SIZE = 65536
+    DOWNLOAD_DIR = 'received'
+    # Progress of a transfer is reported at most this often, in seconds.
+    PROGRESS_INTERVAL = 0.1
+    # Checksums of files shared before; unchanged files are not read again.
+    HASH_INDEX_FILE = 'hash_index.db'
+
     def __init__(self, host='127.0.0.1', port=12345):
         self.host = host
         self.port = port
-        self.connections = {}
+        # Writers of the peers we connected to, by address.
+        self.connections: dict[tuple[str, int], asyncio.StreamWriter] = {}
+        # Frames to one peer are written one at a time, so a chunk being
+        # sent with sendfile is never interleaved with another frame.
+        self.locks: dict[asyncio.StreamWriter, asyncio.Lock] = {}
         self.running = True
+        self.transfer_ids = iter(range(1, 1 << 32))
+        # Everything the UI should show, as (kind, ...) tuples; the node
+        # never touches Tk itself, see P2PApp.poll_events.
+        self.events = queue.Queue()
+        # All sockets are served by one event loop on a background thread.
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.server = None
+        self.tasks = set()
+        self.hash_index = HashIndex(self.HASH_INDEX_FILE)
+
+    def start(self):
+        self.thread.start()
+        return self.submit(self.start_server())
+
+    def submit(self, coroutine):
+        """Runs coroutine on the node's event loop, returning a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def report(self, *event):
+        self.events.put(event)
+
+    def log(self, message: str):
+        print(message)
+        self.report("message", message)
+
+    async def start_server(self):
+        try:
+            self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        except OSError as e:
+            self.log(f"Could not listen on {self.host}:{self.port} - {e}")
+            return
+        self.log(f"Listening on {self.host}:{self.port}")
 
-    def start_server(self):
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind((self.host, self.port))
-        server_socket.listen(5)
-        print(f"Listening on {self.host}:{self.port}")
-
-        while self.running:
-            client_socket, addr = server_socket.accept()
-            print(f"Accepted connection from {addr}")
-            threading.Thread(target=self.handle_peer, args=(client_socket, addr)).start()
-
-    def handle_peer(self, client_socket, addr):
-        while self.running:
-            try:
-                message = client_socket.recv(1024).decode()
-                if message:
-                    print(f"Received message from {addr}: {message}")
-                    # Handle incoming message (e.g., file transfer)
-                else:
-                    break
-            except:
-                break
-        
-        client_socket.close()
-        print(f"Connection closed with {addr}")
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        addr = writer.get_extra_info('peername')
+        self.log(f"Accepted connection from {addr}")
+        await self.handle_peer(reader, writer, addr)
+
+    async def handle_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, addr):
+        incoming: dict[int, IncomingFile] = {}
+        last_report = 0.0
+        try:
+            while self.running:
+                (command, transfer_id, payload, _) = await read_frame(reader)
+                if command == CHUNK and transfer_id in incoming:
+                    transfer = incoming[transfer_id]
+                    transfer.write(payload)
+                    now = time.monotonic()
+                    if now - last_report >= self.PROGRESS_INTERVAL:
+                        last_report = now
+                        self.report("progress", transfer.name, addr, transfer.received, transfer.size)
+                elif command == FILE:
+                    (size, file_hash) = FILE_HEADER.unpack(payload[:FILE_HEADER.size])
+                    # Only the base name is used, a peer cannot write outside DOWNLOAD_DIR.
+                    name = os.path.basename(payload[FILE_HEADER.size:].decode(errors='replace')) or f"file-{transfer_id}"
+                    os.makedirs(self.DOWNLOAD_DIR, exist_ok=True)
+                    incoming[transfer_id] = IncomingFile(name, size, file_hash, self.DOWNLOAD_DIR)
+                    self.log(f"Receiving {name} ({size} bytes) from {addr}")
+                elif command == END and transfer_id in incoming:
+                    transfer = incoming.pop(transfer_id)
+                    self.report("progress", transfer.name, addr, transfer.received, transfer.size)
+                    if transfer.finish():
+                        self.log(f"Received {transfer.name} from {addr}, saved to {transfer.path}")
+                    else:
+                        self.log(f"File {transfer.name} from {addr} does not match its hash, discarded")
+                elif command == MESSAGE:
+                    self.log(f"Received message from {addr}: {payload.decode(errors='replace')}")
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        finally:
+            for transfer in incoming.values():
+                transfer.abort()
+            if self.connections.get(addr) is writer:
+                del self.connections[addr]
+                self.report("peer_lost", addr)
+            writer.close()
+            self.log(f"Connection closed with {addr}")
 
     def connect_to_peer(self, peer_host, peer_port):
+        return self.submit(self.connect(peer_host, peer_port))
+
+    async def connect(self, peer_host, peer_port):
         peer_addr = (peer_host, peer_port)
 
         # Prevent self-connection
         if peer_addr == (self.host, self.port):
-            print(f"Cannot connect to self: {peer_addr}")
+            self.log(f"Cannot connect to self: {peer_addr}")
             return
 
         if peer_addr in self.connections:
-            print(f"Already connected to {peer_addr}, skipping.")
+            self.log(f"Already connected to {peer_addr}, skipping.")
             return
 
         try:
-            peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            peer_socket.connect(peer_addr)
-            self.connections[peer_addr] = peer_socket
-            print(f"Successfully connected to peer at {peer_addr}")
-
-            # Send its own peer list to the newly connected peer
-            self.send_peer_list(peer_socket)
-
-            # Notify existing peers about the new connection
-            self.notify_peers_of_new_connection()
-
-        except Exception as e:
-            print(f"Failed to connect to {peer_addr} - {e}")
-
-    def send_peer_list(self, peer_socket):
+            (reader, writer) = await asyncio.open_connection(peer_host, peer_port)
+        except OSError as e:
+            self.log(f"Failed to connect to {peer_addr} - {e}")
+            return
+        self.connections[peer_addr] = writer
+        self.locks[writer] = asyncio.Lock()
+        self.log(f"Successfully connected to peer at {peer_addr}")
+        self.report("peer", peer_addr)
+        task = asyncio.create_task(self.handle_peer(reader, writer, peer_addr))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+        # Send its own peer list to the newly connected peer
+        await self.send_peer_list(writer)
+
+        # Notify existing peers about the new connection
+        await self.notify_peers_of_new_connection()
+
+    async def send_frame(self, writer: asyncio.StreamWriter, command: bytes, payload: bytes = b"", transfer_id: int = 0):
+        async with self.locks[writer]:
+            writer.write(encode_frame(command, payload, transfer_id))
+            await writer.drain()
+
+    async def send_peer_list(self, writer: asyncio.StreamWriter):
         peer_list = ', '.join([f"{h}:{p}" for (h, p) in self.connections.keys()])
-        peer_socket.send(peer_list.encode())
+        await self.send_frame(writer, MESSAGE, peer_list.encode())
 
-    def notify_peers_of_new_connection(self):
+    async def notify_peers_of_new_connection(self):
         new_peer_info = f"{self.host}:{self.port}"
-        for conn in self.connections.values():
-            conn.send(f"New peer connected: {new_peer_info}".encode())
+        await asyncio.gather(*(
+            self.send_frame(writer, MESSAGE, f"New peer connected: {new_peer_info}".encode())
+            for writer in list(self.connections.values())
+        ), return_exceptions=True)
 
     def upload_file(self, file_path):
-        # Calculate the file hash for verification
-        file_hash = self.calculate_file_hash(file_path)
-        
-        with open(file_path, 'rb') as file:
-            data = file.read()
-            for peer_addr in self.connections.keys():
-                try:
-                    conn = self.connections[peer_addr]
-                    conn.sendall(f"FILE:{file_hash}:{os.path.basename(file_path)}:".encode() + data)
-                    print(f"File {file_path} sent to {peer_addr}")
-                except Exception as e:
-                    print(f"Failed to send file to {peer_addr} - {e}")
+        return self.submit(self.send_file(file_path))
+
+    async def send_file(self, file_path):
+        # Hashing reads the whole file, so it runs off the event loop.
+        file_hash = await self.loop.run_in_executor(None, self.calculate_file_hash, file_path)
+        size = os.path.getsize(file_path)
+        # Every peer gets the file at the same time, each at its own pace.
+        await asyncio.gather(*(
+            self.send_file_to(peer_addr, writer, file_path, size, bytes.fromhex(file_hash))
+            for (peer_addr, writer) in list(self.connections.items())
+        ))
+
+    async def send_file_to(self, peer_addr, writer: asyncio.StreamWriter, file_path, size: int, file_hash: bytes):
+        transfer_id = next(self.transfer_ids)
+        name = os.path.basename(file_path)
+        lock = self.locks[writer]
+        last_report = 0.0
+        try:
+            await self.send_frame(writer, FILE, FILE_HEADER.pack(size, file_hash) + name.encode(), transfer_id)
+            with open(file_path, 'rb') as file:
+                for offset in range(0, size, self.CHUNK_SIZE):
+                    count = min(self.CHUNK_SIZE, size - offset)
+                    async with lock:
+                        writer.write(frame_header(CHUNK, transfer_id, count))
+                        await writer.drain()
+                        await self.loop.sendfile(writer.transport, file, offset, count)
+                    now = time.monotonic()
+                    if now - last_report >= self.PROGRESS_INTERVAL:
+                        last_report = now
+                        self.report("progress", name, peer_addr, offset + count, size)
+            await self.send_frame(writer, END, b"", transfer_id)
+            self.report("progress", name, peer_addr, size, size)
+            self.log(f"File {file_path} sent to {peer_addr}")
+        except (ConnectionError, OSError, RuntimeError) as e:
+            self.log(f"Failed to send file to {peer_addr} - {e}")
 
     def calculate_file_hash(self, file_path):
-        """Calculates the SHA-256 hash of the file."""
-        sha256_hash = hashlib.sha256()
-        with open(file_path, "rb") as f:
-            # Read file in chunks
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
-        return sha256_hash.hexdigest()
+        """Calculates the SHA-256 hash of the file, unless the hash index has it from an earlier upload."""
+        (checksum, _, _, _) = self.hash_index.cached(file_path, WHOLE_FILE, hash_whole_file)
+        return checksum.hex()
 
-    def shutdown(self):
+    async def close(self):
         self.running = False
-        for conn in self.connections.values():
-            conn.close()
+        if self.server is not None:
+            self.server.close()
+        for writer in self.connections.values():
+            writer.close()
+        for task in list(self.tasks):
+            task.cancel()
+
+    def shutdown(self):
+        if self.thread.is_alive():
+            self.submit(self.close()).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+        self.loop.close()
+        self.hash_index.close()
         print("Node shut down.")
 
 class P2PApp:
@@ -109,6 +262,7 @@ class P2PApp:
         self.root = tk.Tk()
         self.root.title("P2P File Sharing")
         self.create_widgets()
+        self.poll_events()
 
     def create_widgets(self):
         style = ttk.Style()
@@ -140,6 +294,11 @@ class P2PApp:
         self.upload_button = ttk.Button(self.root, text="Upload File", command=self.upload_file)
         self.upload_button.pack(fill='x', padx=10, pady=(0, 5))
 
+        self.progress_label = tk.Label(self.root, text="")
+        self.progress_label.pack(pady=(5, 0))
+        self.progress_bar = ttk.Progressbar(self.root, mode='determinate', maximum=100)
+        self.progress_bar.pack(fill='x', padx=10, pady=(0, 10))
+
         self.text_area = scrolledtext.ScrolledText(self.root, wrap=tk.WORD, height=10, font=("Arial", 12))
         self.text_area.pack(expand=True, fill='both', padx=10, pady=(0, 10))
 
@@ -157,14 +316,45 @@ class P2PApp:
     def show_error_message(self, message):
         messagebox.showerror("Error", message)
 
+    # How often the UI picks up what the node reported, in milliseconds.
+    POLL_INTERVAL = 100
+
+    def poll_events(self):
+        # Tk may only be used from this thread, so the node queues events
+        # and they are applied here, on a timer.
+        if self.node:
+            while True:
+                try:
+                    event = self.node.events.get_nowait()
+                except queue.Empty:
+                    break
+                self.apply_event(event)
+        self.root.after(self.POLL_INTERVAL, self.poll_events)
+
+    def apply_event(self, event):
+        (kind, *details) = event
+        if kind == "message":
+            self.text_area.insert(tk.END, f"{details[0]}\n")
+            self.text_area.see(tk.END)
+        elif kind == "progress":
+            (name, peer_addr, done, total) = details
+            self.progress_label.config(text=f"{name} ({peer_addr[0]}:{peer_addr[1]}): {done}/{total} bytes")
+            self.progress_bar['value'] = 100 * done / total if total else 100
+        elif kind == "peer":
+            self.peer_listbox.insert(tk.END, f"{details[0][0]}:{details[0][1]}")
+        elif kind == "peer_lost":
+            peers = list(self.peer_listbox.get(0, tk.END))
+            peer = f"{details[0][0]}:{details[0][1]}"
+            if peer in peers:
+                self.peer_listbox.delete(peers.index(peer))
+
     def start_node(self):
         host = self.host_entry.get() or '127.0.0.1'
         port = self.port_entry.get() or 12345
         try:
             port = int(port)
             self.node = P2PNode(host, port)
-            self.node.app = self  # Reference to the app in the node
-            threading.Thread(target=self.node.start_server, daemon=True).start()
+            self.node.start()
             self.text_area.insert(tk.END, f"Node started at {host}:{port}\n")
             self.disconnect_button.config(state=tk.NORMAL)
             self.start_button.config(state=tk.DISABLED)
@@ -175,6 +365,7 @@ class P2PApp:
         if self.node:
             self.node.shutdown()
             self.node = None  # Clear the node reference
+            self.peer_listbox.delete(0, tk.END)
             self.text_area.insert(tk.END, "Node disconnected.\n")
             self.disconnect_button.config(state=tk.DISABLED)
             self.start_button.config(state=tk.NORMAL)
@@ -204,8 +395,9 @@ class P2PApp:
             
         file_path = filedialog.askopenfilename()
         if file_path:
+            # Returns right away; progress shows up through poll_events.
             self.node.upload_file(file_path)
-            self.text_area.insert(tk.END, f"File {file_path} uploaded.\n")
+            self.text_area.insert(tk.END, f"Uploading {file_path}.\n")
 
     def handle_terminal_input(self, event):
         user_input = self.text_area.get("1.0", tk.END).strip().split("\n")[-1]
@@ -221,4 +413,8 @@ class P2PApp:
 
 if __name__ == "__main__":
     app = P2PApp()
-    app.run()
+    try:
+        app.run()
+    finally:
+        if app.node:
+            app.node.shutdown()
@@ -0,0 +1,114 @@
+import hashlib
+import os
+from typing import Callable
+
+from p2p.lib.bitmap import Bitmap
+from p2p.lib.file_chunk import FileChunk
+from p2p.lib.journal import JournalEntry
+
+class FileAssembler:
+    # Writes chunks straight to their offset in a preallocated file as they
+    # arrive, and keeps an incremental SHA-256 of the longest in-order prefix
+    # so the checksum is ready as soon as the last chunk lands.
+    def __init__(self, file_name: str, checksum: bytes, num_chunks: int, file_size: int = 0, journal_entry: JournalEntry | None = None):
+        self.file_name = file_name
+        self.part_name = f"{file_name}.part"
+        self.checksum = checksum
+        self.num_chunks = num_chunks
+        self.file_size = file_size
+        self.written = Bitmap(num_chunks)
+        self.extents: dict[int, tuple[int, int]] = {}
+        self.sha256_hash = hashlib.sha256()
+        self.hashed = 0
+        # Every chunk written is recorded here, so the download can resume.
+        self.journal_entry = journal_entry
+        # Chunks an interrupted run wrote, not read back since; see recheck.
+        self.unverified: set[int] = set()
+
+        if journal_entry is not None and journal_entry.extents and os.path.exists(self.part_name):
+            self.file = open(self.part_name, 'r+b')
+            for (order, extent) in journal_entry.extents.items():
+                self.written.add(order)
+                self.extents[order] = extent
+                self.unverified.add(order)
+        else:
+            self.file = open(self.part_name, 'w+b')
+            if file_size:
+                self.file.truncate(file_size)
+            if journal_entry is not None:
+                for order in list(journal_entry.completed):
+                    journal_entry.discard(order)
+
+    def __contains__(self, order: int) -> bool:
+        return order in self.written
+
+    def write(self, chunk: FileChunk) -> bool:
+        if chunk.order in self.written or chunk.order >= self.num_chunks:
+            return False
+
+        self.file.seek(chunk.offset)
+        self.file.write(chunk.data)
+        self.written.add(chunk.order)
+        self.extents[chunk.order] = (chunk.offset, chunk.size)
+        if self.journal_entry is not None:
+            self.journal_entry.add(chunk.order, chunk.offset, chunk.size)
+        if chunk.order == self.num_chunks - 1:
+            self.file_size = chunk.offset + chunk.size
+
+        if chunk.order == self.hashed:
+            self.sha256_hash.update(chunk.data)
+            del self.extents[chunk.order]
+            self.hashed += 1
+        self.advance()
+        return True
+
+    def advance(self):
+        # Chunks that arrived early are read back from disk once the gap
+        # before them has been filled. Chunks from an earlier run wait until
+        # they have been checked.
+        while self.hashed in self.extents and self.hashed not in self.unverified:
+            (offset, size) = self.extents.pop(self.hashed)
+            self.file.seek(offset)
+            self.sha256_hash.update(self.file.read(size))
+            self.hashed += 1
+
+    def recheck(self, verify: Callable[[int, bytes], bool]) -> list[int]:
+        """Reads back the chunks an earlier run wrote, drops those that fail verify and returns their orders."""
+        dropped = []
+        for order in sorted(self.unverified):
+            (offset, size) = self.extents[order]
+            if not verify(order, self.read(offset, size)):
+                self.written.discard(order)
+                del self.extents[order]
+                if self.journal_entry is not None:
+                    self.journal_entry.discard(order)
+                dropped.append(order)
+        self.unverified.clear()
+        self.advance()
+        return dropped
+
+    def flush(self):
+        # Called before the journal is saved, so every chunk it lists is on disk.
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def read(self, offset: int, size: int) -> bytes:
+        self.file.seek(offset)
+        return self.file.read(size)
+
+    def complete(self) -> bool:
+        return self.written.complete()
+
+    def finish(self) -> bool:
+        """Closes the file and moves it into place if it is complete and matches the checksum."""
+        if not self.complete():
+            self.file.close()
+            return False
+
+        self.file.truncate(self.file_size)
+        self.file.close()
+        if self.sha256_hash.digest() != self.checksum:
+            os.remove(self.part_name)
+            return False
+        os.replace(self.part_name, self.file_name)
+        return True
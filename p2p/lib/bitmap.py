@@ -0,0 +1,43 @@
+class Bitmap:
+    # Bit i is set when chunk order i is present. Bits are stored least
+    # significant first, so the byte layout is the same on every peer.
+    def __init__(self, size: int, bits: bytes | None = None):
+        self.size = size
+        self.bits = bytearray((size + 7) // 8)
+        if bits is not None:
+            self.bits[:len(bits)] = bits[:len(self.bits)]
+            # The last byte's bits past size are padding. Peers that set them
+            # must not make us see orders the file does not have.
+            if size & 7:
+                self.bits[-1] &= (1 << (size & 7)) - 1
+
+    def add(self, order: int):
+        self.bits[order >> 3] |= 1 << (order & 7)
+
+    def discard(self, order: int):
+        self.bits[order >> 3] &= ~(1 << (order & 7)) & 0xFF
+
+    def __contains__(self, order: int) -> bool:
+        return 0 <= order < self.size and bool(self.bits[order >> 3] & (1 << (order & 7)))
+
+    def __iter__(self):
+        for (index, byte) in enumerate(self.bits):
+            if not byte:
+                continue
+            for bit in range(8):
+                if byte & (1 << bit):
+                    yield index * 8 + bit
+
+    def __len__(self) -> int:
+        return sum(byte.bit_count() for byte in self.bits)
+
+    def missing(self):
+        for order in range(self.size):
+            if order not in self:
+                yield order
+
+    def complete(self) -> bool:
+        return len(self) == self.size
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.bits)
@@ -0,0 +1,65 @@
+import mmap
+import os
+
+class BlobStore:
+    # Payloads are appended to pack files and never rewritten, so a
+    # (pack, offset, size) location stays valid for as long as the store
+    # exists. SQLite only keeps the location, keyed by content hash.
+    PACK_SIZE = 1 << 30
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        packs = sorted(
+            int(name[5:-4]) for name in os.listdir(directory)
+            if name.startswith("pack-") and name.endswith(".dat")
+        )
+        self.pack = packs[-1] if packs else 0
+        self.open_pack()
+        self.maps: dict[int, mmap.mmap] = {}
+
+    def pack_path(self, pack: int) -> str:
+        return os.path.join(self.directory, f"pack-{pack:05d}.dat")
+
+    def open_pack(self):
+        # Unbuffered, so appended bytes are visible to readers right away.
+        self.pack_file = open(self.pack_path(self.pack), 'ab', buffering=0)
+        self.pack_end = os.fstat(self.pack_file.fileno()).st_size
+
+    def append(self, data: bytes) -> tuple[int, int]:
+        """Appends a payload, returning the pack and offset it was written at."""
+        if self.pack_end and self.pack_end + len(data) > self.PACK_SIZE:
+            self.pack_file.close()
+            self.pack += 1
+            self.open_pack()
+
+        offset = self.pack_end
+        view = memoryview(data)
+        while view:
+            written = self.pack_file.write(view)
+            view = view[written:]
+        self.pack_end += len(data)
+        return (self.pack, offset)
+
+    def read(self, pack: int, offset: int, size: int) -> memoryview:
+        # A view straight into the page cache; nothing is copied until the
+        # socket sends it.
+        if size == 0:
+            return memoryview(b"")
+        mapped = self.maps.get(pack)
+        if mapped is None or offset + size > len(mapped):
+            # The pack grew since it was mapped. Older maps stay alive for
+            # as long as views into them are still being sent.
+            with open(self.pack_path(pack), 'rb') as pack_file:
+                mapped = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[pack] = mapped
+        return memoryview(mapped)[offset:offset + size]
+
+    def close(self):
+        self.pack_file.close()
+        for mapped in self.maps.values():
+            try:
+                mapped.close()
+            except BufferError:
+                pass
+        self.maps.clear()
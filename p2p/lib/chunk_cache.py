@@ -0,0 +1,132 @@
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from uuid import UUID
+
+from p2p.lib.file_chunk import FileChunk
+from p2p.lib.metrics import REGISTRY
+
+CACHE_HITS = REGISTRY.counter("p2p_chunk_cache_hits_total", "Chunks served from the chunk cache.")
+CACHE_MISSES = REGISTRY.counter("p2p_chunk_cache_misses_total", "Chunks read from SQLite and the blob store.")
+CACHE_EVICTIONS = REGISTRY.counter("p2p_chunk_cache_evictions_total", "Chunks evicted from the chunk cache.")
+CACHE_BYTES = REGISTRY.gauge("p2p_chunk_cache_bytes", "Bytes held by the chunk cache.")
+
+@dataclass
+class EncodedChunk:
+    # A chunk together with its packed header, as sent to framed peers.
+    chunk: FileChunk
+    header: bytes
+
+    @classmethod
+    def encode(cls, chunk: FileChunk):
+        (header, _) = chunk.encode_parts()
+        return cls(chunk, header)
+
+    @property
+    def size(self) -> int:
+        return len(self.header) + len(self.chunk.data)
+
+class ChunkCache:
+    # Least recently used chunks are evicted once the cache holds more than
+    # max_bytes; a max_bytes of 0 turns caching off. Chunks are keyed by
+    # (file_id, order). Manifest rows never change once written, so cached
+    # chunks never go stale as long as only chunks matching their row are
+    # put here; the server invalidates the others. Only the number of chunks
+    # a file has here changes, when a new one is stored, see stored.
+    # Bookkeeping per entry, on top of the header and payload.
+    ENTRY_OVERHEAD = 256
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[tuple[UUID, int], EncodedChunk] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # Orders of each file that are cached.
+        self.orders: dict[UUID, set[int]] = {}
+        # Number of chunks of each file stored here, learnt from a full read
+        # of the file. A file is served from memory alone while all of them
+        # are cached.
+        self.held: dict[UUID, int] = {}
+        # Bumped whenever a file gains a chunk, so a count learnt while the
+        # file was changing is not kept.
+        self.versions: dict[UUID, int] = {}
+
+    def cost(self, entry: EncodedChunk) -> int:
+        return entry.size + self.ENTRY_OVERHEAD
+
+    def get(self, file_id: UUID, order: int) -> EncodedChunk | None:
+        entry = self.entries.get((file_id, order))
+        if entry is None:
+            self.misses += 1
+            CACHE_MISSES.inc()
+            return None
+        self.entries.move_to_end((file_id, order))
+        self.hits += 1
+        CACHE_HITS.inc()
+        return entry
+
+    def put(self, chunk: FileChunk) -> EncodedChunk:
+        """Caches a chunk as read from the store, returning it with its header encoded."""
+        entry = EncodedChunk.encode(chunk)
+        if self.cost(entry) > self.max_bytes:
+            return entry
+        # Views into the blob store are copied, so the cache owns what it holds.
+        entry = EncodedChunk(replace(chunk, data=bytes(chunk.data)), entry.header)
+        key = (chunk.file_id, chunk.order)
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.size -= self.cost(previous)
+        self.entries[key] = entry
+        self.size += self.cost(entry)
+        self.orders.setdefault(chunk.file_id, set()).add(chunk.order)
+        while self.size > self.max_bytes:
+            ((file_id, order), evicted) = self.entries.popitem(last=False)
+            self.size -= self.cost(evicted)
+            self.forget_order(file_id, order)
+            CACHE_EVICTIONS.inc()
+        CACHE_BYTES.set(self.size)
+        return entry
+
+    def invalidate(self, file_id: UUID, order: int):
+        entry = self.entries.pop((file_id, order), None)
+        if entry is not None:
+            self.size -= self.cost(entry)
+            self.forget_order(file_id, order)
+            CACHE_BYTES.set(self.size)
+
+    def forget_order(self, file_id: UUID, order: int):
+        orders = self.orders.get(file_id)
+        if orders is not None:
+            orders.discard(order)
+            if not orders:
+                del self.orders[file_id]
+
+    def stored(self, file_id: UUID, chunk: FileChunk | None = None):
+        """Records that a chunk of the file was stored, caching it if given."""
+        # The file's chunk count is no longer known.
+        self.versions[file_id] = self.versions.get(file_id, 0) + 1
+        self.held.pop(file_id, None)
+        if chunk is not None:
+            self.put(chunk)
+
+    def version(self, file_id: UUID) -> int:
+        return self.versions.get(file_id, 0)
+
+    def learn(self, file_id: UUID, held: int, version: int):
+        # Only kept if no chunk of the file was stored while it was counted.
+        if self.version(file_id) == version:
+            self.held[file_id] = held
+
+    def file(self, file_id: UUID) -> list[EncodedChunk] | None:
+        """Returns every chunk of the file stored here, in order, if all of them are cached."""
+        held = self.held.get(file_id)
+        orders = self.orders.get(file_id, ())
+        if held is None or len(orders) != held:
+            return None
+        entries = []
+        for order in sorted(orders):
+            self.entries.move_to_end((file_id, order))
+            entries.append(self.entries[(file_id, order)])
+        self.hits += len(entries)
+        CACHE_HITS.inc(len(entries))
+        return entries
@@ -0,0 +1,164 @@
+import hashlib
+from typing import BinaryIO, Iterator
+
+try:
+    import numpy as np
+except ImportError:
+    # Content-defined chunking falls back to rolling the hash in Python.
+    np = None
+
+from p2p.lib.merkle import merkle_root
+
+# Large reads keep the number of hashlib calls low; memory stays at one buffer.
+HASH_BUFFER_SIZE = 1 << 20
+
+def file_checksum(file_name: str) -> bytes:
+    sha256_hash = hashlib.sha256()
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(file_name, 'rb', buffering=0) as data_file:
+        while read := data_file.readinto(buffer):
+            sha256_hash.update(view[:read])
+    return sha256_hash.digest()
+
+class FixedChunker:
+    def __init__(self, chunk_size: int):
+        self.chunk_size = chunk_size
+        # Chunkers with the same key cut a file at the same points.
+        self.key = f"fixed:{chunk_size}"
+
+    def chunks(self, data_file: BinaryIO) -> Iterator[tuple[int, bytes]]:
+        # Yields (offset, data) pairs, holding a single chunk in memory at a time.
+        offset = 0
+        while True:
+            data = data_file.read(self.chunk_size)
+            if not data:
+                break
+            yield (offset, data)
+            offset += len(data)
+
+# Gear table for the rolling hash. It is derived from SHA-256 rather than a
+# random seed so every peer cuts identical content at identical points.
+GEAR = [int.from_bytes(hashlib.sha256(b"oashare-gear" + bytes((i,))).digest()[:8], 'big') for i in range(256)]
+HASH_MASK = (1 << 64) - 1
+# Every step shifts the hash left by one, so a byte no longer counts once
+# this many more have been rolled in.
+GEAR_WINDOW = 64
+
+def gear_hashes(data: bytes) -> "np.ndarray":
+    # The gear hash at every position of data, as if rolled from its start:
+    # sum(GEAR[data[i - j]] << j for j < GEAR_WINDOW). Doubling the span
+    # covered each step takes log2(GEAR_WINDOW) passes over the buffer;
+    # uint64 arithmetic wraps like HASH_MASK does.
+    hashes = GEAR_ARRAY[np.frombuffer(data, dtype=np.uint8)]
+    span = 1
+    while span < GEAR_WINDOW:
+        hashes[span:] += hashes[:-span] << np.uint64(span)
+        span *= 2
+    return hashes
+
+GEAR_ARRAY = np.array(GEAR, dtype=np.uint64) if np is not None else None
+
+class ContentDefinedChunker:
+    # FastCDC-style chunking: a gear hash rolls over the data and a chunk
+    # ends where its top bits are all zero. Cut points depend only on nearby
+    # content, so an edit only changes the chunks around it.
+    #
+    # With NumPy, the hash is computed for a whole read buffer at once and
+    # only the first GEAR_WINDOW bytes of each chunk are rolled in Python;
+    # past those, the chunk's hash and the buffer's are the same. The cut
+    # points are identical either way.
+    def __init__(self, min_size: int, avg_size: int, max_size: int):
+        if not 0 < min_size <= avg_size <= max_size:
+            raise ValueError("Chunk sizes must satisfy 0 < min <= avg <= max")
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self.key = f"cdc:{min_size}:{avg_size}:{max_size}"
+        # Normalized chunking: a stricter mask before the average size and a
+        # looser one after it pull chunk sizes towards the average.
+        bits = max(avg_size.bit_length() - 1, 2)
+        self.strict_mask = ((1 << (bits + 1)) - 1) << (64 - bits - 1)
+        self.loose_mask = ((1 << (bits - 1)) - 1) << (64 - bits + 1)
+        self.read_size = max(HASH_BUFFER_SIZE, max_size)
+        self.vectorized = np is not None
+
+    def candidates(self, data: bytes) -> tuple["np.ndarray", "np.ndarray"]:
+        # Positions of data where the strict and the loose mask would cut.
+        hashes = gear_hashes(data)
+        strict = np.flatnonzero((hashes & np.uint64(self.strict_mask)) == 0)
+        loose = np.flatnonzero((hashes & np.uint64(self.loose_mask)) == 0)
+        return (strict, loose)
+
+    def cut_point(self, data: bytes, start: int = 0, candidates=None) -> int:
+        """Returns the length of the chunk starting at data[start]."""
+        length = len(data) - start
+        if length <= self.min_size:
+            return length
+        limit = min(length, self.max_size)
+        normal = min(self.avg_size, limit)
+        # Rolled byte by byte until the hash has seen a full window of the
+        # chunk, or all the way without candidates.
+        rolled = limit if candidates is None else min(limit, self.min_size + GEAR_WINDOW - 1)
+        gear = GEAR
+        fingerprint = 0
+        index = self.min_size
+        strict_end = min(rolled, normal)
+        while index < strict_end:
+            fingerprint = ((fingerprint << 1) + gear[data[start + index]]) & HASH_MASK
+            if not fingerprint & self.strict_mask:
+                return index + 1
+            index += 1
+        while index < rolled:
+            fingerprint = ((fingerprint << 1) + gear[data[start + index]]) & HASH_MASK
+            if not fingerprint & self.loose_mask:
+                return index + 1
+            index += 1
+        if candidates is None:
+            return limit
+        for (positions, end) in zip(candidates, (normal, limit)):
+            if index < end:
+                found = np.searchsorted(positions, start + index)
+                if found < len(positions) and positions[found] < start + end:
+                    return int(positions[found]) - start + 1
+                index = end
+        return limit
+
+    def chunks(self, data_file: BinaryIO) -> Iterator[tuple[int, bytes]]:
+        buffer = b""
+        # Where the next chunk starts in buffer.
+        start = 0
+        offset = 0
+        candidates = None
+        eof = False
+        while True:
+            if not eof and len(buffer) - start < self.max_size:
+                data = data_file.read(self.read_size)
+                if data:
+                    buffer = buffer[start:] + data
+                    start = 0
+                    if self.vectorized:
+                        candidates = self.candidates(buffer)
+                else:
+                    eof = True
+                continue
+            if start == len(buffer):
+                break
+            cut = self.cut_point(buffer, start, candidates)
+            yield (offset, buffer[start:start + cut])
+            start += cut
+            offset += cut
+
+def scan_file(file_name: str, chunker) -> tuple[bytes, int, int, bytes]:
+    """Chunks and hashes a file in one pass, returning its checksum, size, number of chunks and the Merkle root of its chunks."""
+    sha256_hash = hashlib.sha256()
+    file_size = 0
+    leaves = []
+    # Chunkers read a chunk at a time; the large buffer keeps that to one
+    # read system call per HASH_BUFFER_SIZE bytes.
+    with open(file_name, 'rb', buffering=HASH_BUFFER_SIZE) as data_file:
+        for (offset, data) in chunker.chunks(data_file):
+            sha256_hash.update(data)
+            file_size += len(data)
+            leaves.append(hashlib.sha256(data).digest())
+    return (sha256_hash.digest(), file_size, len(leaves), merkle_root(leaves))
@@ -13,3 +13,10 @@ class Command(Enum):
     INITIALIZE = b"INI:"
     RETRY = b"RET:"
     DISCONNECT = b"DIS:"
+    PING = b"PIN:"
+    HAVE = b"HAV:"
+    BEACON = b"BCN:"
+    LOOKUP = b"LKP:"
+    BUSY = b"BSY:"
+    LIST = b"LST:"
+    HASHES = b"HSH:"
@@ -0,0 +1,101 @@
+from collections import Counter
+from dataclasses import replace
+import hashlib
+import math
+import zlib
+
+try:
+    import zstandard as zstd
+except ImportError:
+    # zlib is always there; zstd is only offered when it is installed.
+    zstd = None
+
+from p2p.lib.file_chunk import FLAG_ZLIB, FLAG_ZSTD, COMPRESSION_FLAGS, FileChunk
+
+CODEC_FLAGS = {"zstd": FLAG_ZSTD, "zlib": FLAG_ZLIB}
+DECOMPRESSION_ERRORS = (zlib.error, zstd.ZstdError) if zstd is not None else (zlib.error,)
+DEFAULT_LEVELS = {"zstd": 3, "zlib": 6}
+
+# Data is only compressed if a sample of it looks compressible: random or
+# already compressed data has close to 8 bits of entropy per byte.
+ENTROPY_SAMPLE = 4096
+MAX_ENTROPY = 7.5
+# Compressed chunks must save at least this fraction to be worth it.
+MIN_SAVING = 0.1
+
+def available_codecs() -> list[str]:
+    """Returns the codecs this peer supports, most preferred first."""
+    return [codec for codec in CODEC_FLAGS if codec != "zstd" or zstd is not None]
+
+def encode_codecs(codecs: list[str]) -> bytes:
+    return ",".join(codecs).encode()
+
+def decode_codecs(payload: bytes) -> list[str]:
+    return [codec for codec in bytes(payload).decode(errors='replace').split(",") if codec in available_codecs()]
+
+def codec_name(flags: int) -> str | None:
+    for (codec, flag) in CODEC_FLAGS.items():
+        if flags & flag:
+            return codec
+    return None
+
+def entropy(sample: bytes) -> float:
+    # Shannon entropy of the byte distribution, in bits per byte.
+    if not sample:
+        return 0.0
+    total = len(sample)
+    return -sum(count / total * math.log2(count / total) for count in Counter(sample).values())
+
+def compress(data: bytes, codec: str, level: int | None = None) -> bytes | None:
+    """Returns data compressed with codec, or None if that would not save enough to be worth it."""
+    if entropy(bytes(data[:ENTROPY_SAMPLE])) > MAX_ENTROPY:
+        return None
+    level = level if level is not None else DEFAULT_LEVELS[codec]
+    if codec == "zstd":
+        compressed = zstd.ZstdCompressor(level=level).compress(data)
+    else:
+        compressed = zlib.compress(data, level)
+    if len(compressed) > len(data) * (1 - MIN_SAVING):
+        return None
+    return compressed
+
+def decompress(data: bytes, flags: int, size: int) -> bytes:
+    # size is the uncompressed size from the chunk header, so a corrupt or
+    # hostile payload can never expand past it.
+    codec = codec_name(flags)
+    try:
+        if codec == "zstd":
+            if zstd is None:
+                raise ValueError("Chunk is zstd compressed, install zstandard to read it")
+            raw = zstd.ZstdDecompressor().decompress(data, max_output_size=size)
+        elif codec == "zlib":
+            decompressor = zlib.decompressobj()
+            raw = decompressor.decompress(data, size)
+            if decompressor.unconsumed_tail:
+                raise ValueError("Compressed chunk is larger than its header says")
+        else:
+            return data
+    except DECOMPRESSION_ERRORS as e:
+        raise ValueError(f"Corrupt {codec} chunk: {e}")
+    if len(raw) != size:
+        raise ValueError(f"Chunk decompressed to {len(raw)} bytes, expected {size}")
+    return raw
+
+def content_digest(chunk: FileChunk) -> bytes:
+    # chunk_hash names the uncompressed content.
+    return hashlib.sha256(decompress(chunk.data, chunk.flags, chunk.size)).digest()
+
+def compress_chunk(chunk: FileChunk, codec: str, level: int | None = None) -> FileChunk:
+    # The chunk hash and size stay those of the uncompressed content, so
+    # deduplication and verification do not depend on the codec.
+    if chunk.is_reference or chunk.is_compressed:
+        return chunk
+    compressed = compress(chunk.data, codec, level)
+    if compressed is None:
+        return chunk
+    return replace(chunk, data=compressed, flags=chunk.flags | CODEC_FLAGS[codec])
+
+def decompress_chunk(chunk: FileChunk) -> FileChunk:
+    if not chunk.is_compressed:
+        return chunk
+    return replace(chunk, data=decompress(chunk.data, chunk.flags, chunk.size), flags=chunk.flags & ~COMPRESSION_FLAGS)
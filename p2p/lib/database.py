@@ -0,0 +1,124 @@
+import asyncio
+import time
+
+import aiosqlite
+
+from p2p.lib.metrics import REGISTRY
+
+QUERY_SECONDS = REGISTRY.histogram("p2p_sqlite_seconds", "Time spent in SQLite, by reads and batched writes.", ("kind",))
+READ_SECONDS = QUERY_SECONDS.labels("read")
+WRITE_SECONDS = QUERY_SECONDS.labels("write")
+WRITE_QUEUE_DEPTH = REGISTRY.gauge("p2p_sqlite_write_queue_depth", "Writes waiting for the batching writer.")
+WRITE_BATCH_SIZE = REGISTRY.histogram("p2p_sqlite_write_batch_size", "Writes committed per transaction.",
+                                      buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+
+class ChunkDatabase:
+    # Writes queued within BATCH_DELAY of each other share one transaction,
+    # up to BATCH_SIZE writes per transaction.
+    BATCH_SIZE = 512
+    BATCH_DELAY = 0.005
+    PRAGMAS = (
+        "PRAGMA journal_mode = WAL",
+        # With WAL, NORMAL only syncs at checkpoints and is still corruption safe.
+        "PRAGMA synchronous = NORMAL",
+        "PRAGMA temp_store = MEMORY",
+        "PRAGMA cache_size = -65536",
+        "PRAGMA mmap_size = 268435456",
+        "PRAGMA busy_timeout = 5000",
+    )
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.db = None
+        self.writes: asyncio.Queue = None
+        self.writer_task = None
+
+    async def open(self):
+        self.db = await aiosqlite.connect(self.file_name)
+        for pragma in self.PRAGMAS:
+            await self.db.execute(pragma)
+        self.writes = asyncio.Queue()
+        self.writer_task = asyncio.create_task(self.write_loop())
+
+    async def close(self):
+        if self.writer_task is not None:
+            # Let queued writes land before the connection goes away.
+            await self.writes.join()
+            self.writer_task.cancel()
+        if self.db is not None:
+            await self.db.close()
+
+    async def fetchall(self, sql: str, parameters=()) -> list:
+        started = time.perf_counter()
+        cursor = await self.db.execute(sql, parameters)
+        rows = await cursor.fetchall()
+        READ_SECONDS.observe(time.perf_counter() - started)
+        return rows
+
+    async def fetchone(self, sql: str, parameters=()):
+        started = time.perf_counter()
+        cursor = await self.db.execute(sql, parameters)
+        row = await cursor.fetchone()
+        READ_SECONDS.observe(time.perf_counter() - started)
+        return row
+
+    async def iterate(self, sql: str, parameters=()):
+        # Rows are fetched a few at a time, so a large result is never held
+        # in memory as a whole.
+        async with self.db.execute(sql, parameters) as cursor:
+            async for row in cursor:
+                yield row
+
+    async def write(self, statements: list[tuple[str, tuple]]):
+        """Queues statements that must be applied together and waits until they are committed."""
+        future = asyncio.get_running_loop().create_future()
+        self.writes.put_nowait((statements, future))
+        WRITE_QUEUE_DEPTH.inc()
+        await future
+
+    async def next_batch(self) -> list:
+        loop = asyncio.get_running_loop()
+        batch = [await self.writes.get()]
+        deadline = loop.time() + self.BATCH_DELAY
+        while len(batch) < self.BATCH_SIZE:
+            if not self.writes.empty():
+                batch.append(self.writes.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.writes.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def write_loop(self):
+        while True:
+            batch = await self.next_batch()
+            WRITE_QUEUE_DEPTH.dec(len(batch))
+            WRITE_BATCH_SIZE.observe(len(batch))
+            started = time.perf_counter()
+            # Group the rows by statement so each statement runs once per
+            # batch with executemany, keeping first-seen statement order.
+            grouped: dict[str, list[tuple]] = {}
+            for (statements, _) in batch:
+                for (sql, parameters) in statements:
+                    grouped.setdefault(sql, []).append(parameters)
+            try:
+                for (sql, rows) in grouped.items():
+                    await self.db.executemany(sql, rows)
+                await self.db.commit()
+            except Exception as e:
+                await self.db.rollback()
+                for (_, future) in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, future) in batch:
+                    if not future.done():
+                        future.set_result(None)
+            finally:
+                WRITE_SECONDS.observe(time.perf_counter() - started)
+                for _ in batch:
+                    self.writes.task_done()
@@ -0,0 +1,138 @@
+import asyncio
+from ipaddress import IPv4Address
+import json
+import logging
+import struct
+from typing import Awaitable, Callable
+
+from p2p.lib.commands import Command
+from p2p.lib.node import Node
+
+DEFAULT_PORT = 3000
+
+log = logging.getLogger(__name__)
+
+class BeaconResponder(asyncio.DatagramProtocol):
+    # Runs next to the server and answers UDP beacons with the TCP port the
+    # server listens on. The sender learns our address from the datagram.
+    def __init__(self, port: int = DEFAULT_PORT):
+        self.port = port
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        if data[:4] == Command.BEACON.value:
+            self.transport.sendto(Command.BEACON.value + struct.pack(">H", self.port), addr)
+
+class BeaconListener(asyncio.DatagramProtocol):
+    def __init__(self, on_found: Callable[[Node], None]):
+        self.on_found = on_found
+
+    def datagram_received(self, data: bytes, addr):
+        if data[:4] == Command.BEACON.value and len(data) >= 6:
+            (port,) = struct.unpack(">H", data[4:6])
+            self.on_found(Node(IPv4Address(addr[0]), port))
+
+class PeerCache:
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+
+    def load(self) -> set[Node]:
+        try:
+            with open(self.file_name) as cache_file:
+                entries = json.load(cache_file)
+        except (OSError, ValueError):
+            return set()
+        return {Node(IPv4Address(ip), port) for (ip, port) in entries}
+
+    def save(self, peers: set[Node]):
+        with open(self.file_name, 'w') as cache_file:
+            json.dump([[str(peer.ip_address), peer.port] for peer in peers], cache_file)
+
+def parse_seeds(seeds: str) -> set[Node]:
+    # "10.0.0.2,10.0.0.3:3001" -> nodes, defaulting to the standard port.
+    nodes = set()
+    for seed in seeds.split(","):
+        seed = seed.strip()
+        if not seed:
+            continue
+        (ip, _, port) = seed.partition(":")
+        nodes.add(Node(IPv4Address(ip), int(port or DEFAULT_PORT)))
+    return nodes
+
+class Discovery:
+    # Concurrent TCP probes; the rest wait their turn.
+    MAX_PROBES = 64
+    PROBE_TIMEOUT = 1.0
+    # How long to listen for beacon replies.
+    BEACON_TIMEOUT = 0.25
+
+    def __init__(self,
+                 probe: Callable[[Node], Awaitable[list[Node] | None]],
+                 exclude: set[IPv4Address],
+                 seeds: set[Node],
+                 cache: PeerCache,
+                 broadcast_addresses: list[str],
+                 port: int = DEFAULT_PORT):
+        # probe connects to a node and returns the peers it gossips about,
+        # or None if it is not reachable.
+        self.probe = probe
+        self.exclude = exclude
+        self.seeds = seeds
+        self.cache = cache
+        self.broadcast_addresses = broadcast_addresses
+        self.port = port
+        self.seen: set[Node] = set()
+        self.known: set[Node] = set()
+
+    async def discover(self) -> set[Node]:
+        semaphore = asyncio.Semaphore(self.MAX_PROBES)
+        async with asyncio.TaskGroup() as tg:
+            # Cached and seed peers are probed while the beacon is still out.
+            for node in self.cache.load() | self.seeds:
+                self.schedule(node, tg, semaphore)
+            tg.create_task(self.beacon(tg, semaphore))
+
+        self.cache.save(self.known)
+        return self.known
+
+    def schedule(self, node: Node, tg: asyncio.TaskGroup, semaphore: asyncio.Semaphore):
+        if node in self.seen or node.ip_address in self.exclude:
+            return
+        self.seen.add(node)
+        tg.create_task(self.probe_node(node, tg, semaphore))
+
+    async def probe_node(self, node: Node, tg: asyncio.TaskGroup, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            try:
+                gossip = await asyncio.wait_for(self.probe(node), timeout=self.PROBE_TIMEOUT)
+            except asyncio.TimeoutError:
+                return
+        if gossip is None:
+            return
+        self.known.add(node)
+        for peer in gossip:
+            self.schedule(peer, tg, semaphore)
+
+    async def beacon(self, tg: asyncio.TaskGroup, semaphore: asyncio.Semaphore):
+        loop = asyncio.get_running_loop()
+        try:
+            (transport, _) = await loop.create_datagram_endpoint(
+                lambda: BeaconListener(lambda node: self.schedule(node, tg, semaphore)),
+                local_addr=('0.0.0.0', 0),
+                allow_broadcast=True
+            )
+        except OSError as e:
+            log.warning("Beacon unavailable: %s", e)
+            return
+        try:
+            for address in self.broadcast_addresses:
+                try:
+                    transport.sendto(Command.BEACON.value, (address, self.port))
+                except OSError:
+                    continue
+            await asyncio.sleep(self.BEACON_TIMEOUT)
+        finally:
+            transport.close()
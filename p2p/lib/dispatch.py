@@ -0,0 +1,88 @@
+import inspect
+import logging
+import time
+
+from p2p.lib.commands import Command
+from p2p.lib.metrics import REGISTRY
+
+COMMAND_SECONDS = REGISTRY.histogram("p2p_command_seconds", "Time spent handling each command.", ("command",))
+COMMAND_ERRORS = REGISTRY.counter("p2p_command_errors_total", "Commands whose handler raised.", ("command",))
+
+log = logging.getLogger(__name__)
+
+class OpcodeStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    @property
+    def mean_time(self) -> float:
+        return self.total_time / self.calls if self.calls else 0.0
+
+    def record(self, elapsed: float, failed: bool):
+        self.calls += 1
+        if failed:
+            self.errors += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+class Handler:
+    def __init__(self, command: Command, function, throttled: bool):
+        self.command = command
+        self.function = function
+        self.throttled = throttled
+        # Handlers either return their whole (short) reply or, as async
+        # generators, yield it one frame at a time.
+        self.streaming = inspect.isasyncgenfunction(function)
+        self.stats = OpcodeStats()
+        self.latency = COMMAND_SECONDS.labels(command.name)
+        self.errors = COMMAND_ERRORS.labels(command.name)
+
+    async def run(self, owner, data: bytes, client_node):
+        started = time.perf_counter()
+        failed = True
+        try:
+            if self.streaming:
+                async for reply in self.function(owner, data, client_node):
+                    yield reply
+            else:
+                for reply in await self.function(owner, data, client_node):
+                    yield reply
+            failed = False
+        except Exception as e:
+            # Malformed requests end up here too. The client is told below
+            # instead of waiting out its timeout.
+            log.warning("%s from %s failed: %r", self.command.name, client_node, e)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.stats.record(elapsed, failed)
+            self.latency.observe(elapsed)
+            if failed:
+                self.errors.inc()
+        if failed:
+            yield (Command.ERROR.value, b"")
+            yield (Command.TERMINATE.value, b"")
+
+class CommandRegistry:
+    # Maps the raw 4 byte opcode to its handler, so dispatch is one dict lookup.
+    def __init__(self):
+        self.handlers: dict[bytes, Handler] = {}
+
+    def handler(self, command: Command, throttled: bool = False):
+        """Registers the decorated method as the handler of a command.
+
+        Throttled handlers count towards the server's in-flight limit."""
+        def register(function):
+            if command.value in self.handlers:
+                raise ValueError(f"{command.name} already has a handler")
+            self.handlers[command.value] = Handler(command, function, throttled)
+            return function
+        return register
+
+    def get(self, opcode: bytes) -> Handler | None:
+        return self.handlers.get(opcode)
+
+    def stats(self) -> dict[Command, OpcodeStats]:
+        return {handler.command: handler.stats for handler in self.handlers.values()}
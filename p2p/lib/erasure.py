@@ -0,0 +1,118 @@
+try:
+    import numpy as np
+except ImportError:
+    # Erasure coding is optional; everything else works without NumPy.
+    np = None
+
+# GF(2^8) with the polynomial x^8 + x^4 + x^3 + x^2 + 1, as in most
+# Reed-Solomon codes. Addition is XOR; multiplication goes through a full
+# 256x256 product table so whole blocks are multiplied with one lookup.
+PRIMITIVE_POLYNOMIAL = 0x11D
+
+# Layout of an erasure coded file: data chunks keep orders 0..num_chunks-1,
+# and stripe s covers data orders s*k..s*k+k-1. Its parity chunks follow all
+# data chunks, at orders num_chunks + s*m .. num_chunks + s*m + m-1.
+def stripe_count(num_chunks: int, data_shards: int) -> int:
+    return -(-num_chunks // data_shards) if data_shards else 0
+
+def total_chunks(num_chunks: int, data_shards: int, parity_shards: int) -> int:
+    return num_chunks + stripe_count(num_chunks, data_shards) * parity_shards
+
+def parity_order(num_chunks: int, parity_shards: int, stripe: int, parity: int) -> int:
+    return num_chunks + stripe * parity_shards + parity
+
+def gf_tables():
+    exp = [0] * 512
+    log = [0] * 256
+    value = 1
+    for power in range(255):
+        exp[power] = value
+        log[value] = power
+        value <<= 1
+        if value & 0x100:
+            value ^= PRIMITIVE_POLYNOMIAL
+    for power in range(255, 512):
+        exp[power] = exp[power - 255]
+    return (exp, log)
+
+(GF_EXP, GF_LOG) = gf_tables()
+
+def gf_mul(a: int, b: int) -> int:
+    if a == 0 or b == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+def gf_inv(a: int) -> int:
+    return GF_EXP[255 - GF_LOG[a]]
+
+class ReedSolomon:
+    # A systematic code: the k data blocks are stored as they are, followed
+    # by m parity blocks, and any k of the k + m blocks give back the data.
+    # The parity rows form a Cauchy matrix, so every k x k submatrix of the
+    # full coding matrix is invertible.
+    MUL_TABLE = None
+
+    def __init__(self, data_shards: int, parity_shards: int):
+        if np is None:
+            raise RuntimeError("Erasure coding needs NumPy, install it with: pip install numpy")
+        if data_shards < 1 or parity_shards < 0 or data_shards + parity_shards > 256:
+            raise ValueError(f"Unsupported erasure code {data_shards}+{parity_shards}")
+        self.data_shards = data_shards
+        self.parity_shards = parity_shards
+
+        if ReedSolomon.MUL_TABLE is None:
+            ReedSolomon.MUL_TABLE = np.array([[gf_mul(a, b) for b in range(256)] for a in range(256)], dtype=np.uint8)
+
+        # Row i of the coding matrix gives block i from the data blocks.
+        self.matrix = [[int(row == column) for column in range(data_shards)] for row in range(data_shards)]
+        for parity in range(parity_shards):
+            x = data_shards + parity
+            self.matrix.append([gf_inv(x ^ y) for y in range(data_shards)])
+
+    def multiply(self, rows: list[list[int]], blocks: "np.ndarray") -> "np.ndarray":
+        # (rows x k) times (k x width) over GF(256): look every product up at
+        # once, then XOR-reduce along k.
+        coefficients = np.array(rows, dtype=np.uint8)
+        products = self.MUL_TABLE[coefficients[:, :, None], blocks[None, :, :]]
+        return np.bitwise_xor.reduce(products, axis=1)
+
+    def stack(self, blocks: list[bytes], width: int) -> "np.ndarray":
+        # Short blocks are padded with zeros to the stripe width.
+        matrix = np.zeros((len(blocks), width), dtype=np.uint8)
+        for (index, block) in enumerate(blocks):
+            matrix[index, :len(block)] = np.frombuffer(block, dtype=np.uint8)
+        return matrix
+
+    def encode(self, data: list[bytes], width: int) -> list[bytes]:
+        """Returns the parity blocks for up to data_shards data blocks; missing trailing blocks count as zeros."""
+        blocks = self.stack(data + [b""] * (self.data_shards - len(data)), width)
+        parity = self.multiply(self.matrix[self.data_shards:], blocks)
+        return [row.tobytes() for row in parity]
+
+    def decode(self, available: dict[int, bytes], width: int) -> list[bytes]:
+        """Rebuilds all data blocks from any data_shards of the blocks, keyed by their index in the stripe."""
+        indices = sorted(available)[:self.data_shards]
+        if len(indices) < self.data_shards:
+            raise ValueError(f"Need {self.data_shards} blocks to decode, got {len(indices)}")
+        if indices == list(range(self.data_shards)):
+            return [bytes(available[index]) for index in indices]
+
+        inverse = self.invert([self.matrix[index] for index in indices])
+        data = self.multiply(inverse, self.stack([available[index] for index in indices], width))
+        return [row.tobytes() for row in data]
+
+    def invert(self, matrix: list[list[int]]) -> list[list[int]]:
+        # Gauss-Jordan elimination over GF(256). The matrix is only k x k,
+        # so plain Python is fast enough here.
+        size = len(matrix)
+        rows = [row[:] + [int(row_index == column) for column in range(size)] for (row_index, row) in enumerate(matrix)]
+        for column in range(size):
+            pivot = next(row for row in range(column, size) if rows[row][column])
+            (rows[column], rows[pivot]) = (rows[pivot], rows[column])
+            scale = gf_inv(rows[column][column])
+            rows[column] = [gf_mul(value, scale) for value in rows[column]]
+            for row in range(size):
+                factor = rows[row][column]
+                if row != column and factor:
+                    rows[row] = [value ^ gf_mul(factor, pivot_value) for (value, pivot_value) in zip(rows[row], rows[column])]
+        return [row[size:] for row in rows]
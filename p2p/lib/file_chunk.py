@@ -1,6 +1,6 @@
 from base64 import b64encode, b64decode
 from binascii import hexlify, unhexlify
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 import hashlib
 from ipaddress import IPv4Address
 import struct
@@ -8,6 +8,32 @@ import uuid
 
 from p2p.lib.node import Node
 
+# Binary chunks start with MAGIC so they can never be mistaken for the
+# legacy hex/base64 encoding, whose first byte is the high byte of a
+# size that never exceeded 512.
+MAGIC = 0xFC
+VERSION = 5
+
+# The chunk carries no data: the receiver already stores content with
+# this chunk_hash and only needs to add it to the file's manifest.
+FLAG_REFERENCE = 0x01
+# The payload is compressed with this codec, see p2p.lib.compression. The
+# size and chunk_hash stay those of the uncompressed content.
+FLAG_ZLIB = 0x02
+FLAG_ZSTD = 0x04
+COMPRESSION_FLAGS = FLAG_ZLIB | FLAG_ZSTD
+
+# Legacy chunks were always cut at this size, which gives their offsets.
+LEGACY_CHUNK_SIZE = 512
+
+# magic, version, flags, size, order, num_chunks, offset, file_size, file_id, checksum, chunk_hash, next_ip, next_port, name_len,
+# data_shards, parity_shards, merkle_root
+HEADER = struct.Struct(">BBBIIIQQ16s32s32s4sHHBB32s")
+# Version 4 chunks lack the Merkle root of the file.
+HEADER_V4 = struct.Struct(">BBBIIIQQ16s32s32s4sHHBB")
+# Version 3 chunks lack the shard counts, as nothing was erasure coded yet.
+HEADER_V3 = struct.Struct(">BBBIIIQQ16s32s32s4sHH")
+
 @dataclass
 class FileChunk:
     file_id: uuid.UUID
@@ -18,8 +44,73 @@ class FileChunk:
     next_node: Node
     file_name: str
     data: bytes
+    offset: int = 0
+    file_size: int = 0
+    chunk_hash: bytes = b""
+    flags: int = 0
+    # Erasure coded files are cut into stripes of data_shards chunks, each
+    # followed by parity_shards parity chunks; see p2p.lib.erasure.
+    data_shards: int = 0
+    parity_shards: int = 0
+    # Root of the hash tree over the file's data chunk hashes, see
+    # p2p.lib.merkle. Empty when the uploader did not send one.
+    merkle_root: bytes = b""
+
+    def __post_init__(self):
+        # Chunks are identified by the SHA-256 of their content.
+        if not self.chunk_hash and not self.is_reference and not self.is_compressed:
+            self.chunk_hash = hashlib.sha256(self.data).digest()
+
+    @property
+    def is_reference(self) -> bool:
+        return bool(self.flags & FLAG_REFERENCE)
+
+    @property
+    def is_compressed(self) -> bool:
+        return bool(self.flags & COMPRESSION_FLAGS)
+
+    @property
+    def is_parity(self) -> bool:
+        # Parity chunks are numbered after the file's num_chunks data chunks.
+        return self.order >= self.num_chunks
+
+    def reference(self):
+        return replace(self, data=b"", flags=self.flags | FLAG_REFERENCE)
 
     def encode(self) -> bytes:
+        return b"".join(self.encode_parts())
+
+    def encode_parts(self) -> tuple[bytes, bytes]:
+        # The header and the payload are kept apart so a payload that is a
+        # view into a file can go to the socket without being copied.
+        file_name = self.file_name.encode()
+        header = HEADER.pack(
+            MAGIC,
+            VERSION,
+            self.flags,
+            self.size,
+            self.order,
+            self.num_chunks,
+            self.offset,
+            self.file_size,
+            self.file_id.bytes,
+            self.file_checksum,
+            self.chunk_hash,
+            self.next_node.ip_address.packed,
+            self.next_node.port,
+            len(file_name),
+            self.data_shards,
+            self.parity_shards,
+            self.merkle_root
+        )
+        return (header + file_name, self.data)
+
+    def encode_legacy(self) -> bytes:
+        # Legacy peers read the size, order and chunk count as two bytes.
+        # Larger ones, such as content-defined chunks of up to 64 KiB, are
+        # refused rather than sent wrong; the peer gets an ERROR instead.
+        if max(len(self.data), self.order, self.num_chunks) > 0xFFFF:
+            raise ValueError(f"Chunk {self.order} of {self.file_id} does not fit the legacy encoding")
         size_bytes = struct.pack('>H', len(self.data))
         order_bytes = struct.pack('>H', self.order)
         num_chunks_bytes = struct.pack('>H', self.num_chunks)
@@ -35,6 +126,41 @@ class FileChunk:
 
     @classmethod
     def decode(cls, packet: bytes):
+        view = memoryview(packet)
+        if len(view) == 0 or view[0] != MAGIC:
+            return cls.decode_legacy(packet)
+
+        version = view[1] if len(view) > 1 else 0
+        if version == VERSION:
+            header = HEADER
+            (_, _, flags, size, order, num_chunks, offset, file_size, file_id_bytes, checksum, chunk_hash, next_ip_address, next_port, name_len, data_shards, parity_shards, merkle_root) = header.unpack_from(view)
+            # An all-zero root was packed from an empty one.
+            if not any(merkle_root):
+                merkle_root = b""
+        elif version == 4:
+            header = HEADER_V4
+            (_, _, flags, size, order, num_chunks, offset, file_size, file_id_bytes, checksum, chunk_hash, next_ip_address, next_port, name_len, data_shards, parity_shards) = header.unpack_from(view)
+            merkle_root = b""
+        elif version == 3:
+            header = HEADER_V3
+            (_, _, flags, size, order, num_chunks, offset, file_size, file_id_bytes, checksum, chunk_hash, next_ip_address, next_port, name_len) = header.unpack_from(view)
+            (data_shards, parity_shards, merkle_root) = (0, 0, b"")
+        else:
+            raise ValueError(f"Unsupported chunk version {version}")
+
+        name_start = header.size
+        data_start = name_start + name_len
+        file_name = str(view[name_start:data_start], 'utf-8')
+        # The payload stays a view into the received packet, no copy is made.
+        data = view[data_start:]
+        if len(data) != size and not flags & (FLAG_REFERENCE | COMPRESSION_FLAGS):
+            raise ValueError(f"Chunk payload is {len(data)} bytes, expected {size}")
+
+        next_node = Node(IPv4Address(next_ip_address), next_port)
+        return FileChunk(uuid.UUID(bytes=file_id_bytes), size, order, num_chunks, checksum, next_node, file_name, data, offset, file_size, chunk_hash, flags, data_shards, parity_shards, merkle_root)
+
+    @classmethod
+    def decode_legacy(cls, packet: bytes):
         (size, order, num_chunks) = struct.unpack(">HHH", packet[:6])
         packet = packet[6:]
         file_id_len = 32
@@ -47,16 +173,19 @@ class FileChunk:
         (next_ip_address, next_port) = struct.unpack(">4sH", packet[:6])
         misc_data_encoded = packet[6:]
         next_node = Node(IPv4Address(next_ip_address), next_port)
-        misc_data = b64decode(misc_data_encoded).split(b'\x1f')
+        misc_data = b64decode(misc_data_encoded).split(b'\x1f', 1)
         [file_name, data] = misc_data
-        return FileChunk(file_id, size, order, num_chunks, checksum, next_node, file_name.decode(), data)
+        return FileChunk(file_id, size, order, num_chunks, checksum, next_node, file_name.decode(), data, order * LEGACY_CHUNK_SIZE)
 
     def __str__(self):
         return f"""File ID: {self.file_id}
 Size: {self.size}
 Order: {self.order}
 Chunks: {self.num_chunks}
+Offset: {self.offset}/{self.file_size}
 Checksum: {self.file_checksum.hex()}
+Chunk Hash: {self.chunk_hash.hex()}
+Merkle Root: {self.merkle_root.hex()}
 Next Node: {self.next_node}
 Filename: {self.file_name}
-Data: {self.data[:5]}"""
+Data: {bytes(self.data[:5])}"""
@@ -0,0 +1,123 @@
+import asyncio
+import struct
+import time
+
+from p2p.lib.commands import Command
+from p2p.lib.metrics import REGISTRY
+from p2p.lib.node import Node
+from p2p.lib.pool import ConnectionPool
+
+# Payload of a BUSY reply: how long the server wants us to hold off, in milliseconds.
+RETRY_AFTER = struct.Struct(">I")
+
+REQUEST_SECONDS = REGISTRY.histogram("p2p_request_seconds", "Round trip of requests to other peers, by command.", ("command",))
+BUSY_REPLIES = REGISTRY.counter("p2p_busy_replies_total", "BUSY replies received from other peers.", ("peer",))
+COMMAND_NAMES = {command.value: command.name for command in Command}
+
+class CongestionWindow:
+    # Additive increase, multiplicative decrease, as in TCP. Each reply
+    # grows the window by 1/size, so it opens by about one request per
+    # round trip. A failure or busy reply halves it, at most once per
+    # round trip so one overload event is not punished many times over.
+    INITIAL_SIZE = 4
+    MIN_SIZE = 1
+    MAX_SIZE = 128
+    DECREASE_FACTOR = 0.5
+    # Weight of the newest sample in the moving average round trip time.
+    RTT_SMOOTHING = 0.125
+    DEFAULT_RTT = 0.05
+
+    def __init__(self):
+        self.size = float(self.INITIAL_SIZE)
+        self.in_flight = 0
+        self.rtt = self.DEFAULT_RTT
+        self.last_decrease = 0.0
+        # Set from a busy reply; nothing is sent to the peer before then.
+        self.resume_at = 0.0
+        self.waiters: list[asyncio.Future] = []
+
+    @property
+    def limit(self) -> int:
+        return max(self.MIN_SIZE, int(self.size))
+
+    async def acquire(self):
+        while True:
+            delay = self.resume_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            if self.in_flight < self.limit:
+                self.in_flight += 1
+                return
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+
+    def release(self):
+        self.in_flight -= 1
+        self.wake()
+
+    def wake(self):
+        # Waiters re-check the window themselves, so waking too many is harmless.
+        for waiter in self.waiters[:max(self.limit - self.in_flight, 0)]:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def acknowledged(self, elapsed: float):
+        self.rtt += self.RTT_SMOOTHING * (elapsed - self.rtt)
+        self.size = min(self.size + 1 / self.size, self.MAX_SIZE)
+        self.wake()
+
+    def congested(self):
+        now = time.monotonic()
+        if now - self.last_decrease < self.rtt:
+            return
+        self.last_decrease = now
+        self.size = max(self.size * self.DECREASE_FACTOR, self.MIN_SIZE)
+
+    def pause(self, delay: float):
+        self.resume_at = max(self.resume_at, time.monotonic() + delay)
+        self.congested()
+
+class FlowControl:
+    # Busy replies tolerated for one request before its caller sees the last one.
+    BUSY_ATTEMPTS = 10
+
+    def __init__(self, pool: ConnectionPool):
+        self.pool = pool
+        self.windows: dict[Node, CongestionWindow] = {}
+
+    def window(self, node: Node) -> CongestionWindow:
+        return self.windows.setdefault(node, CongestionWindow())
+
+    def limit(self, node: Node) -> int:
+        return self.window(node).limit
+
+    async def request(self, node: Node, command: bytes, payload: bytes = b"", timeout: float = 30) -> list[tuple[bytes, bytes]]:
+        """Sends a request through the pool once the peer's window allows it, resending after busy replies."""
+        window = self.window(node)
+        for attempt in range(self.BUSY_ATTEMPTS):
+            await window.acquire()
+            started = time.monotonic()
+            try:
+                reply = await self.pool.request(node, command, payload, timeout)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, OSError):
+                window.congested()
+                raise
+            finally:
+                window.release()
+
+            if reply and reply[-1][0] == Command.BUSY.value:
+                (retry_after,) = RETRY_AFTER.unpack(reply[-1][1][:RETRY_AFTER.size])
+                BUSY_REPLIES.labels(str(node)).inc()
+                window.pause(retry_after / 1000)
+                continue
+            elapsed = time.monotonic() - started
+            window.acknowledged(elapsed)
+            REQUEST_SECONDS.labels(COMMAND_NAMES.get(command, "UNKNOWN")).observe(elapsed)
+            return reply
+        return reply
@@ -0,0 +1,37 @@
+import asyncio
+import struct
+
+# A frame is a 4 byte command, the FRAME_MAGIC marker, a big-endian request
+# id and payload length, and the raw payload. Replies carry the id of the
+# request they answer, so many requests can share one connection.
+# Legacy peers send the command followed by a newline-terminated payload
+# instead; their first payload byte is never FRAME_MAGIC, which is how the
+# two are told apart on the wire. Legacy frames always have request id 0.
+FRAME_MAGIC = 0xFC
+FRAME_HEADER = struct.Struct(">II")
+# Command, marker and header in front of every framed payload.
+FRAME_OVERHEAD = 5 + FRAME_HEADER.size
+
+def frame_header(command: bytes, request_id: int, length: int) -> bytes:
+    return b"".join((command, bytes((FRAME_MAGIC,)), FRAME_HEADER.pack(request_id, length)))
+
+def encode_frame(command: bytes, payload: bytes = b"", request_id: int = 0, legacy: bool = False) -> bytes:
+    if legacy:
+        return b"".join((command, payload, b"\n"))
+    return frame_header(command, request_id, len(payload)) + payload
+
+async def read_frame(reader: asyncio.StreamReader) -> tuple[bytes, int, bytes, bool]:
+    """Reads one frame, returning the command, request id, payload and whether the peer used the legacy format."""
+    command = await reader.readexactly(4)
+    marker = await reader.readexactly(1)
+    if marker[0] == FRAME_MAGIC:
+        (request_id, length) = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+        payload = await reader.readexactly(length)
+        return (command, request_id, payload, False)
+
+    if marker == b"\n":
+        return (command, 0, b"", True)
+    line = marker + await reader.readline()
+    if line.endswith(b"\n"):
+        line = line[:-1]
+    return (command, 0, line, True)
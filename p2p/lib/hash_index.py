@@ -0,0 +1,78 @@
+import os
+import sqlite3
+import threading
+
+from p2p.lib.chunking import file_checksum
+
+# Checksums of whole files, with no chunking.
+WHOLE_FILE = "sha256"
+
+def hash_whole_file(path: str) -> tuple[bytes, int, int, bytes]:
+    size = os.path.getsize(path)
+    return (file_checksum(path), size, 0, b"")
+
+class HashIndex:
+    # Remembers what hashing a file produced, keyed by its path and by how
+    # it was hashed (whole, or cut by a particular chunker). An entry only
+    # counts while the file's size, mtime and inode are those it had when
+    # it was hashed, so a changed or replaced file is hashed again. Sharing
+    # the same files again then costs a stat call per file.
+    #
+    # Files are hashed on worker threads, which share the one connection.
+    def __init__(self, file_name: str):
+        self.lock = threading.Lock()
+        self.db_connection = sqlite3.connect(file_name, check_same_thread=False)
+        with self.db_connection:
+            self.db_connection.execute('''
+                CREATE TABLE IF NOT EXISTS file_hashes (
+                    path TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    inode INTEGER NOT NULL,
+                    checksum BLOB NOT NULL,
+                    num_chunks INTEGER NOT NULL,
+                    merkle_root BLOB NOT NULL,
+                    PRIMARY KEY (path, kind)
+                )
+            ''')
+
+    def lookup(self, path: str, kind: str) -> tuple[bytes, int, int, bytes] | None:
+        """Returns the checksum, size, number of chunks and Merkle root recorded for an unchanged file, or None."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self.lock:
+            row = self.db_connection.execute('''
+                SELECT size, mtime_ns, inode, checksum, num_chunks, merkle_root FROM file_hashes WHERE path = (?) AND kind = (?)
+            ''', (path, kind)).fetchone()
+        if row is None:
+            return None
+        (size, mtime_ns, inode, checksum, num_chunks, root) = row
+        if (size, mtime_ns, inode) != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            return None
+        return (checksum, size, num_chunks, root)
+
+    def record(self, path: str, kind: str, stat: os.stat_result, checksum: bytes, num_chunks: int = 0, root: bytes = b""):
+        # stat must be taken before the file was read: if the file changes
+        # while it is hashed, its mtime no longer matches and the entry is
+        # never used.
+        with self.lock, self.db_connection:
+            self.db_connection.execute('''
+                INSERT OR REPLACE INTO file_hashes (path, kind, size, mtime_ns, inode, checksum, num_chunks, merkle_root)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (os.path.abspath(path), kind, stat.st_size, stat.st_mtime_ns, stat.st_ino, checksum, num_chunks, root))
+
+    def cached(self, path: str, kind: str, compute) -> tuple[bytes, int, int, bytes]:
+        """Returns the recorded hashes of path, or computes them with compute(path) and records them.
+
+        compute returns the checksum, size, number of chunks and Merkle root, like scan_file."""
+        found = self.lookup(path, kind)
+        if found is not None:
+            return found
+        stat = os.stat(path)
+        (checksum, size, num_chunks, root) = compute(path)
+        self.record(path, kind, stat, checksum, num_chunks, root)
+        return (checksum, size, num_chunks, root)
+
+    def close(self):
+        self.db_connection.close()
@@ -0,0 +1,123 @@
+from dataclasses import dataclass, field
+import sqlite3
+import time
+import uuid
+
+from p2p.lib.bitmap import Bitmap
+
+UPLOAD = "upload"
+DOWNLOAD = "download"
+
+@dataclass
+class JournalEntry:
+    # Progress of one transfer. Uploads are keyed by the source file and
+    # remember which chunk orders (parity included) a peer acknowledged.
+    # Downloads are keyed by file id and also remember where each chunk was
+    # written in the .part file, as content-defined chunks have no fixed
+    # offset.
+    direction: str
+    key: str
+    file_id: uuid.UUID
+    file_name: str
+    checksum: bytes
+    num_chunks: int
+    file_size: int
+    completed: Bitmap
+    extents: dict[int, tuple[int, int]] = field(default_factory=dict)
+    # Changes since the last save, so a save only writes what is new.
+    added: dict[int, tuple[int, int]] = field(default_factory=dict)
+    removed: set[int] = field(default_factory=set)
+    saved: float = 0.0
+
+    def add(self, order: int, offset: int = 0, size: int = 0):
+        self.completed.add(order)
+        self.removed.discard(order)
+        if self.direction == DOWNLOAD:
+            self.added[order] = (offset, size)
+
+    def discard(self, order: int):
+        self.completed.discard(order)
+        self.extents.pop(order, None)
+        if self.added.pop(order, None) is None:
+            self.removed.add(order)
+
+class TransferJournal:
+    # Transfers are saved at most once per SAVE_INTERVAL seconds, so a crash
+    # loses at most that much progress: those chunks are simply sent again.
+    SAVE_INTERVAL = 1.0
+
+    def __init__(self, file_name: str):
+        self.db_connection = sqlite3.connect(file_name)
+        with self.db_connection:
+            self.db_connection.execute('''
+                CREATE TABLE IF NOT EXISTS transfers (
+                    direction TEXT NOT NULL,
+                    transfer_key TEXT NOT NULL,
+                    file_id TEXT NOT NULL,
+                    file_name TEXT NOT NULL,
+                    checksum TEXT NOT NULL,
+                    num_chunks INTEGER NOT NULL,
+                    file_size INTEGER NOT NULL,
+                    completed BLOB NOT NULL,
+                    PRIMARY KEY (direction, transfer_key)
+                )
+            ''')
+            self.db_connection.execute('''
+                CREATE TABLE IF NOT EXISTS transfer_extents (
+                    transfer_key TEXT NOT NULL,
+                    chunk_order INTEGER NOT NULL,
+                    chunk_offset INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    PRIMARY KEY (transfer_key, chunk_order)
+                )
+            ''')
+
+    def load(self, direction: str, key: str) -> JournalEntry | None:
+        row = self.db_connection.execute('''
+            SELECT file_id, file_name, checksum, num_chunks, file_size, completed
+            FROM transfers WHERE direction = (?) AND transfer_key = (?)
+        ''', (direction, key)).fetchone()
+        if row is None:
+            return None
+        (file_id, file_name, checksum, num_chunks, file_size, completed) = row
+        extents = {}
+        if direction == DOWNLOAD:
+            for (order, offset, size) in self.db_connection.execute('''
+                SELECT chunk_order, chunk_offset, size FROM transfer_extents WHERE transfer_key = (?)
+            ''', (key,)):
+                extents[order] = (offset, size)
+        return JournalEntry(direction, key, uuid.UUID(file_id), file_name, bytes.fromhex(checksum), num_chunks, file_size,
+                            Bitmap(num_chunks, completed), extents)
+
+    def due(self, entry: JournalEntry) -> bool:
+        return time.monotonic() - entry.saved >= self.SAVE_INTERVAL
+
+    def save(self, entry: JournalEntry):
+        entry.saved = time.monotonic()
+        with self.db_connection:
+            self.db_connection.execute('''
+                INSERT OR REPLACE INTO transfers
+                (direction, transfer_key, file_id, file_name, checksum, num_chunks, file_size, completed)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (entry.direction, entry.key, str(entry.file_id), entry.file_name, entry.checksum.hex(),
+                  entry.num_chunks, entry.file_size, entry.completed.to_bytes()))
+            self.db_connection.executemany('''
+                INSERT OR REPLACE INTO transfer_extents (transfer_key, chunk_order, chunk_offset, size) VALUES (?, ?, ?, ?)
+            ''', ((entry.key, order, offset, size) for (order, (offset, size)) in entry.added.items()))
+            self.db_connection.executemany('''
+                DELETE FROM transfer_extents WHERE transfer_key = (?) AND chunk_order = (?)
+            ''', ((entry.key, order) for order in entry.removed))
+        entry.added.clear()
+        entry.removed.clear()
+
+    def remove(self, entry: JournalEntry):
+        with self.db_connection:
+            self.db_connection.execute('''
+                DELETE FROM transfers WHERE direction = (?) AND transfer_key = (?)
+            ''', (entry.direction, entry.key))
+            self.db_connection.execute('''
+                DELETE FROM transfer_extents WHERE transfer_key = (?)
+            ''', (entry.key,))
+
+    def close(self):
+        self.db_connection.close()
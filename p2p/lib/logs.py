@@ -0,0 +1,15 @@
+import logging
+import os
+
+# Leveled logging for the server and client. P2P_LOG_LEVEL picks the level
+# (DEBUG shows every chunk, INFO connections and transfers, WARNING only
+# problems) and OFF silences the log entirely.
+DEFAULT_LEVEL = "INFO"
+FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+def configure_logging(level: str | None = None):
+    level = (level or os.environ.get("P2P_LOG_LEVEL", DEFAULT_LEVEL)).upper()
+    if level == "OFF":
+        logging.disable(logging.CRITICAL)
+        return
+    logging.basicConfig(level=level, format=FORMAT)
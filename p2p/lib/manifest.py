@@ -0,0 +1,67 @@
+from binascii import hexlify, unhexlify
+from dataclasses import dataclass
+import struct
+import uuid
+
+# file_id, file_size, num_chunks, held, checksum, merkle_root, data_shards, parity_shards, name_len
+ENTRY = struct.Struct(">16sQII32s32sBBH")
+
+# Header of a HAVE reply, followed by the bitmap of held orders:
+# num_chunks, data_shards, parity_shards, merkle_root
+AVAILABILITY = struct.Struct(">IBB32s")
+
+# One (order, chunk_hash) pair of a HASHES reply.
+CHUNK_HASH = struct.Struct(">I32s")
+
+# The order a RETRY request asks for, after the file id in hex. Peers from
+# before files could have more than 65535 chunks send it in two bytes, in
+# their native byte order.
+RETRY_ORDER = struct.Struct(">I")
+LEGACY_RETRY_ORDER = struct.Struct("H")
+
+def encode_retry(file_id: uuid.UUID, order: int) -> bytes:
+    return hexlify(file_id.bytes) + RETRY_ORDER.pack(order)
+
+def decode_retry(data: bytes) -> tuple[uuid.UUID, int]:
+    file_id = uuid.UUID(bytes=unhexlify(data[:32]))
+    if len(data) >= 32 + RETRY_ORDER.size:
+        (order,) = RETRY_ORDER.unpack_from(data, 32)
+    else:
+        (order,) = LEGACY_RETRY_ORDER.unpack_from(data, 32)
+    return (file_id, order)
+
+@dataclass
+class FileEntry:
+    # One file in a LIST reply: what the file is and how many of its chunks
+    # (parity included) the answering peer holds.
+    file_id: uuid.UUID
+    file_name: str
+    file_size: int
+    num_chunks: int
+    checksum: bytes
+    held: int
+    data_shards: int = 0
+    parity_shards: int = 0
+    merkle_root: bytes = b""
+
+    def encode(self) -> bytes:
+        file_name = self.file_name.encode()
+        return ENTRY.pack(
+            self.file_id.bytes,
+            self.file_size,
+            self.num_chunks,
+            self.held,
+            self.checksum,
+            self.merkle_root,
+            self.data_shards,
+            self.parity_shards,
+            len(file_name)
+        ) + file_name
+
+    @classmethod
+    def decode(cls, packet: bytes):
+        (file_id, file_size, num_chunks, held, checksum, merkle_root, data_shards, parity_shards, name_len) = ENTRY.unpack_from(packet)
+        file_name = bytes(packet[ENTRY.size:ENTRY.size + name_len]).decode()
+        if not any(merkle_root):
+            merkle_root = b""
+        return FileEntry(uuid.UUID(bytes=file_id), file_name, file_size, num_chunks, checksum, held, data_shards, parity_shards, merkle_root)
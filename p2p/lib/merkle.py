@@ -0,0 +1,49 @@
+import hashlib
+
+from p2p.lib.file_chunk import FileChunk
+
+# Interior nodes hash their two children behind this prefix, so an interior
+# node can never be passed off as a chunk hash.
+NODE_PREFIX = b"\x01"
+
+def merkle_root(leaves: list[bytes]) -> bytes:
+    """Returns the root of the binary hash tree over the chunk hashes of a file, in chunk order."""
+    if not leaves:
+        return hashlib.sha256(b"").digest()
+    level = list(leaves)
+    while len(level) > 1:
+        parents = [hashlib.sha256(NODE_PREFIX + level[index] + level[index + 1]).digest() for index in range(0, len(level) - 1, 2)]
+        # An odd node out moves up a level unchanged.
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0]
+
+class ChunkVerifier:
+    # Checks every data chunk as it arrives, so a corrupt chunk is caught
+    # (and can be fetched again elsewhere) long before the whole-file
+    # checksum could tell that something was wrong.
+    def __init__(self, root: bytes = b"", leaves: list[bytes] | None = None):
+        self.root = root
+        # The chunk hashes of the file, once they have been checked against
+        # the root. Without them a chunk can only be checked against the
+        # hash it was sent with.
+        self.leaves = leaves
+
+    def verify(self, chunk: FileChunk, order: int) -> bool:
+        if chunk.order != order or chunk.is_reference or chunk.is_compressed:
+            return False
+        if self.root and chunk.merkle_root and chunk.merkle_root != self.root:
+            return False
+        digest = hashlib.sha256(chunk.data).digest()
+        if digest != chunk.chunk_hash:
+            return False
+        if self.leaves is not None and order < len(self.leaves):
+            return digest == self.leaves[order]
+        return True
+
+    def matches(self, order: int, data: bytes) -> bool:
+        """Checks data read back from disk against the hash of its order, when the chunk hashes are known."""
+        if self.leaves is None or order >= len(self.leaves):
+            return True
+        return hashlib.sha256(data).digest() == self.leaves[order]
@@ -0,0 +1,219 @@
+from abc import ABC, abstractmethod
+import asyncio
+import bisect
+import math
+import os
+
+# Counters, gauges and histograms kept in memory and served in the
+# Prometheus text format. Updating one is a dict lookup and an addition, so
+# they are cheap enough for the per-chunk paths; everything is formatted
+# only when the endpoint is scraped.
+
+# Latency buckets in seconds, from a cached lookup to a slow transfer.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for (name, value) in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+class CounterValue:
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+class GaugeValue:
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+class HistogramValue:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        # One count per bucket plus one for +Inf, cumulated when scraped.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metric(ABC):
+    TYPE = ""
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values: dict[tuple, object] = {}
+
+    @abstractmethod
+    def new_value(self):
+        """Returns the value kept for one combination of labels."""
+
+    def labels(self, *values):
+        """Returns the value for one combination of labels; hot paths should keep it rather than look it up every time."""
+        if len(values) != len(self.label_names):
+            raise ValueError(f"{self.name} takes labels {self.label_names}, got {values}")
+        value = self.values.get(values)
+        if value is None:
+            value = self.values[values] = self.new_value()
+        return value
+
+    def samples(self):
+        for (labels, value) in self.values.items():
+            yield (self.name, self.label_names, labels, value.value)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        for (name, label_names, labels, value) in self.samples():
+            lines.append(f"{name}{format_labels(label_names, labels)} {format_value(value)}")
+        return lines
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def new_value(self):
+        return CounterValue()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def new_value(self):
+        return GaugeValue()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self.labels().dec(amount)
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def new_value(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def samples(self):
+        bucket_labels = self.label_names + ("le",)
+        for (labels, value) in self.values.items():
+            cumulative = 0
+            for (bound, count) in zip(self.buckets + (math.inf,), value.counts):
+                cumulative += count
+                yield (f"{self.name}_bucket", bucket_labels, labels + (format_value(bound),), cumulative)
+            yield (f"{self.name}_sum", self.label_names, labels, value.sum)
+            yield (f"{self.name}_count", self.label_names, labels, value.count)
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: tuple = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+# Every metric of the process lives here, like the command registry of the server.
+REGISTRY = MetricsRegistry()
+
+# Traffic to and from each peer, in bytes. Prometheus turns these into
+# per-peer transfer rates with rate().
+BYTES_SENT = REGISTRY.counter("p2p_bytes_sent_total", "Bytes sent, by peer.", ("peer",))
+BYTES_RECEIVED = REGISTRY.counter("p2p_bytes_received_total", "Bytes received, by peer.", ("peer",))
+
+class MetricsServer:
+    # Answers every HTTP GET with the current metrics, on a TCP address
+    # ("127.0.0.1:9464") or a Unix socket ("unix:/run/p2p-metrics.sock").
+    # Only the request line and headers are read, which is all a scraper sends.
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+    READ_TIMEOUT = 5
+
+    def __init__(self, address: str, registry: MetricsRegistry = REGISTRY):
+        self.address = address
+        self.registry = registry
+        self.server = None
+
+    async def start(self):
+        if self.address.startswith("unix:"):
+            path = self.address.removeprefix("unix:")
+            if os.path.exists(path):
+                os.remove(path)
+            self.server = await asyncio.start_unix_server(self.handle, path)
+        else:
+            (host, _, port) = self.address.rpartition(":")
+            self.server = await asyncio.start_server(self.handle, host or "127.0.0.1", int(port))
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.READ_TIMEOUT)
+            (method, path) = request.split(b" ", 2)[:2]
+            if method != b"GET":
+                status, body = "405 Method Not Allowed", b""
+            elif path.split(b"?")[0] not in (b"/", b"/metrics"):
+                status, body = "404 Not Found", b""
+            else:
+                status, body = "200 OK", self.registry.render().encode()
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {self.CONTENT_TYPE}\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import ipaddress
 import struct
 
@@ -7,16 +7,27 @@ class Node:
 
     ip_address: ipaddress.IPv4Address
     port: int
+    # Address and port as one integer, computed once: nodes are hashed on
+    # every set and dict lookup, and hashing an IPv4Address is slow.
+    key: int = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.key = (int(self.ip_address) << 16) | self.port
 
     def encode(self) -> bytes:
         return struct.pack(">4sH", self.ip_address.packed, self.port)
 
+    @classmethod
+    def decode(cls, packet: bytes):
+        (ip_address, port) = struct.unpack(">4sH", packet[:6])
+        return Node(ipaddress.IPv4Address(ip_address), port)
+
     @classmethod
     def null_node(cls):
         return Node(ipaddress.IPv4Address("0.0.0.0"), 0)
 
     def __hash__(self) -> int:
-        return hash((self.ip_address, self.port))
+        return hash(self.key)
 
 
     def __str__(self) -> str:
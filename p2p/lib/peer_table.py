@@ -0,0 +1,114 @@
+from array import array
+from ipaddress import IPv4Address
+import struct
+import sys
+import time
+from typing import Iterable, Iterator
+
+from p2p.lib.commands import Command
+from p2p.lib.node import Node
+
+# A peer on the wire: its address and port, as in Node.encode.
+PEER_RECORD = struct.Struct(">IH")
+
+def big_endian(column: array) -> bytes:
+    if sys.byteorder == "little":
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+def encode_peers(ips: array, ports: array) -> bytes:
+    """Packs parallel address and port arrays into consecutive PEER_RECORDs."""
+    (ip_size, port_size) = (ips.itemsize, ports.itemsize)
+    if (ip_size, port_size) != (4, 2):
+        # Platforms where 'I' or 'H' are wider than the wire format.
+        return b"".join(map(PEER_RECORD.pack, ips, ports))
+    # Each column is converted to network order in one go, then its bytes
+    # are interleaved into the records with strided slice assignments.
+    (ip_bytes, port_bytes) = (big_endian(ips), big_endian(ports))
+    records = bytearray(PEER_RECORD.size * len(ips))
+    for byte in range(ip_size):
+        records[byte::PEER_RECORD.size] = ip_bytes[byte::ip_size]
+    for byte in range(port_size):
+        records[ip_size + byte::PEER_RECORD.size] = port_bytes[byte::port_size]
+    return bytes(records)
+
+class PeerTable:
+    # The known peers, column by column: addresses, ports, when each was
+    # last heard from and its last round trip time, in packed arrays of
+    # 4 + 2 + 8 + 8 bytes per peer instead of a Node and an IPv4Address
+    # object each. A dict from Node.key to the peer's row makes membership
+    # O(1); removing a peer moves the last row into its place.
+    #
+    # Iterating yields Nodes like the set this replaces did.
+    def __init__(self, nodes: Iterable[Node] = ()):
+        self.ips = array('I')
+        self.ports = array('H')
+        self.last_seen = array('d')
+        self.rtts = array('d')
+        self.rows: dict[int, int] = {}
+        # PEER replies to CONNECT, built when first needed after a change.
+        self.replies: list[tuple[bytes, bytes]] | None = None
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __contains__(self, node: Node) -> bool:
+        return node.key in self.rows
+
+    def __iter__(self) -> Iterator[Node]:
+        # A snapshot, so peers can be added or removed while iterating.
+        for (ip, port) in list(zip(self.ips, self.ports)):
+            yield Node(IPv4Address(ip), port)
+
+    def add(self, node: Node, rtt: float | None = None):
+        row = self.rows.get(node.key)
+        if row is None:
+            row = len(self.ips)
+            self.rows[node.key] = row
+            self.ips.append(node.key >> 16)
+            self.ports.append(node.port)
+            self.last_seen.append(0.0)
+            self.rtts.append(0.0)
+            self.replies = None
+        self.last_seen[row] = time.time()
+        if rtt is not None:
+            self.rtts[row] = rtt
+
+    def discard(self, node: Node):
+        row = self.rows.pop(node.key, None)
+        if row is None:
+            return
+        last = len(self.ips) - 1
+        if row != last:
+            for column in (self.ips, self.ports, self.last_seen, self.rtts):
+                column[row] = column[last]
+            self.rows[(self.ips[row] << 16) | self.ports[row]] = row
+        for column in (self.ips, self.ports, self.last_seen, self.rtts):
+            column.pop()
+        self.replies = None
+
+    def rtt(self, node: Node) -> float | None:
+        row = self.rows.get(node.key)
+        return self.rtts[row] if row is not None else None
+
+    def seen(self, node: Node) -> float | None:
+        """Returns when the peer was last heard from, as a Unix timestamp."""
+        row = self.rows.get(node.key)
+        return self.last_seen[row] if row is not None else None
+
+    def encode(self) -> bytes:
+        return encode_peers(self.ips, self.ports)
+
+    def peer_replies(self, exclude: Node | None = None) -> list[tuple[bytes, bytes]]:
+        """Returns a PEER reply for every peer but exclude, reusing the last ones built while the table is unchanged."""
+        if self.replies is None:
+            packed = self.encode()
+            size = PEER_RECORD.size
+            self.replies = [(Command.PEER.value, packed[offset:offset + size]) for offset in range(0, len(packed), size)]
+        row = self.rows.get(exclude.key) if exclude is not None else None
+        if row is None:
+            return self.replies.copy()
+        return self.replies[:row] + self.replies[row + 1:]
@@ -0,0 +1,170 @@
+import asyncio
+import itertools
+import time
+
+from p2p.lib.commands import Command
+from p2p.lib.frame import FRAME_OVERHEAD, encode_frame, read_frame
+from p2p.lib.metrics import BYTES_RECEIVED, BYTES_SENT, REGISTRY
+from p2p.lib.node import Node
+
+# Replies that complete a request. Everything else (DATA, PEER, ...) is
+# streamed to the caller until one of these arrives.
+FINAL_COMMANDS = {Command.TERMINATE.value, Command.ACKNOWLEDGE.value, Command.ERROR.value, Command.BUSY.value}
+
+POOLED_CONNECTIONS = REGISTRY.gauge("p2p_pool_connections", "Open connections to other peers.")
+
+class PeerConnection:
+    def __init__(self, node: Node, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.node = node
+        self.reader = reader
+        self.writer = writer
+        self.pending: dict[int, asyncio.Queue] = {}
+        self.request_ids = itertools.count(1)
+        self.last_used = time.monotonic()
+        self.sent = BYTES_SENT.labels(str(node))
+        self.received = BYTES_RECEIVED.labels(str(node))
+        self.read_task = asyncio.create_task(self.read_loop())
+        POOLED_CONNECTIONS.inc()
+
+    @property
+    def closed(self) -> bool:
+        return self.read_task.done() or self.writer.is_closing()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self.pending)
+
+    async def read_loop(self):
+        try:
+            while True:
+                (command, request_id, payload, _) = await read_frame(self.reader)
+                self.received.inc(FRAME_OVERHEAD + len(payload))
+                queue = self.pending.get(request_id)
+                if queue is not None:
+                    queue.put_nowait((command, payload))
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        finally:
+            # Wake up everyone still waiting on this socket.
+            for queue in self.pending.values():
+                queue.put_nowait(None)
+            self.writer.close()
+            POOLED_CONNECTIONS.dec()
+
+    async def stream(self, command: bytes, payload: bytes = b"", timeout: float = 30):
+        if self.closed:
+            raise ConnectionResetError(f"Connection to {self.node} is closed")
+
+        request_id = next(self.request_ids)
+        queue = asyncio.Queue()
+        self.pending[request_id] = queue
+        self.last_used = time.monotonic()
+        try:
+            frame = encode_frame(command, payload, request_id)
+            self.sent.inc(len(frame))
+            self.writer.write(frame)
+            await self.writer.drain()
+            while True:
+                frame = await asyncio.wait_for(queue.get(), timeout)
+                if frame is None:
+                    raise ConnectionResetError(f"Connection to {self.node} was lost")
+                yield frame
+                if frame[0] in FINAL_COMMANDS:
+                    break
+        finally:
+            del self.pending[request_id]
+            self.last_used = time.monotonic()
+
+    async def request(self, command: bytes, payload: bytes = b"", timeout: float = 30) -> list[tuple[bytes, bytes]]:
+        return [frame async for frame in self.stream(command, payload, timeout)]
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+class ConnectionPool:
+    CONNECT_TIMEOUT = 5
+    # Connections unused for this long are closed by the eviction task.
+    IDLE_TIMEOUT = 60
+    # Connections unused for this long are pinged before being handed out.
+    HEALTH_CHECK_INTERVAL = 15
+    HEALTH_CHECK_TIMEOUT = 2
+    # A new connection is opened once every existing one has this many requests in flight.
+    MAX_IN_FLIGHT = 32
+
+    def __init__(self, max_connections_per_node: int = 2, local_host: str | None = None):
+        self.max_connections_per_node = max_connections_per_node
+        # Address to connect from. Servers connect from the address they
+        # listen on, as peers know each other by it.
+        self.local_host = local_host
+        self.connections: dict[Node, list[PeerConnection]] = {}
+        self.locks: dict[Node, asyncio.Lock] = {}
+        self.eviction_task = None
+
+    async def acquire(self, node: Node) -> PeerConnection:
+        if self.eviction_task is None or self.eviction_task.done():
+            self.eviction_task = asyncio.create_task(self.evict_idle())
+
+        lock = self.locks.setdefault(node, asyncio.Lock())
+        async with lock:
+            connections = self.connections.setdefault(node, [])
+            connections[:] = [connection for connection in connections if not connection.closed]
+
+            if connections:
+                connection = min(connections, key=lambda connection: connection.in_flight)
+                if connection.in_flight < self.MAX_IN_FLIGHT or len(connections) >= self.max_connections_per_node:
+                    if await self.check_health(connection):
+                        return connection
+                    connections.remove(connection)
+
+            local_addr = (self.local_host, 0) if self.local_host else None
+            con = asyncio.open_connection(str(node.ip_address), node.port, local_addr=local_addr)
+            (reader, writer) = await asyncio.wait_for(con, timeout=self.CONNECT_TIMEOUT)
+            connection = PeerConnection(node, reader, writer)
+            connections.append(connection)
+            return connection
+
+    async def check_health(self, connection: PeerConnection) -> bool:
+        if connection.closed:
+            return False
+        if connection.in_flight > 0 or time.monotonic() - connection.last_used < self.HEALTH_CHECK_INTERVAL:
+            return True
+        try:
+            await connection.request(Command.PING.value, timeout=self.HEALTH_CHECK_TIMEOUT)
+            return True
+        except (asyncio.TimeoutError, ConnectionError, OSError):
+            await connection.close()
+            return False
+
+    async def stream(self, node: Node, command: bytes, payload: bytes = b"", timeout: float = 30):
+        connection = await self.acquire(node)
+        async for frame in connection.stream(command, payload, timeout):
+            yield frame
+
+    async def request(self, node: Node, command: bytes, payload: bytes = b"", timeout: float = 30) -> list[tuple[bytes, bytes]]:
+        connection = await self.acquire(node)
+        return await connection.request(command, payload, timeout)
+
+    async def evict_idle(self):
+        while True:
+            await asyncio.sleep(self.IDLE_TIMEOUT / 4)
+            now = time.monotonic()
+            for (node, connections) in list(self.connections.items()):
+                for connection in list(connections):
+                    idle = connection.in_flight == 0 and now - connection.last_used > self.IDLE_TIMEOUT
+                    if connection.closed or idle:
+                        connections.remove(connection)
+                        await connection.close()
+                if not connections:
+                    del self.connections[node]
+
+    async def close(self):
+        if self.eviction_task is not None:
+            self.eviction_task.cancel()
+        for connections in self.connections.values():
+            for connection in connections:
+                await connection.close()
+        self.connections.clear()
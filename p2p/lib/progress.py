@@ -0,0 +1,63 @@
+import time
+
+from p2p.lib.node import Node
+
+class TransferProgress:
+    # Minimum number of seconds between two progress lines.
+    REPORT_INTERVAL = 0.5
+
+    def __init__(self, label: str, num_chunks: int, total_bytes: int):
+        self.label = label
+        self.num_chunks = num_chunks
+        self.total_bytes = total_bytes
+        self.done_chunks = 0
+        self.done_bytes = 0
+        self.failed_chunks = 0
+        # Bytes the receiving peer already stored, so only a reference was sent.
+        self.deduplicated_bytes = 0
+        self.peer_chunks: dict[Node, int] = {}
+        self.peer_bytes: dict[Node, int] = {}
+        self.started = time.monotonic()
+        self.last_report = 0.0
+
+    @property
+    def elapsed(self) -> float:
+        return max(time.monotonic() - self.started, 1e-9)
+
+    @property
+    def throughput(self) -> float:
+        # Bytes per second since the transfer started.
+        return self.done_bytes / self.elapsed
+
+    def update(self, node: Node, size: int, deduplicated: bool = False):
+        self.done_chunks += 1
+        self.done_bytes += size
+        if deduplicated:
+            self.deduplicated_bytes += size
+        self.peer_chunks[node] = self.peer_chunks.get(node, 0) + 1
+        self.peer_bytes[node] = self.peer_bytes.get(node, 0) + size
+        self.report()
+
+    def skip(self, size: int):
+        # Sent by an earlier run, so it is not part of this transfer.
+        self.num_chunks -= 1
+        self.total_bytes -= size
+
+    def fail(self, node: Node):
+        self.failed_chunks += 1
+        self.report(force=True)
+
+    def report(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self.last_report < self.REPORT_INTERVAL and self.done_chunks < self.num_chunks:
+            return
+        self.last_report = now
+        peers = ", ".join(
+            f"{node}: {self.peer_chunks[node]} chunks ({self.peer_bytes[node] / self.elapsed / 1e6:.2f} MB/s)"
+            for node in self.peer_chunks
+        )
+        print(f"{self.label}: {self.done_chunks}/{self.num_chunks} chunks, "
+              f"{self.done_bytes}/{self.total_bytes} bytes, {self.throughput / 1e6:.2f} MB/s"
+              + (f", {self.deduplicated_bytes} bytes deduplicated" if self.deduplicated_bytes else "")
+              + (f", {self.failed_chunks} failed" if self.failed_chunks else "")
+              + (f" [{peers}]" if peers else ""))
@@ -0,0 +1,72 @@
+import bisect
+import hashlib
+import struct
+from typing import Iterable
+import uuid
+
+from p2p.lib.node import Node
+
+class HashRing:
+    # Each node owns this many points on the ring, which evens out how many
+    # chunks land on each node and how many move when one joins or leaves.
+    VIRTUAL_NODES = 64
+
+    def __init__(self, nodes: Iterable[Node], virtual_nodes: int | None = None):
+        self.nodes = set(nodes)
+        points = []
+        for node in self.nodes:
+            for index in range(virtual_nodes or self.VIRTUAL_NODES):
+                digest = hashlib.sha256(f"{node}#{index}".encode()).digest()
+                points.append((int.from_bytes(digest[:8], 'big'), node))
+        points.sort(key=lambda point: point[0])
+        self.points = [point for (point, _) in points]
+        self.owners = [node for (_, node) in points]
+
+    def replicas(self, key: bytes, count: int) -> list[Node]:
+        """Returns the first count distinct nodes clockwise from the key."""
+        found = []
+        if not self.points:
+            return found
+        start = bisect.bisect(self.points, int.from_bytes(key[:8], 'big'))
+        for index in range(len(self.owners)):
+            node = self.owners[(start + index) % len(self.owners)]
+            if node not in found:
+                found.append(node)
+                if len(found) == count:
+                    break
+        return found
+
+def placement(file_id: uuid.UUID, order: int, num_chunks: int, chunk_hash: bytes, data_shards: int = 0, parity_shards: int = 0) -> tuple[bytes, int]:
+    """Returns the ring key that places a chunk and its position among the nodes found from that key."""
+    # Plain chunks are placed by their content. Erasure coded chunks are
+    # placed by their stripe, one stripe member per peer where there are
+    # enough peers; parity chunks come after the stripe's data chunks.
+    if not data_shards:
+        return (chunk_hash, 0)
+    if order < num_chunks:
+        (stripe, position) = divmod(order, data_shards)
+    else:
+        (stripe, parity) = divmod(order - num_chunks, parity_shards)
+        position = data_shards + parity
+    return (hashlib.sha256(file_id.bytes + struct.pack(">I", stripe)).digest(), position)
+
+def holders(ring: HashRing, key: bytes, position: int, spread: int, count: int) -> list[Node]:
+    """Returns the count nodes a chunk is stored on, the first of them receiving it from the uploader."""
+    nodes = ring.replicas(key, spread)
+    return [nodes[(position + index) % len(nodes)] for index in range(min(count, len(nodes)))]
+
+# A TRANSFER payload is the number of replicas still to be reached after
+# the chunk's next_node, those replicas, and the encoded chunk.
+def encode_chain(chain: list[Node]) -> bytes:
+    return bytes((len(chain),)) + b"".join(node.encode() for node in chain)
+
+def decode_chain(payload: bytes) -> tuple[list[Node], bytes]:
+    count = payload[0]
+    chain = [Node.decode(payload[1 + index * 6:7 + index * 6]) for index in range(count)]
+    return (chain, payload[1 + count * 6:])
+
+# A TRANSFER whose chunk could not be passed all the way down the chain is
+# answered with ERROR and the replica that did not get it, encoded like a
+# Node. Other ERROR replies carry nothing or a chunk hash.
+def decode_unreachable(payload: bytes) -> Node | None:
+    return Node.decode(payload) if len(payload) == 6 else None
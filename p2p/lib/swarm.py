@@ -0,0 +1,184 @@
+import logging
+import random
+import time
+from typing import Callable
+
+from p2p.lib.metrics import REGISTRY
+from p2p.lib.node import Node
+
+log = logging.getLogger(__name__)
+
+CORRUPT_CHUNKS = REGISTRY.counter("p2p_corrupt_chunks_total", "Chunks that failed verification, by the peer that sent them.", ("peer",))
+
+class PeerStats:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+
+class PeerScores:
+    # How far a client trusts each peer's data, from 1 down towards 0.
+    # Every corrupt chunk halves the score and every good one wins a little
+    # of it back; peers below MIN_SCORE are not asked for chunks at all.
+    CORRUPTION_FACTOR = 0.5
+    RECOVERY = 0.01
+    MIN_SCORE = 0.2
+
+    def __init__(self):
+        self.scores: dict[Node, float] = {}
+
+    def score(self, peer: Node) -> float:
+        return self.scores.get(peer, 1.0)
+
+    def trusted(self, peer: Node) -> bool:
+        return self.score(peer) >= self.MIN_SCORE
+
+    def good(self, peer: Node):
+        if peer in self.scores:
+            self.scores[peer] += self.RECOVERY * (1.0 - self.scores[peer])
+
+    def corrupt(self, peer: Node):
+        self.scores[peer] = self.score(peer) * self.CORRUPTION_FACTOR
+        CORRUPT_CHUNKS.labels(str(peer)).inc()
+        log.warning("Peer %s sent a corrupt chunk, score now %.2f.", peer, self.scores[peer])
+
+    def rank(self, peers) -> list[Node]:
+        """Returns the trusted peers among the given ones, most trusted first."""
+        return sorted((peer for peer in peers if self.trusted(peer)), key=self.score, reverse=True)
+
+class SwarmScheduler:
+    # Weight of the newest sample in each peer's moving average chunk time.
+    LATENCY_SMOOTHING = 0.3
+    DEFAULT_LATENCY = 0.05
+    # A request is stalled once it has been outstanding for STALL_FACTOR
+    # times the peer's average chunk time, but never sooner than this.
+    MIN_STALL_TIMEOUT = 2.0
+    STALL_FACTOR = 8
+    # How often the downloader should wake up to look for stalled requests.
+    POLL_INTERVAL = 0.5
+    # Requests per order before it is left to the retry pass.
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, holders: dict[int, list[Node]], window: Callable[[Node], int], scores: PeerScores | None = None):
+        self.holders = holders
+        # Requests each peer may have in flight right now.
+        self.window = window
+        self.scores = scores or PeerScores()
+        self.peers: dict[Node, PeerStats] = {}
+        for peers in holders.values():
+            for peer in peers:
+                self.peers.setdefault(peer, PeerStats(self.DEFAULT_LATENCY))
+
+        self.done: set[int] = set()
+        self.in_flight: dict[int, dict[Node, float]] = {}
+        self.excluded: dict[int, set[Node]] = {}
+        self.attempts: dict[int, int] = {}
+
+        # Rarest first, with ties broken randomly so that downloaders of the
+        # same file spread their load instead of all asking for order 0.
+        orders = list(holders)
+        random.shuffle(orders)
+        orders.sort(key=lambda order: len(holders[order]))
+        self.pending = orders
+        self.queued = set(orders)
+
+    def stall_timeout(self, peer: Node) -> float:
+        return max(self.MIN_STALL_TIMEOUT, self.STALL_FACTOR * self.peers[peer].latency)
+
+    def candidates(self, order: int) -> list[Node]:
+        busy = self.in_flight.get(order, {})
+        excluded = self.excluded.get(order, set())
+        return [peer for peer in self.holders[order] if peer not in busy and peer not in excluded and self.scores.trusted(peer)]
+
+    def pick_peer(self, candidates: list[Node]) -> Node | None:
+        candidates = [peer for peer in candidates if self.peers[peer].in_flight < self.window(peer)]
+        if not candidates:
+            return None
+        # Fastest expected completion: queue length times average chunk time,
+        # stretched for peers that have sent corrupt chunks.
+        return min(candidates, key=lambda peer: (self.peers[peer].in_flight + 1) * self.peers[peer].latency / self.scores.score(peer))
+
+    def assign(self) -> list[tuple[int, Node]]:
+        assignments = []
+        remaining = []
+        for (index, order) in enumerate(self.pending):
+            if all(stats.in_flight >= self.window(peer) for (peer, stats) in self.peers.items()):
+                remaining += self.pending[index:]
+                break
+            if order in self.done:
+                self.queued.discard(order)
+                continue
+            if self.attempts.get(order, 0) >= self.MAX_ATTEMPTS:
+                self.queued.discard(order)
+                continue
+            candidates = self.candidates(order)
+            if not candidates:
+                if order in self.in_flight:
+                    # Only the stalled holders have it, wait for one of them.
+                    remaining.append(order)
+                else:
+                    # Nobody left to ask, the retry pass takes over.
+                    self.queued.discard(order)
+                continue
+            peer = self.pick_peer(candidates)
+            if peer is None:
+                remaining.append(order)
+                continue
+            self.queued.discard(order)
+            self.attempts[order] = self.attempts.get(order, 0) + 1
+            self.in_flight.setdefault(order, {})[peer] = time.monotonic()
+            self.peers[peer].in_flight += 1
+            assignments.append((order, peer))
+        self.pending = remaining
+        return assignments
+
+    def requeue(self, order: int):
+        if order in self.done or order in self.queued:
+            return
+        self.queued.add(order)
+        self.pending.insert(0, order)
+
+    def release(self, order: int, peer: Node) -> float:
+        started = self.in_flight[order].pop(peer)
+        if not self.in_flight[order]:
+            del self.in_flight[order]
+        self.peers[peer].in_flight -= 1
+        return time.monotonic() - started
+
+    def finish(self, order: int, peer: Node, successful: bool, corrupt: bool = False) -> bool:
+        """Records the outcome of a request, returning True if it completed the order.
+
+        A corrupt chunk scores its peer down and puts the order back at the
+        front of the queue, for another holder."""
+        elapsed = self.release(order, peer)
+        stats = self.peers[peer]
+        if corrupt:
+            self.scores.corrupt(peer)
+            successful = False
+        if not successful:
+            stats.failed += 1
+            self.excluded.setdefault(order, set()).add(peer)
+            self.requeue(order)
+            return False
+
+        stats.completed += 1
+        self.scores.good(peer)
+        stats.latency += self.LATENCY_SMOOTHING * (elapsed - stats.latency)
+        if order in self.done:
+            return False
+        self.done.add(order)
+        return True
+
+    def cancel(self, order: int, peer: Node):
+        self.release(order, peer)
+
+    def check_stalled(self):
+        now = time.monotonic()
+        for (order, requests) in list(self.in_flight.items()):
+            if order in self.done or order in self.queued:
+                continue
+            if all(now - started > self.stall_timeout(peer) for (peer, started) in requests.items()):
+                # Leave the slow request running, but ask another holder too.
+                self.excluded.setdefault(order, set()).update(requests)
+                self.requeue(order)
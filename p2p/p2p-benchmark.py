@@ -0,0 +1,279 @@
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+from datetime import datetime, timezone
+import importlib.util
+from ipaddress import IPv4Address
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from uuid import uuid4
+
+sys.path.append('.')
+
+from p2p.lib.commands import Command
+from p2p.lib.file_chunk import FileChunk
+from p2p.lib.flow_control import FlowControl
+from p2p.lib.node import Node
+from p2p.lib.peer_table import PeerTable
+
+# Benchmarks for the server and client. Every transfer scenario runs in a
+# fresh process with its own servers, clients and temporary directory, so
+# peak RSS is per scenario and no state leaks from one run into the next.
+# Results go to a JSON file that can be compared between versions:
+#
+#   python p2p/p2p-benchmark.py --file-sizes 1M,16M --chunk-sizes 512,65536 --peers 1,3
+
+def load_script(name: str):
+    # The server and client are scripts with dashes in their names.
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+    spec = importlib.util.spec_from_file_location(name.removesuffix('.py').replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+server_script = load_script('p2p-server.py')
+client_script = load_script('p2p-client.py')
+
+class TimedFlowControl(FlowControl):
+    # Records how long every chunk request took, by command.
+    def __init__(self, pool):
+        super().__init__(pool)
+        self.latencies: dict[bytes, list[float]] = {}
+
+    async def request(self, node: Node, command: bytes, payload: bytes = b"", timeout: float = 30) -> list[tuple[bytes, bytes]]:
+        started = time.perf_counter()
+        try:
+            return await super().request(node, command, payload, timeout)
+        finally:
+            self.latencies.setdefault(command, []).append(time.perf_counter() - started)
+
+def parse_size(text: str) -> int:
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    text = text.strip().upper()
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def parse_list(text: str, parse=int) -> list:
+    return [parse(item) for item in text.split(',') if item.strip()]
+
+def percentiles(samples: list[float]) -> dict:
+    # p50 and p99 chunk latency in milliseconds.
+    if not samples:
+        return {"count": 0, "p50_ms": None, "p99_ms": None}
+    ordered = sorted(samples)
+    def at(fraction: float) -> float:
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+    return {"count": len(ordered), "p50_ms": round(at(0.50), 3), "p99_ms": round(at(0.99), 3)}
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    return round(peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10), 1)
+
+def write_input(file_name: str, size: int, data: str):
+    with open(file_name, 'wb') as data_file:
+        written = 0
+        while written < size:
+            block = min(1 << 20, size - written)
+            if data == "text":
+                line = b"%d fun text for the benchmark, lorem ipsum dolor sit amet\n" % written
+                data_file.write((line * (block // len(line) + 1))[:block])
+            else:
+                data_file.write(os.urandom(block))
+            written += block
+
+async def transfer_scenario(file_size: int, chunk_size: int, peers: int, clients: int, replication: int, data: str) -> dict:
+    # Servers listen on 127.0.0.1, 127.0.0.2, ... as peers are told apart
+    # by address and all listen on the same port.
+    nodes = [Node(IPv4Address(f"127.0.0.{index + 1}"), server_script.Server.PORT) for index in range(peers)]
+    servers = []
+    for (index, node) in enumerate(nodes):
+        os.makedirs(f"server{index}")
+        server = server_script.Server(host=str(node.ip_address), db_file=f"server{index}/file_chunks.db", blob_dir=f"server{index}/chunks",
+                                      replication_factor=replication, metrics_address="")
+        server.peers = PeerTable(peer for peer in nodes if peer != node)
+        servers.append(server)
+    server_tasks = [asyncio.create_task(server.run_server()) for server in servers]
+
+    simulated = []
+    for index in range(clients):
+        client = client_script.Client(host="127.0.0.1", journal_file=f"client{index}.db")
+        client.CHUNK_SIZE = chunk_size
+        client.flow = TimedFlowControl(client.pool)
+        simulated.append(client)
+
+    try:
+        for client in simulated:
+            for node in nodes:
+                # The servers may still be starting up.
+                for attempt in range(50):
+                    if await client.attempt_connection(node) is not None:
+                        break
+                    await asyncio.sleep(0.1)
+
+        inputs = []
+        for index in range(clients):
+            file_name = f"input{index}.bin"
+            write_input(file_name, file_size, data)
+            inputs.append(file_name)
+
+        started = time.perf_counter()
+        file_ids = await asyncio.gather(*(
+            client.upload_file(file_name, replication_factor=replication) for (client, file_name) in zip(simulated, inputs)
+        ))
+        upload_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client.download_file(file_id) for (client, file_id) in zip(simulated, file_ids)))
+        download_time = time.perf_counter() - started
+
+        downloaded = sum(1 for file_name in os.listdir('.') if file_name.endswith(tuple(f"_{name}" for name in inputs)))
+        upload_latencies = []
+        download_latencies = []
+        for client in simulated:
+            upload_latencies += client.flow.latencies.get(Command.UPLOAD.value, []) + client.flow.latencies.get(Command.TRANSFER.value, [])
+            download_latencies += client.flow.latencies.get(Command.RETRY.value, [])
+
+        total = file_size * clients
+        return {
+            "file_size": file_size,
+            "chunk_size": chunk_size,
+            "peers": peers,
+            "clients": clients,
+            "replication": replication,
+            "data": data,
+            "upload_mb_s": round(total / upload_time / 1e6, 3),
+            "download_mb_s": round(total / download_time / 1e6, 3),
+            "upload_seconds": round(upload_time, 3),
+            "download_seconds": round(download_time, 3),
+            "upload_latency": percentiles(upload_latencies),
+            "download_latency": percentiles(download_latencies),
+            "files_downloaded": downloaded,
+        }
+    finally:
+        for client in simulated:
+            await client.pool.close()
+            client.journal.close()
+            client.hash_index.close()
+            client.executor.shutdown()
+        for task in server_tasks:
+            task.cancel()
+        await asyncio.gather(*server_tasks, return_exceptions=True)
+        for server in servers:
+            server.close()
+
+async def sqlite_scenario(rows: int) -> dict:
+    # Manifest rows written through the server's batching writer, the way
+    # concurrent uploads write them.
+    server = server_script.Server(db_file="file_chunks.db", blob_dir="chunks", metrics_address="")
+    await server.database.open()
+    try:
+        file_id = str(uuid4())
+        statement = f'''
+            INSERT OR IGNORE INTO file_chunks ({server_script.MANIFEST_COLUMNS})
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        '''
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            server.database.write([(statement, (file_id, "bench.bin", 512, order, rows, "00" * 32, "0.0.0.0", 0, order * 512, rows * 512,
+                                                order.to_bytes(32, 'big').hex(), 0, 0, ""))])
+            for order in range(rows)
+        ))
+        elapsed = time.perf_counter() - started
+        return {"rows": rows, "rows_per_second": round(rows / elapsed)}
+    finally:
+        await server.database.close()
+        server.close()
+
+def isolated(scenario, *args) -> dict:
+    # Runs in a child process, inside a temporary directory, with the
+    # servers' and clients' chatter silenced.
+    with tempfile.TemporaryDirectory(prefix="oashare-bench-") as directory:
+        os.chdir(directory)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            result = asyncio.run(scenario(*args))
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+def run_isolated(scenario, *args) -> dict:
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(isolated, scenario, *args).result()
+
+def codec_benchmark(chunk_size: int, duration: float) -> dict:
+    chunk = FileChunk(uuid4(), chunk_size, 0, 1, bytes(32), Node.null_node(), "bench.bin", os.urandom(chunk_size))
+    packet = chunk.encode()
+    result = {"chunk_size": chunk_size}
+    for (name, operation) in (("encode_ops_s", chunk.encode), ("decode_ops_s", lambda: FileChunk.decode(packet))):
+        operations = 0
+        started = time.perf_counter()
+        while (elapsed := time.perf_counter() - started) < duration:
+            for _ in range(100):
+                operation()
+            operations += 100
+        result[name] = round(operations / elapsed)
+    return result
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark OaShare servers and clients on loopback.")
+    parser.add_argument("--file-sizes", default="1M,4M", help="comma separated file sizes, e.g. 512K,16M")
+    parser.add_argument("--chunk-sizes", default="512,16384", help="comma separated chunk sizes in bytes")
+    parser.add_argument("--peers", default="1,3", help="comma separated numbers of servers")
+    parser.add_argument("--clients", type=int, default=1, help="simulated clients transferring at once")
+    parser.add_argument("--replication", type=int, default=1, help="copies of each chunk")
+    parser.add_argument("--data", choices=("random", "text"), default="random", help="file contents")
+    parser.add_argument("--sqlite-rows", type=int, default=20000, help="manifest rows to insert")
+    parser.add_argument("--codec-seconds", type=float, default=0.5, help="time spent per encode/decode measurement")
+    parser.add_argument("--output", default="benchmark.json", help="file to write the results to")
+    args = parser.parse_args()
+
+    results = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "codec": [],
+        "sqlite": None,
+        "transfers": [],
+    }
+
+    for chunk_size in parse_list(args.chunk_sizes, parse_size):
+        result = codec_benchmark(chunk_size, args.codec_seconds)
+        print(f"FileChunk {chunk_size} B: {result['encode_ops_s']} encodes/s, {result['decode_ops_s']} decodes/s")
+        results["codec"].append(result)
+
+    results["sqlite"] = run_isolated(sqlite_scenario, args.sqlite_rows)
+    print(f"SQLite: {results['sqlite']['rows_per_second']} rows/s")
+
+    for file_size in parse_list(args.file_sizes, parse_size):
+        for chunk_size in parse_list(args.chunk_sizes, parse_size):
+            for peers in parse_list(args.peers):
+                result = run_isolated(transfer_scenario, file_size, chunk_size, peers, args.clients, min(args.replication, peers), args.data)
+                print(f"{file_size} B file, {chunk_size} B chunks, {peers} peers: "
+                      f"upload {result['upload_mb_s']} MB/s (p50 {result['upload_latency']['p50_ms']} ms, p99 {result['upload_latency']['p99_ms']} ms), "
+                      f"download {result['download_mb_s']} MB/s (p50 {result['download_latency']['p50_ms']} ms, p99 {result['download_latency']['p99_ms']} ms), "
+                      f"peak RSS {result['peak_rss_mb']} MB")
+                results["transfers"].append(result)
+
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -1,295 +1,693 @@
 import asyncio
 from binascii import hexlify
-from ipaddress import IPv4Address, IPv4Interface, IPv4Network
-import hashlib
-import itertools
-import math
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from ipaddress import IPv4Address
+import logging
+import os
 import random
-import socket
 import struct
 import sys
+import time
 from uuid import uuid4, UUID
 
 sys.path.append('.')
 
 import netifaces
 
+from p2p.lib.assembler import FileAssembler
+from p2p.lib.bitmap import Bitmap
+from p2p.lib.chunking import ContentDefinedChunker, FixedChunker, scan_file
 from p2p.lib.commands import Command
+from p2p.lib.compression import available_codecs, compress_chunk, decode_codecs, decompress_chunk, encode_codecs
+from p2p.lib.discovery import Discovery, PeerCache, parse_seeds
+from p2p.lib.erasure import ReedSolomon, parity_order, stripe_count, total_chunks
 from p2p.lib.file_chunk import FileChunk
+from p2p.lib.flow_control import FlowControl
+from p2p.lib.hash_index import HashIndex
+from p2p.lib.journal import DOWNLOAD, UPLOAD, JournalEntry, TransferJournal
+from p2p.lib.logs import configure_logging
+from p2p.lib.manifest import AVAILABILITY, CHUNK_HASH, FileEntry, encode_retry
+from p2p.lib.merkle import ChunkVerifier, merkle_root
+from p2p.lib.metrics import MetricsServer
 from p2p.lib.node import Node
+from p2p.lib.peer_table import PeerTable
+from p2p.lib.pool import ConnectionPool
+from p2p.lib.progress import TransferProgress
+from p2p.lib.replication import HashRing, decode_unreachable, encode_chain, holders, placement
+from p2p.lib.swarm import PeerScores, SwarmScheduler
+
+log = logging.getLogger("p2p.client")
 
 class Client:
     CHUNK_SIZE = 512
-    peers: set[Node]
-
-    def __init__(self):
-        (self.interface, self.host) = get_usable_interface()
+    # "fixed" cuts CHUNK_SIZE chunks, "cdc" cuts on content so that edited
+    # files share most of their chunks with the original.
+    CHUNKING = "fixed"
+    CDC_MIN_SIZE = 2048
+    CDC_AVG_SIZE = 8192
+    CDC_MAX_SIZE = 65536
+    # Chunks read ahead per sharing peer during an upload; how many of them
+    # are in flight is up to the peer's congestion window.
+    UPLOAD_WINDOW = 64
+    UPLOAD_ATTEMPTS = 5
+    UPLOAD_BACKOFF = 0.2
+    UPLOAD_MAX_BACKOFF = 5
+    # Chunks per content lookup.
+    UPLOAD_BATCH = 256
+    # Peers each chunk is stored on. The uploader sends a chunk to the first
+    # of them, which passes it down the chain through next_node.
+    REPLICATION_FACTOR = 3
+    # (data, parity) chunks per stripe to erasure code uploads with, or None
+    # to only replicate. Coded uploads store each chunk once by default.
+    ERASURE_CODE = None
+    # Peers that answered during the last discovery, probed first next time.
+    PEER_CACHE_FILE = 'known_peers.json'
+    # Progress of unfinished uploads and downloads, so they resume after a
+    # crash or restart instead of starting over.
+    JOURNAL_FILE = 'transfers.db'
+    # Checksums and Merkle roots of files already scanned, so sharing an
+    # unchanged file again does not read it twice.
+    HASH_INDEX_FILE = 'hash_index.db'
+    # Compress chunks for peers that agreed on a codec during CONNECT, at
+    # the codec's default level unless COMPRESSION_LEVEL is set.
+    COMPRESSION = True
+    COMPRESSION_LEVEL = None
+    # Chunks at least this large are compressed on a worker thread.
+    OFFLOAD_SIZE = 16384
+    # Where to serve metrics while the client runs, as for the server. Off
+    # by default, as the client usually runs next to a server.
+    METRICS_ADDRESS = ''
+    peers: PeerTable
+
+    def __init__(self, host: str | None = None, journal_file: str | None = None, metrics_address: str | None = None):
+        if host is None:
+            (self.interface, self.host) = get_usable_interface()
+
+            if self.interface is None or self.host is None:
+                print("No usable interfaces found.")
+                sys.exit(1)
+        else:
+            # A given address, such as a loopback one in benchmarks, has no
+            # interface to send discovery beacons on.
+            (self.interface, self.host) = (None, host)
 
-        if self.interface is None or self.host is None:
-            print("No usable interfaces found.")
-            sys.exit(1)
-
-        self.ip_interface = IPv4Interface(self.host)
-        self.ip_network = IPv4Network(self.ip_interface.network.supernet(8))
         self.localhost = IPv4Address(self.host)
 
-        self.peers = set()
+        self.peers = PeerTable()
+        self.pool = ConnectionPool()
+        # Chunk traffic goes through a per-peer congestion window on top of the pool.
+        self.flow = FlowControl(self.pool)
+        # Peers that served corrupt chunks are asked last, or not at all.
+        self.scores = PeerScores()
+        self.journal = TransferJournal(journal_file or self.JOURNAL_FILE)
+        # The codecs each peer accepts chunks in, most preferred first.
+        self.codecs: dict[Node, list[str]] = {}
+        self.executor = ThreadPoolExecutor()
+        self.hash_index = HashIndex(self.HASH_INDEX_FILE)
+        self.metrics_address = metrics_address if metrics_address is not None else self.METRICS_ADDRESS
 
         print(f"Client started on {self.localhost} ({self.interface}).")
 
-    async def test_connections(self):
-        connection_tasks = set()
-        async with asyncio.TaskGroup() as tg:
-            for host in self.ip_network.hosts():
-                if host.is_reserved:
-                    continue
-                # if host == localhost:
-                #     continue
-                task = tg.create_task(self.test_connection(host, 3000))
-                connection_tasks.add(task)
-                task.add_done_callback(connection_tasks.discard)
-
-        print("Total peers:", len(self.peers))
-
     async def attempt_connections(self):
-        connection_tasks = set()
-        async with asyncio.TaskGroup() as tg:
-            for host in self.ip_network.hosts():
-                if host.is_reserved:
-                    continue
-                if host == self.localhost:
-                    continue
-                node = Node(host, 3000)
-                task = tg.create_task(self.attempt_connection(node))
-                connection_tasks.add(task)
-                task.add_done_callback(connection_tasks.discard)
-
-        print("Total peers:", len(self.peers))
-
-
-    async def attempt_connection(self, node: Node):
-        ip = node.ip_address
-        port = node.port
-        con = asyncio.open_connection(str(ip), port)
-        try:
-            reader, writer = await asyncio.wait_for(con, timeout=5)
-            await asyncio.sleep(0.01)
-            writer.write(Command.CONNECT.value)
-            writer.write(node.encode())
-            writer.write(b"\n")
-            await writer.drain()
-            await asyncio.sleep(0.01)
-            command = await reader.read(4)
-            while command.hex() != Command.TERMINATE.value.hex():
-                line = await reader.readline()
-                await asyncio.sleep(0.01)
-                command = await reader.read(4)
-                await asyncio.sleep(0.01)
-            if node not in self.peers:
-                print(f"CLIENT: Unrecognized peer {node}, updating entries.")
-                self.peers.add(node)
-            await asyncio.sleep(0.1)
-            return (ip, port, True)
-        except (asyncio.TimeoutError, ConnectionRefusedError, OSError) as e:
-            await asyncio.sleep(0.01)
-            return (ip, port, False)
-        except Exception as e:
-            raise e
-
-    async def test_connection(self, ip: IPv4Address, port: int):
-        con = asyncio.open_connection(str(ip), port)
+        # Beacon replies, seed peers and cached peers are probed, and every
+        # peer they report over CONNECT is probed in turn.
+        discovery = Discovery(
+            self.attempt_connection,
+            exclude={self.localhost},
+            seeds=parse_seeds(os.environ.get("OASHARE_SEEDS", "")),
+            cache=PeerCache(self.PEER_CACHE_FILE),
+            broadcast_addresses=get_broadcast_addresses(self.interface) if self.interface else []
+        )
+        started = time.monotonic()
+        await discovery.discover()
+
+        print(f"Total peers: {len(self.peers)} ({time.monotonic() - started:.3f}s)")
+
+
+    async def attempt_connection(self, node: Node) -> list[Node] | None:
+        gossip = []
+        offer = encode_codecs(available_codecs()) if self.COMPRESSION else b""
+        started = time.monotonic()
         try:
-            reader, writer = await asyncio.wait_for(con, timeout=5)
-            writer.write(Command.CONNECT.value)
-            writer.write(struct.pack("4sH", ip.packed, port))
-            writer.write(b"\n")
-            await writer.drain()
-            result = await reader.read(1024)
-            print(f"{ip}:{port}",result.decode())
-            writer.close()
-            await writer.wait_closed()
-            node = Node(ip, port)
+            async for (command, payload) in self.pool.stream(node, Command.CONNECT.value, node.encode() + offer):
+                if command == Command.PEER.value:
+                    gossip.append(Node.decode(payload))
+                elif command == Command.CONNECT.value:
+                    self.codecs[node] = decode_codecs(payload)
             if node not in self.peers:
-                print(f"Unrecognized peer {node}, updating entries.")
-                self.peers.add(node)
-            return (ip, port, True)
-        except (asyncio.TimeoutError, ConnectionRefusedError, OSError) as e:
-            return (ip, port, False)
-        except Exception as e:
-            raise e
+                log.info("Unrecognized peer %s, updating entries.", node)
+            self.peers.add(node, rtt=time.monotonic() - started)
+            return gossip
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionRefusedError, OSError):
+            return None
 
     async def download_chunks(self, node: Node, file_id: UUID):
-        ip = node.ip_address
-        port = node.port
-        con = asyncio.open_connection(str(ip), port)
         chunks = []
         try:
-            reader, writer = await asyncio.wait_for(con, timeout=5)
-            writer.write(Command.DOWNLOAD.value)
-            writer.write(hexlify(file_id.bytes))
-            writer.write(b"\n")
-            await writer.drain()
-            await asyncio.sleep(0.01)
-            command = await reader.read(4)
-            while command.hex() != Command.TERMINATE.value.hex():
-                line = await reader.readline()
-                chunk = FileChunk.decode(line)
-                chunks.append(chunk)
-                await asyncio.sleep(0.01)
-                command = await reader.read(4)
-            writer.close()
-            await writer.wait_closed()
-            await asyncio.sleep(random.uniform(0.1,0.2))
+            async for (command, payload) in self.pool.stream(node, Command.DOWNLOAD.value, hexlify(file_id.bytes)):
+                if command != Command.DATA.value:
+                    continue
+                chunk = await self.read_chunk(node, payload)
+                if chunk is not None:
+                    chunks.append(chunk)
             return chunks
-        except (asyncio.TimeoutError, ConnectionRefusedError, OSError) as e:
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionRefusedError, OSError):
             return []
-        except Exception as e:
-            raise e
-
-    async def retry(self, file_id: UUID, missing_chunk: int):
-        print(f"Retrying file {file_id}, chunk {missing_chunk}")
-
-        chunks = []
-        for peer in self.peers:
-            ip = peer.ip_address
-            port = peer.port
-            con = asyncio.open_connection(str(ip), port)
-            try:
-                reader, writer = await asyncio.wait_for(con, timeout=5)
-                await asyncio.sleep(0.01)
-                writer.write(Command.RETRY.value)
-                writer.write(hexlify(file_id.bytes))
-                writer.write(struct.pack('H', missing_chunk))
-                writer.write(b"\n")
-                await writer.drain()
-                await asyncio.sleep(0.01)
-                command = await reader.read(4)
-                while command.hex() != Command.TERMINATE.value.hex():
-                    line = await reader.readline()
-                    chunk = FileChunk.decode(line)
-                    chunks.append(chunk)
-                    await asyncio.sleep(0.01)
-                    command = await reader.read(4)
-                writer.close()
-                await writer.wait_closed()
-                await asyncio.sleep(random.uniform(0.1,0.2))
-            except (asyncio.TimeoutError, ConnectionRefusedError, OSError) as e:
-                chunks += []
-            except Exception as e:
-                raise e
 
-            await asyncio.sleep(0.01)
-        return chunks
+    async def fetch_chunk(self, peer: Node, file_id: UUID, order: int) -> FileChunk | None:
+        try:
+            found = None
+            for (command, payload) in await self.flow.request(peer, Command.RETRY.value, encode_retry(file_id, order)):
+                if command != Command.DATA.value:
+                    continue
+                chunk = await self.read_chunk(peer, payload)
+                if chunk is None:
+                    return None
+                if chunk.order == order:
+                    found = chunk
+            return found
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionRefusedError, OSError):
+            return None
+
+    async def offload(self, size: int, function, *args):
+        # Small jobs are cheaper to run inline than to hand to a thread.
+        if size < self.OFFLOAD_SIZE:
+            return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def read_chunk(self, peer: Node, payload: bytes) -> FileChunk | None:
+        # A malformed chunk fails only its own fetch, not the whole download,
+        # and counts against the peer that sent it.
+        try:
+            chunk = FileChunk.decode(payload)
+            return await self.offload(chunk.size, decompress_chunk, chunk)
+        except (ValueError, struct.error) as e:
+            log.warning("Could not read a chunk from %s: %s", peer, e)
+            self.scores.corrupt(peer)
+            return None
+
+    async def compress(self, peer: Node, chunk: FileChunk) -> FileChunk:
+        codecs = self.codecs.get(peer)
+        if not self.COMPRESSION or not codecs:
+            return chunk
+        return await self.offload(chunk.size, compress_chunk, chunk, codecs[0], self.COMPRESSION_LEVEL)
+
+    async def retry(self, file_id: UUID, missing_chunk: int, verifier: ChunkVerifier):
+        log.info("Retrying file %s, chunk %d.", file_id, missing_chunk)
+
+        for peer in self.scores.rank(self.peers):
+            chunk = await self.fetch_chunk(peer, file_id, missing_chunk)
+            if chunk is None:
+                continue
+            if verifier.verify(chunk, missing_chunk):
+                return [chunk]
+            self.scores.corrupt(peer)
+        return []
+
+    async def fetch_availability(self, peer: Node, file_id: UUID) -> tuple[int, tuple[int, int], bytes, Bitmap | None]:
+        # Returns the number of data chunks, the erasure code, the Merkle
+        # root and which orders the peer holds, parity chunks included.
+        try:
+            for (command, payload) in await self.flow.request(peer, Command.HAVE.value, hexlify(file_id.bytes)):
+                if command == Command.HAVE.value:
+                    (num_chunks, data_shards, parity_shards, root) = AVAILABILITY.unpack_from(payload)
+                    bitmap = Bitmap(total_chunks(num_chunks, data_shards, parity_shards), payload[AVAILABILITY.size:])
+                    return (num_chunks, (data_shards, parity_shards), root if any(root) else b"", bitmap)
+                if command == Command.ERROR.value:
+                    # Peers from before HAVE existed only support whole-file downloads.
+                    return (-1, (0, 0), b"", None)
+            return (0, (0, 0), b"", None)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionRefusedError, OSError):
+            return (0, (0, 0), b"", None)
+
+    async def fetch_hashes(self, peer: Node, file_id: UUID) -> dict[int, bytes]:
+        # The content hashes of the data chunks the peer holds, by order.
+        hashes = {}
+        try:
+            for (command, payload) in await self.flow.request(peer, Command.HASHES.value, hexlify(file_id.bytes)):
+                if command == Command.HASHES.value:
+                    for (order, chunk_hash) in CHUNK_HASH.iter_unpack(payload):
+                        hashes[order] = chunk_hash
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionRefusedError, OSError):
+            pass
+        return hashes
+
+    async def open_verifier(self, file_id: UUID, root: bytes, num_chunks: int, peers: list[Node]) -> ChunkVerifier:
+        # Collect every data chunk's hash from the peers and keep them only
+        # if they hash up to the file's Merkle root. A peer that lies about
+        # a hash then cannot get a bad chunk past us.
+        if not root or not num_chunks:
+            return ChunkVerifier(root)
+        replies = await asyncio.gather(*(self.fetch_hashes(peer, file_id) for peer in peers))
+        candidates: dict[int, dict[bytes, int]] = {}
+        for hashes in replies:
+            for (order, chunk_hash) in hashes.items():
+                votes = candidates.setdefault(order, {})
+                votes[chunk_hash] = votes.get(chunk_hash, 0) + 1
+        if len(candidates) < num_chunks:
+            return ChunkVerifier(root)
+        leaves = [max(candidates[order], key=candidates[order].get) for order in range(num_chunks)]
+        if merkle_root(leaves) != root:
+            log.warning("Chunk hashes for %s do not match its Merkle root.", file_id)
+            return ChunkVerifier(root)
+        return ChunkVerifier(root, leaves)
+
+    async def fetch_listing(self, peer: Node, prefix: str) -> list[FileEntry]:
+        try:
+            return [
+                FileEntry.decode(payload)
+                for (command, payload) in await self.flow.request(peer, Command.LIST.value, prefix.encode())
+                if command == Command.LIST.value
+            ]
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionRefusedError, OSError):
+            return []
 
+    async def list_files(self, prefix: str = "") -> dict[UUID, tuple[FileEntry, dict[Node, int]]]:
+        # Every file the peers know of whose name starts with prefix, with
+        # how many of its chunks each peer holds. No chunk data is sent.
+        peers = list(self.peers)
+        listings = await asyncio.gather(*(self.fetch_listing(peer, prefix) for peer in peers))
+        files: dict[UUID, tuple[FileEntry, dict[Node, int]]] = {}
+        for (peer, entries) in zip(peers, listings):
+            for entry in entries:
+                (_, holders) = files.setdefault(entry.file_id, (entry, {}))
+                holders[peer] = entry.held
+        for (entry, holders) in files.values():
+            print(f"{entry.file_id} {entry.file_name} {entry.file_size} bytes, {entry.num_chunks} chunks, "
+                  f"checksum {entry.checksum.hex()[:16]}, on {len(holders)} peers")
+        return files
+
+    def open_assembler(self, chunk: FileChunk) -> FileAssembler:
+        # The first chunk to arrive tells us where and how big the file is.
+        log.debug("%s", chunk)
+        file_name = f'{hexlify(chunk.file_checksum).decode()}_{chunk.file_name}'
+        entry = JournalEntry(DOWNLOAD, str(chunk.file_id), chunk.file_id, file_name, chunk.file_checksum, chunk.num_chunks, chunk.file_size,
+                             Bitmap(chunk.num_chunks))
+        return FileAssembler(file_name, chunk.file_checksum, chunk.num_chunks, chunk.file_size, entry)
+
+    def resume_download(self, file_id: UUID) -> FileAssembler | None:
+        entry = self.journal.load(DOWNLOAD, str(file_id))
+        if entry is None:
+            return None
+        assembler = FileAssembler(entry.file_name, entry.checksum, entry.num_chunks, entry.file_size, entry)
+        print(f"Resuming download of {entry.file_name}: {len(assembler.written)}/{entry.num_chunks} chunks already on disk.")
+        return assembler
+
+    def store_chunk(self, assembler: FileAssembler | None, chunk: FileChunk) -> FileAssembler:
+        if assembler is None:
+            assembler = self.open_assembler(chunk)
+        assembler.write(chunk)
+        self.save_download(assembler)
+        return assembler
+
+    def save_download(self, assembler: FileAssembler, force: bool = False):
+        entry = assembler.journal_entry
+        if entry is None or not (force or self.journal.due(entry)):
+            return
+        # The chunks the journal lists must be on disk before it says so.
+        assembler.flush()
+        self.journal.save(entry)
+
+    async def fetch_parity(self, file_id: UUID, num_chunks: int, parity_shards: int, stripe: int, needed: int, holders: dict[int, list[Node]], verifier: ChunkVerifier) -> list[FileChunk]:
+        found = []
+        for parity in range(parity_shards):
+            order = parity_order(num_chunks, parity_shards, stripe, parity)
+            for peer in self.scores.rank(holders.get(order, [])):
+                chunk = await self.fetch_chunk(peer, file_id, order)
+                if chunk is None:
+                    continue
+                if not verifier.verify(chunk, order):
+                    self.scores.corrupt(peer)
+                    continue
+                found.append(chunk)
+                break
+            if len(found) == needed:
+                break
+        return found
+
+    async def recover_stripes(self, file_id: UUID, num_chunks: int, code: tuple[int, int], holders: dict[int, list[Node]], assembler: FileAssembler | None, verifier: ChunkVerifier) -> FileAssembler | None:
+        # Rebuild the data chunks we could not download from their stripe's
+        # parity chunks: any data_shards chunks of a stripe will do.
+        (data_shards, parity_shards) = code
+        damaged = {}
+        for stripe in range(stripe_count(num_chunks, data_shards)):
+            orders = range(stripe * data_shards, min((stripe + 1) * data_shards, num_chunks))
+            missing = [order for order in orders if assembler is None or order not in assembler]
+            if missing:
+                damaged[stripe] = (orders, missing)
+        if not damaged:
+            return assembler
+
+        codec = ReedSolomon(data_shards, parity_shards)
+        parities = await asyncio.gather(*(
+            self.fetch_parity(file_id, num_chunks, parity_shards, stripe, len(missing), holders, verifier)
+            for (stripe, (_, missing)) in damaged.items()
+        ))
+        for ((stripe, (orders, missing)), parity) in zip(damaged.items(), parities):
+            if len(parity) < len(missing):
+                log.warning("Stripe %d has too few chunks left to rebuild.", stripe)
+                continue
+            if assembler is None:
+                assembler = self.open_assembler(parity[0])
+            template = parity[0]
+            width = template.size
+            first = stripe * data_shards
+
+            available = {}
+            for order in orders:
+                if order in assembler:
+                    available[order - first] = assembler.read(order * width, width)
+            # Stripes past the end of the file are padded with zero chunks.
+            for index in range(len(orders), data_shards):
+                available[index] = b""
+            for chunk in parity:
+                available[data_shards + chunk.order - parity_order(num_chunks, parity_shards, stripe, 0)] = chunk.data
+
+            data = codec.decode(available, width)
+            for order in missing:
+                offset = order * width
+                size = min(width, template.file_size - offset)
+                chunk = replace(template, order=order, size=size, offset=offset, data=data[order - first][:size], chunk_hash=b"")
+                if not verifier.verify(chunk, order):
+                    log.warning("Rebuilt chunk %d of stripe %d does not match its hash.", order, stripe)
+                    continue
+                assembler.write(chunk)
+        return assembler
 
     async def download_file(self, file_id: UUID):
-        chunks: list[FileChunk] = []
-        for peer in self.peers:
-            chunks += await self.download_chunks(peer, file_id)
-            await asyncio.sleep(random.uniform(0.1,0.2))
+        peers = list(self.peers)
+        replies = await asyncio.gather(*(self.fetch_availability(peer, file_id) for peer in peers))
+
+        num_chunks = 0
+        code = (0, 0)
+        roots: dict[bytes, int] = {}
+        holders: dict[int, list[Node]] = {}
+        # Parity chunks are only fetched to rebuild data chunks nobody could send.
+        parity_holders: dict[int, list[Node]] = {}
+        legacy_peers = []
+        for (peer, (peer_chunks, peer_code, root, bitmap)) in zip(peers, replies):
+            if bitmap is not None:
+                num_chunks = max(num_chunks, peer_chunks)
+                if peer_code[0]:
+                    code = peer_code
+                if root:
+                    roots[root] = roots.get(root, 0) + 1
+                for order in bitmap:
+                    if order < peer_chunks:
+                        holders.setdefault(order, []).append(peer)
+                    else:
+                        parity_holders.setdefault(order, []).append(peer)
+            elif peer_chunks < 0:
+                legacy_peers.append(peer)
+
+        # The root most peers agree on, and the chunk hashes that match it.
+        root = max(roots, key=roots.get) if roots else b""
+        verifier = await self.open_verifier(file_id, root, num_chunks, [peer for (peer, reply) in zip(peers, replies) if reply[3] is not None])
+
+        # Chunks an interrupted run already wrote are not fetched again.
+        assembler = self.resume_download(file_id)
+        for peer in legacy_peers:
+            for chunk in await self.download_chunks(peer, file_id):
+                if not verifier.verify(chunk, chunk.order):
+                    self.scores.corrupt(peer)
+                    continue
+                num_chunks = max(num_chunks, chunk.num_chunks)
+                assembler = self.store_chunk(assembler, chunk)
+
+        if assembler is not None:
+            holders = {order: peers for (order, peers) in holders.items() if order not in assembler}
+        scheduler = SwarmScheduler(holders, self.flow.limit, self.scores)
+        tasks: dict[asyncio.Task, tuple[int, Node]] = {}
+        while True:
+            for (order, peer) in scheduler.assign():
+                task = asyncio.create_task(self.fetch_chunk(peer, file_id, order))
+                tasks[task] = (order, peer)
+            if not tasks:
+                break
+
+            (done, _) = await asyncio.wait(tasks, timeout=scheduler.POLL_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                (order, peer) = tasks.pop(task)
+                chunk = task.result()
+                # A corrupt chunk is asked of another holder right away.
+                corrupt = chunk is not None and not verifier.verify(chunk, order)
+                if scheduler.finish(order, peer, chunk is not None, corrupt):
+                    assembler = self.store_chunk(assembler, chunk)
+
+            # Drop duplicate requests for orders another holder already delivered.
+            for (task, (order, peer)) in list(tasks.items()):
+                if order in scheduler.done:
+                    task.cancel()
+                    del tasks[task]
+                    scheduler.cancel(order, peer)
+            scheduler.check_stalled()
+
+        # Chunks from an interrupted run are only read back now, once the
+        # network is busy with the rest; any that changed on disk are
+        # fetched again below.
+        if assembler is not None and assembler.unverified:
+            dropped = assembler.recheck(verifier.matches)
+            if dropped:
+                log.warning("%d chunks on disk did not match, fetching them again.", len(dropped))
+
+        if code[0]:
+            assembler = await self.recover_stripes(file_id, num_chunks, code, parity_holders, assembler, verifier)
+        else:
+            for order in range(num_chunks):
+                if assembler is not None and order in assembler:
+                    continue
+                for chunk in await self.retry(file_id, order, verifier):
+                    assembler = self.store_chunk(assembler, chunk)
 
-        if len(chunks) <= 0:
+        if assembler is None:
             return
 
-        file_id = chunks[0].file_id
-        num_chunks = chunks[0].num_chunks
-
-        print(chunks[0])
-
-        num_missing_chunks = num_chunks - len(chunks)
-
-        retry_chunks = []
-        if num_missing_chunks >= 0:
-            all_chunks = set(range(num_chunks))
-            for chunk in chunks:
-                if chunk.order in all_chunks:
-                    all_chunks.remove(chunk.order)
-                else:
-                    print("RETRY")
-                    retry_chunks += await self.retry(file_id, chunk.order)
-                    await asyncio.sleep(random.uniform(0.1,0.2))
-
+        log.debug("Chunks %d/%d.", len(assembler.written), assembler.num_chunks)
 
-        await self.reconstruct(chunks + retry_chunks)
-
-    async def reconstruct(self, chunks: list[FileChunk]):
-        checksum = chunks[0].file_checksum
-        file_name = chunks[0].file_name
-
-        sorted_chunks: list[FileChunk] = sorted(chunks, key=lambda chunk: chunk.order)
-        for chunk in sorted_chunks:
-            print(f"CHUNK #{chunk.order + 1}/{chunk.num_chunks}")
-
-        reconstructed_chunks = b"".join([chunk.data for chunk in sorted_chunks])
-        reconstructed_checksum = hashlib.sha256(reconstructed_chunks).digest()
-
-        print(reconstructed_checksum, checksum)
-
-        if reconstructed_checksum != checksum:
+        complete = assembler.complete()
+        if not complete:
+            self.save_download(assembler, force=True)
+        if assembler.finish():
+            self.journal.remove(assembler.journal_entry)
+        elif complete:
+            # The file did not match its checksum and is gone.
+            self.journal.remove(assembler.journal_entry)
             print("Oh no!")
-            return
+        else:
+            print(f"Download of {file_id} is incomplete, it resumes from here next time.")
 
-        with open(f'{hexlify(checksum).decode()}_{file_name}', 'wb') as out_file:
-            out_file.write(reconstructed_chunks)
-
-    async def upload_chunk(self, receiver_node: Node, chunk: FileChunk):
+    async def upload_chunk(self, receiver_node: Node, chunk: FileChunk, chain: list[Node]):
         ip = receiver_node.ip_address
         port = receiver_node.port
-        con = asyncio.open_connection(str(ip), port)
         try:
-            reader, writer = await asyncio.wait_for(con, timeout=5)
-            await asyncio.sleep(0.01)
-            writer.write(Command.UPLOAD.value)
-            writer.write(chunk.encode())
-            writer.write(b"\n")
-            await writer.drain()
-            await asyncio.sleep(0.01)
-            result = await reader.read(1024)
-            print(result.decode())
-            writer.close()
-            await writer.wait_closed()
-            await asyncio.sleep(random.uniform(0.1,0.2))
-            return (ip, port, True)
-        except (asyncio.TimeoutError, ConnectionRefusedError, OSError) as e:
-            print("Upload failed.")
-            return (ip, port, False)
-        except Exception as e:
-            raise e
-
-    async def upload_file(self, file_name: str):
-        all_peers = self.peers.copy()
-
-        sharing_peers = []
-        while len(all_peers) > 0 and len(sharing_peers) < 4:
-            sharing_peers.append(all_peers.pop())
+            if chunk.next_node.port:
+                (request, payload) = (Command.TRANSFER.value, encode_chain(chain) + chunk.encode())
+            else:
+                (request, payload) = (Command.UPLOAD.value, chunk.encode())
+            [(command, result)] = await self.flow.request(receiver_node, request, payload)
+            # A failed TRANSFER names the replica down the chain that did not get the chunk.
+            unreachable = decode_unreachable(result) if command == Command.ERROR.value and chunk.next_node.port else None
+            return (ip, port, command == Command.ACKNOWLEDGE.value, unreachable)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionRefusedError, OSError):
+            return (ip, port, False, None)
+
+    def replace_replica(self, chunk: FileChunk, chain: list[Node], unreachable: Node, receiver_node: Node, ring: HashRing, ring_key: bytes, failed: set[Node]) -> tuple[FileChunk, list[Node]]:
+        # The next peer on the ring that is not holding a copy yet takes the
+        # unreachable replica's place. Without one, the chunk is stored on
+        # one peer fewer rather than not at all.
+        replicas = [chunk.next_node, *chain]
+        if unreachable not in replicas:
+            return (chunk, chain)
+        failed.add(unreachable)
+        taken = {receiver_node, *replicas, *failed}
+        spare = next((node for node in ring.replicas(ring_key, len(ring.nodes)) if node not in taken), None)
+        index = replicas.index(unreachable)
+        if spare is None:
+            del replicas[index]
+        else:
+            replicas[index] = spare
+        if not replicas:
+            return (replace(chunk, next_node=Node.null_node()), [])
+        return (replace(chunk, next_node=replicas[0]), replicas[1:])
+
+    async def lookup_chunks(self, receiver_node: Node, chunks: list[FileChunk]) -> Bitmap:
+        # Ask which of these chunks the peer already stores by content hash.
+        present = Bitmap(len(chunks))
+        try:
+            payload = b"".join(chunk.chunk_hash for chunk in chunks)
+            for (command, result) in await self.flow.request(receiver_node, Command.LOOKUP.value, payload):
+                if command == Command.HAVE.value:
+                    present = Bitmap(len(chunks), result)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionRefusedError, OSError):
+            pass
+        return present
+
+    async def send_chunk(self, receiver_node: Node, chunk: FileChunk, chain: list[Node], stored: bool, window: asyncio.Semaphore, progress: TransferProgress, entry: JournalEntry,
+                         ring: HashRing, ring_key: bytes):
+        try:
+            if stored:
+                # Only the manifest entry is sent; if the peer lost the
+                # content in the meantime, fall back to a full upload.
+                (receiver_ip, receiver_port, successful, _) = await self.upload_chunk(receiver_node, chunk.reference(), chain)
+                if successful:
+                    progress.update(receiver_node, chunk.size, deduplicated=True)
+                    self.save_upload(entry, chunk.order)
+                    return True
+            # Compressed once, however often it has to be sent.
+            payload = await self.compress(receiver_node, chunk)
+            failed = set()
+            for attempt in range(self.UPLOAD_ATTEMPTS):
+                (receiver_ip, receiver_port, successful, unreachable) = await self.upload_chunk(receiver_node, payload, chain)
+                if successful:
+                    progress.update(receiver_node, chunk.size)
+                    self.save_upload(entry, chunk.order)
+                    return True
+                if unreachable is not None:
+                    (payload, chain) = self.replace_replica(payload, chain, unreachable, receiver_node, ring, ring_key, failed)
+                # Exponential backoff with jitter, only after a failed send.
+                delay = min(self.UPLOAD_BACKOFF * 2 ** attempt, self.UPLOAD_MAX_BACKOFF)
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            log.warning("Giving up on chunk %d for %s.", chunk.order, receiver_node)
+            progress.fail(receiver_node)
+            return False
+        finally:
+            window.release()
+
+    def save_upload(self, entry: JournalEntry, order: int):
+        entry.add(order)
+        if self.journal.due(entry):
+            self.journal.save(entry)
+
+    async def send_batch(self, batch: list[tuple[Node, FileChunk, list[Node], bytes]], windows: dict[Node, asyncio.Semaphore], progress: TransferProgress, entry: JournalEntry,
+                         ring: HashRing, tg: asyncio.TaskGroup):
+        by_receiver: dict[Node, list[FileChunk]] = {}
+        for (receiver_node, chunk, _, _) in batch:
+            by_receiver.setdefault(receiver_node, []).append(chunk)
+
+        receivers = list(by_receiver)
+        lookups = await asyncio.gather(*(self.lookup_chunks(receiver, by_receiver[receiver]) for receiver in receivers))
+        stored = {receiver: present for (receiver, present) in zip(receivers, lookups)}
+
+        positions = {receiver: 0 for receiver in receivers}
+        for (receiver_node, chunk, chain, ring_key) in batch:
+            position = positions[receiver_node]
+            positions[receiver_node] += 1
+            window = windows[receiver_node]
+            await window.acquire()
+            tg.create_task(self.send_chunk(receiver_node, chunk, chain, position in stored[receiver_node], window, progress, entry, ring, ring_key))
+
+    def chunker(self, chunking: str):
+        if chunking == "cdc":
+            return ContentDefinedChunker(self.CDC_MIN_SIZE, self.CDC_AVG_SIZE, self.CDC_MAX_SIZE)
+        if chunking == "fixed":
+            return FixedChunker(self.CHUNK_SIZE)
+        raise ValueError(f"Unknown chunking mode {chunking}")
+
+    def stripe_chunks(self, chunks, codec: ReedSolomon | None):
+        # Yields every chunk to upload, with each stripe's parity chunks
+        # following its last data chunk.
+        stripe = []
+        for chunk in chunks:
+            yield chunk
+            if codec is None:
+                continue
+            stripe.append(chunk)
+            if len(stripe) == codec.data_shards or chunk.order == chunk.num_chunks - 1:
+                number = chunk.order // codec.data_shards
+                blocks = codec.encode([bytes(member.data) for member in stripe], self.CHUNK_SIZE)
+                for (parity, block) in enumerate(blocks):
+                    order = parity_order(chunk.num_chunks, codec.parity_shards, number, parity)
+                    offset = number * codec.data_shards * self.CHUNK_SIZE
+                    yield replace(chunk, size=len(block), order=order, offset=offset, data=block, chunk_hash=b"")
+                stripe = []
+
+    async def upload_file(self, file_name: str, window_size: int | None = None, chunking: str | None = None,
+                          replication_factor: int | None = None, erasure_code: tuple[int, int] | None = None):
+        sharing_peers = list(self.peers)
+
+        if not sharing_peers:
+            print("No peers to upload to.")
+            return None
+
+        chunking = chunking or self.CHUNKING
+        erasure_code = erasure_code or self.ERASURE_CODE
+        codec = None
+        (data_shards, parity_shards) = (0, 0)
+        if erasure_code:
+            # Lost chunks are rebuilt at offsets derived from their order.
+            if chunking != "fixed":
+                raise ValueError("Erasure coding needs fixed size chunks")
+            (data_shards, parity_shards) = erasure_code
+            codec = ReedSolomon(data_shards, parity_shards)
+            replication_factor = replication_factor or 1
+
+        # Chunks are placed by consistent hashing, so every uploader agrees
+        # on where a chunk lives and a peer leaving only moves the chunks it
+        # held.
+        ring = HashRing(sharing_peers)
+        replication_factor = min(replication_factor or self.REPLICATION_FACTOR, len(sharing_peers))
+        spread = data_shards + parity_shards if codec else replication_factor
+
+        # Each peer gets its own window of in-flight chunks, so a slow peer
+        # only holds back its own share of the file.
+        windows = {peer: asyncio.Semaphore(window_size or self.UPLOAD_WINDOW) for peer in sharing_peers}
+
+        # Every chunk header carries the whole-file checksum, the number of
+        # chunks and the Merkle root of their hashes, so one streaming pass
+        # chunks and hashes the file before anything is sent, unless the hash
+        # index has them from an earlier upload. The second pass re-cuts the
+        # same chunks. The scan runs on a worker thread; hashlib releases the
+        # GIL on large buffers, so the event loop keeps going meanwhile.
+        chunker = self.chunker(chunking)
+        (checksum, file_size, num_chunks, root) = await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.hash_index.cached, file_name, chunker.key, lambda path: scan_file(path, chunker)
+        )
+        parity_chunks = total_chunks(num_chunks, data_shards, parity_shards) - num_chunks
+        progress = TransferProgress(f"Upload {file_name}", num_chunks + parity_chunks, file_size + parity_chunks * self.CHUNK_SIZE)
+
+        # An interrupted upload of the same content keeps its file id and
+        # only sends the chunks no peer acknowledged yet.
+        key = f"{os.path.abspath(file_name)}:{checksum.hex()}:{chunker.key}:{data_shards}+{parity_shards}"
+        entry = self.journal.load(UPLOAD, key)
+        if entry is None:
+            entry = JournalEntry(UPLOAD, key, uuid4(), file_name, checksum, num_chunks + parity_chunks, file_size, Bitmap(num_chunks + parity_chunks))
+        else:
+            print(f"Resuming upload of {file_name}: {len(entry.completed)}/{entry.num_chunks} chunks already sent.")
 
         with open(file_name, 'rb') as data_file:
-            full_file = data_file.read()
-            checksum = hashlib.sha256(full_file).digest()
-            num_chunks = math.ceil(len(full_file)/self.CHUNK_SIZE)
-            data_file.seek(0)
-            index = 0
-            file_id = uuid4()
-            while True:
-                data_chunk = data_file.read(self.CHUNK_SIZE)
-                if not data_chunk:
-                    break
-                size = len(data_chunk)
-
-                receiver_node = sharing_peers[index % len(sharing_peers)]
-                next_node = sharing_peers[(index + 1) % len(sharing_peers)]
-                if size < self.CHUNK_SIZE:
-                    next_node = Node(IPv4Address("0.0.0.0"), 0)
-                chunk = FileChunk(file_id, size, index, num_chunks, checksum, next_node, file_name, data_chunk)
-                index += 1
-
-                (receiver_ip, receiver_port, successful) = await self.upload_chunk(receiver_node, chunk)
-                await asyncio.sleep(random.uniform(0.1,0.2))
-                if not successful:
-                    await asyncio.sleep(random.uniform(0.5,1.5))
-                    print("Retrying upload.")
-                    await self.upload_chunk(receiver_node, chunk)
-            return file_id
+            file_id = entry.file_id
+            batch = []
+            chunks = (
+                FileChunk(file_id, len(data_chunk), order, num_chunks, checksum, Node.null_node(), file_name, data_chunk, offset, file_size,
+                          data_shards=data_shards, parity_shards=parity_shards, merkle_root=root)
+                for (order, (offset, data_chunk)) in enumerate(chunker.chunks(data_file))
+            )
+            async with asyncio.TaskGroup() as tg:
+                for chunk in self.stripe_chunks(chunks, codec):
+                    if chunk.order in entry.completed:
+                        progress.skip(chunk.size)
+                        continue
+                    (ring_key, position) = placement(file_id, chunk.order, num_chunks, chunk.chunk_hash, data_shards, parity_shards)
+                    (receiver_node, *chain) = holders(ring, ring_key, position, spread, replication_factor)
+                    if chain:
+                        chunk.next_node = chain.pop(0)
+
+                    # Chunks are looked up in batches so the peers can tell
+                    # us which content they already store.
+                    batch.append((receiver_node, chunk, chain, ring_key))
+                    if len(batch) >= self.UPLOAD_BATCH:
+                        await self.send_batch(batch, windows, progress, entry, ring, tg)
+                        batch = []
+                if batch:
+                    await self.send_batch(batch, windows, progress, entry, ring, tg)
+
+        if progress.failed_chunks:
+            self.journal.save(entry)
+            print(f"Upload of {file_name} is incomplete, it resumes from here next time.")
+        else:
+            self.journal.remove(entry)
+        return file_id
 
 
 def get_network_interfaces():
@@ -304,6 +702,14 @@ def get_network_interfaces():
 
     return interface_info
 
+def get_broadcast_addresses(interface: str) -> list[str]:
+    addresses = []
+    for address in netifaces.ifaddresses(interface).get(netifaces.AF_INET, []):
+        if 'broadcast' in address:
+            addresses.append(address['broadcast'])
+    addresses.append('255.255.255.255')
+    return addresses
+
 def get_usable_interface():
     network_interfaces = get_network_interfaces()
     for interface, ip in network_interfaces.items():
@@ -312,34 +718,32 @@ def get_usable_interface():
         return (interface, ip)
     return (None, None)
 
+async def run_client(client: Client):
+    # Everything runs on one event loop so pooled connections survive
+    # between the discovery, upload and download steps.
+    metrics = MetricsServer(client.metrics_address) if client.metrics_address else None
+    try:
+        if metrics is not None:
+            try:
+                await metrics.start()
+            except OSError as e:
+                log.warning("Metrics unavailable at %s: %s", client.metrics_address, e)
+                metrics = None
+        await client.attempt_connections()
+        file_id = await client.upload_file('fun.txt')
+        await client.download_file(file_id)
+    finally:
+        if metrics is not None:
+            await metrics.close()
+        await client.pool.close()
+        client.journal.close()
+        client.hash_index.close()
+        client.executor.shutdown()
+
 def main():
+    configure_logging()
     client = Client()
-    asyncio.run(client.attempt_connections())
-    asyncio.run(asyncio.sleep(random.uniform(0.5, 2.5)))
-    file_id = asyncio.run(client.upload_file('fun.txt'))
-    asyncio.run(asyncio.sleep(random.uniform(0.5, 2.5)))
-    asyncio.run(client.download_file(file_id))
-
-def test_chunks():
-    next_node = Node(IPv4Address("127.0.0.1"), 12345)
-    data = b"0" * 512
-    checksum = hashlib.sha256(data).digest()
-    chunk = FileChunk(uuid4(), 512, 1, 1, checksum, next_node, "test.dat", data)
-    chunk_bytes = chunk.encode()
-    test_chunk = FileChunk.decode(chunk_bytes)
-
-    assert test_chunk.next_node.ip_address == chunk.next_node.ip_address
-    assert str(test_chunk.next_node.ip_address) == "127.0.0.1"
-    assert test_chunk.next_node.port == chunk.next_node.port
-    assert test_chunk.file_id == chunk.file_id
-    assert test_chunk.num_chunks == chunk.num_chunks
-    assert test_chunk.num_chunks == 1
-    assert test_chunk.file_name == chunk.file_name
-    assert test_chunk.file_checksum == chunk.file_checksum
-    assert test_chunk.size == chunk.size
-    assert test_chunk.order == chunk.order
-    assert test_chunk.data == chunk.data
+    asyncio.run(run_client(client))
 
 if __name__ == "__main__":
-    test_chunks()
     main()
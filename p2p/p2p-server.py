@@ -1,201 +1,925 @@
 import asyncio
 from binascii import unhexlify
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
 import hashlib
-from ipaddress import IPv4Network, IPv4Address
+from ipaddress import IPv4Address
+import logging
+import os
+import random
 import socket
 from uuid import UUID
 import sqlite3
-import aiosqlite
-import struct
 import sys
+import time
 
 sys.path.append('.')
 
+from p2p.lib.bitmap import Bitmap
+from p2p.lib.blob_store import BlobStore
+from p2p.lib.chunk_cache import ChunkCache, EncodedChunk
 from p2p.lib.commands import Command
-from p2p.lib.file_chunk import FileChunk
+from p2p.lib.compression import available_codecs, codec_name, content_digest, decode_codecs, decompress_chunk, encode_codecs
+from p2p.lib.database import ChunkDatabase
+from p2p.lib.dispatch import CommandRegistry
+from p2p.lib.erasure import total_chunks
+from p2p.lib.discovery import BeaconResponder, parse_seeds
+from p2p.lib.file_chunk import COMPRESSION_FLAGS, FileChunk
+from p2p.lib.flow_control import FlowControl, RETRY_AFTER
+from p2p.lib.manifest import AVAILABILITY, CHUNK_HASH, FileEntry, decode_retry
+from p2p.lib.frame import FRAME_OVERHEAD, encode_frame, frame_header, read_frame
+from p2p.lib.logs import configure_logging
+from p2p.lib.metrics import BYTES_RECEIVED, BYTES_SENT, REGISTRY, MetricsServer
 from p2p.lib.node import Node
+from p2p.lib.peer_table import PeerTable
+from p2p.lib.pool import ConnectionPool
+from p2p.lib.replication import HashRing, decode_chain, decode_unreachable, encode_chain, holders, placement
+
+# Column order used by every query that rebuilds a FileChunk, see chunk_from_row.
+CHUNK_COLUMNS = "file_id, file_name, size, chunk_order, num_chunks, checksum, next_ip, next_port, pack, pack_offset, stored_size, compression, chunk_offset, file_size, chunk_hash, data_shards, parity_shards, merkle_root"
+# Columns of a file's manifest entry; the payload lives in the blob store.
+MANIFEST_COLUMNS = "file_id, file_name, size, chunk_order, num_chunks, checksum, next_ip, next_port, chunk_offset, file_size, chunk_hash, data_shards, parity_shards, merkle_root"
+
+# Columns of a file's entry in the files table.
+FILE_COLUMNS = "file_id, file_name, file_size, num_chunks, checksum, data_shards, parity_shards, merkle_root"
+
+# Handlers register themselves below with @commands.handler.
+commands = CommandRegistry()
+
+log = logging.getLogger("p2p.server")
+
+CONNECTIONS = REGISTRY.gauge("p2p_server_connections", "Connections being served.")
+REJECTED_CONNECTIONS = REGISTRY.counter("p2p_server_rejected_connections_total", "Connections turned away with an ERROR.")
+IN_FLIGHT = REGISTRY.gauge("p2p_server_requests_in_flight", "Throttled requests being handled.")
+BUSY_REPLIES = REGISTRY.counter("p2p_server_busy_total", "Requests answered with BUSY.")
 
 class Server:
-    peers: set[Node]
+    peers: PeerTable
+    # Peers find each other by address, always on port 3000.
+    HOST = '0.0.0.0'
+    PORT = 3000
     DB_FILE = 'file_chunks.db'
-    def __init__(self):
-        self.peers = set()
+    BLOB_DIR = 'chunks'
+    # Hashes accepted by one LOOKUP request.
+    MAX_LOOKUP = 4096
+    # Throttled requests handled at once across all clients. Beyond that,
+    # framed clients are told to back off for BUSY_RETRY_AFTER seconds.
+    MAX_IN_FLIGHT = 256
+    BUSY_RETRY_AFTER = 0.05
+    # Every connection is served by its own task. At most MAX_CONNECTIONS
+    # are served at once and at most MAX_CONNECTIONS_PER_PEER per peer;
+    # up to MAX_WAITING more wait for a slot, the rest get an ERROR.
+    MAX_CONNECTIONS = 256
+    MAX_CONNECTIONS_PER_PEER = 8
+    MAX_WAITING = 64
+    # Seconds a rejected connection gets to send the request we reply to.
+    REJECT_TIMEOUT = 1
+    # Pending connections the kernel keeps before refusing new ones.
+    BACKLOG = 512
+    # Payloads at least this large are hashed and encoded on a worker thread.
+    OFFLOAD_SIZE = 16384
+    # Where the metrics are served in the Prometheus text format: a local
+    # host:port, or unix:/path for a Unix socket. Empty turns it off.
+    METRICS_ADDRESS = '127.0.0.1:9464'
+    # Bytes of recently stored or requested chunks kept in memory with
+    # their headers encoded, so popular files skip SQLite and the blob
+    # store. 0 turns the cache off.
+    CHUNK_CACHE_SIZE = 64 << 20
+    # Copies of each chunk kept across the peers; see rereplicate. Erasure
+    # coded chunks are stored once by default, as uploaders do.
+    REPLICATION_FACTOR = 3
+    ERASURE_REPLICATION_FACTOR = 1
+    # Addresses that connect are checked for a server of their own, see
+    # process_peer, at most once per PROBE_INTERVAL seconds.
+    PROBE_INTERVAL = 60
+    PROBE_TIMEOUT = 2
+    # Servers learn the ring from their seeds and then from each other:
+    # every GOSSIP_INTERVAL seconds a random peer is asked for its peers.
+    GOSSIP_INTERVAL = 30
 
-        self.db_connection = sqlite3.connect(self.DB_FILE)
+    def __init__(self, max_connections: int | None = None, max_connections_per_peer: int | None = None,
+                 max_waiting: int | None = None, backlog: int | None = None, cpu_workers: int | None = None,
+                 replication_factor: int | None = None, host: str | None = None, db_file: str | None = None,
+                 blob_dir: str | None = None, metrics_address: str | None = None, chunk_cache_size: int | None = None,
+                 seeds: set[Node] | None = None):
+        self.host = host or self.HOST
+        self.metrics_address = metrics_address if metrics_address is not None else self.METRICS_ADDRESS
+        self.db_file = db_file or self.DB_FILE
+        self.replication_factor = replication_factor or self.REPLICATION_FACTOR
+        self.max_connections = max_connections or self.MAX_CONNECTIONS
+        self.max_connections_per_peer = max_connections_per_peer or self.MAX_CONNECTIONS_PER_PEER
+        self.max_waiting = max_waiting if max_waiting is not None else self.MAX_WAITING
+        self.backlog = backlog or self.BACKLOG
+        # hashlib and base64 release the GIL on large buffers, so threads
+        # are enough to keep them off the event loop.
+        self.executor = ThreadPoolExecutor(max_workers=cpu_workers or os.cpu_count())
+        self.connection_slots = None
+        self.waiting = 0
+        self.peer_connections: dict[Node, int] = {}
+
+        self.peers = PeerTable()
+        # Codecs each peer agreed to receive chunks in, see process_connection.
+        self.codecs: dict[Node, list[str]] = {}
+        # Addresses peers reach us on, so we can find ourselves on the ring.
+        self.local_nodes: set[Node] = set()
+        if self.host != self.HOST:
+            self.local_nodes.add(Node(IPv4Address(self.host), self.PORT))
+        # Servers joined through on startup, as clients find peers beyond
+        # the broadcast domain.
+        self.seeds = seeds if seeds is not None else parse_seeds(os.environ.get("OASHARE_SEEDS", ""))
+        # When each peer that sent DISCONNECT left, so an answer it sent
+        # before that does not add it again.
+        self.departures: dict[Node, float] = {}
+        # When each address not known as a peer was last checked for a server.
+        self.probed: dict[Node, float] = {}
+        # Forwarding and repairs talk to other peers like a client would.
+        self.pool = ConnectionPool(local_host=self.host if self.host != self.HOST else None)
+        self.flow = FlowControl(self.pool)
+        self.background: set[asyncio.Task] = set()
+        # Set while shutting down, so departures of peers leaving at the same
+        # time do not start repairs that would be cancelled anyway.
+        self.closing = False
+        self.blobs = BlobStore(blob_dir or self.BLOB_DIR)
+        self.chunk_cache = ChunkCache(chunk_cache_size if chunk_cache_size is not None else self.CHUNK_CACHE_SIZE)
+        # Locations of payloads appended but not yet committed, so concurrent
+        # uploads of the same content append it only once.
+        self.storing: dict[str, tuple[int, int, int, int]] = {}
+        self.in_flight = 0
+
+        self.db_connection = sqlite3.connect(self.db_file)
 
         with self.db_connection:
+            self.create_tables()
+
+        # All queries at runtime share this one connection; see ChunkDatabase.
+        self.database = ChunkDatabase(self.db_file)
+
+    def create_tables(self):
+        # file_chunks is the manifest of every file, one row per chunk order.
+        # Payloads are stored once per distinct content in the blob store,
+        # and chunk_data maps each content hash to where its bytes live, so
+        # files that share chunks share storage.
+        self.db_connection.execute('''
+            CREATE TABLE IF NOT EXISTS file_chunks (
+                file_id TEXT NOT NULL,
+                file_name TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                chunk_order INTEGER NOT NULL,
+                num_chunks INTEGER NOT NULL,
+                checksum TEXT NOT NULL,
+                next_ip TEXT,
+                next_port INTEGER,
+                chunk_offset INTEGER NOT NULL DEFAULT 0,
+                file_size INTEGER NOT NULL DEFAULT 0,
+                chunk_hash TEXT NOT NULL DEFAULT '',
+                data_shards INTEGER NOT NULL DEFAULT 0,
+                parity_shards INTEGER NOT NULL DEFAULT 0,
+                merkle_root TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY (file_id, chunk_order)
+            )
+        ''')
+        self.db_connection.execute('''
+            CREATE TABLE IF NOT EXISTS chunk_data (
+                chunk_hash TEXT PRIMARY KEY,
+                pack INTEGER NOT NULL DEFAULT 0,
+                pack_offset INTEGER NOT NULL DEFAULT 0,
+                stored_size INTEGER NOT NULL DEFAULT 0,
+                compression INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+
+        # Databases created before chunks carried their offset.
+        columns = {row[1] for row in self.db_connection.execute("PRAGMA table_info(file_chunks)")}
+        if 'chunk_offset' not in columns:
+            self.db_connection.execute("ALTER TABLE file_chunks ADD COLUMN chunk_offset INTEGER NOT NULL DEFAULT 0")
+            self.db_connection.execute("UPDATE file_chunks SET chunk_offset = chunk_order * 512")
+        if 'file_size' not in columns:
+            self.db_connection.execute("ALTER TABLE file_chunks ADD COLUMN file_size INTEGER NOT NULL DEFAULT 0")
+        if 'chunk_hash' not in columns:
+            self.db_connection.execute("ALTER TABLE file_chunks ADD COLUMN chunk_hash TEXT NOT NULL DEFAULT ''")
+        # Databases created before erasure coding.
+        if 'data_shards' not in columns:
+            self.db_connection.execute("ALTER TABLE file_chunks ADD COLUMN data_shards INTEGER NOT NULL DEFAULT 0")
+            self.db_connection.execute("ALTER TABLE file_chunks ADD COLUMN parity_shards INTEGER NOT NULL DEFAULT 0")
+        # Databases created before chunks carried the file's Merkle root.
+        if 'merkle_root' not in columns:
+            self.db_connection.execute("ALTER TABLE file_chunks ADD COLUMN merkle_root TEXT NOT NULL DEFAULT ''")
+        # Databases created before deduplication kept the payload in every row.
+        if 'data' in columns:
+            hashes = []
+            for (rowid, data) in self.db_connection.execute("SELECT rowid, data FROM file_chunks"):
+                chunk_hash = hashlib.sha256(data).hexdigest()
+                self.migrate_blob(chunk_hash, data)
+                hashes.append((chunk_hash, rowid))
+            self.db_connection.executemany("UPDATE file_chunks SET chunk_hash = ? WHERE rowid = ?", hashes)
+            self.db_connection.execute("ALTER TABLE file_chunks DROP COLUMN data")
+        # Databases created before the blob store kept payloads in chunk_data.
+        columns = {row[1] for row in self.db_connection.execute("PRAGMA table_info(chunk_data)")}
+        if 'data' in columns:
+            self.db_connection.execute("ALTER TABLE chunk_data RENAME TO chunk_blobs")
             self.db_connection.execute('''
-                CREATE TABLE IF NOT EXISTS file_chunks (
-                    file_id TEXT NOT NULL,
-                    file_name TEXT NOT NULL,
-                    size INTEGER NOT NULL,
-                    chunk_order INTEGER NOT NULL,
-                    num_chunks INTEGER NOT NULL,
-                    checksum TEXT NOT NULL,
-                    next_ip TEXT,
-                    next_port INTEGER,
-                    data BLOB NOT NULL,
-                    PRIMARY KEY (file_id, chunk_order)
+                CREATE TABLE chunk_data (
+                    chunk_hash TEXT PRIMARY KEY,
+                    pack INTEGER NOT NULL DEFAULT 0,
+                    pack_offset INTEGER NOT NULL DEFAULT 0,
+                    stored_size INTEGER NOT NULL DEFAULT 0
                 )
             ''')
+            for (chunk_hash, data) in self.db_connection.execute("SELECT chunk_hash, data FROM chunk_blobs"):
+                self.migrate_blob(chunk_hash, data)
+            self.db_connection.execute("DROP TABLE chunk_blobs")
+        # Databases created before chunks could be stored compressed.
+        columns = {row[1] for row in self.db_connection.execute("PRAGMA table_info(chunk_data)")}
+        if 'compression' not in columns:
+            self.db_connection.execute("ALTER TABLE chunk_data ADD COLUMN compression INTEGER NOT NULL DEFAULT 0")
+
+        # One row per file, so files can be listed and looked up by name
+        # without scanning every chunk. Chunk orders are looked up through
+        # the (file_id, chunk_order) primary key of file_chunks.
+        listed = self.db_connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'files'").fetchone()
+        self.db_connection.execute('''
+            CREATE TABLE IF NOT EXISTS files (
+                file_id TEXT PRIMARY KEY,
+                file_name TEXT NOT NULL,
+                file_size INTEGER NOT NULL,
+                num_chunks INTEGER NOT NULL,
+                checksum TEXT NOT NULL,
+                data_shards INTEGER NOT NULL DEFAULT 0,
+                parity_shards INTEGER NOT NULL DEFAULT 0,
+                merkle_root TEXT NOT NULL DEFAULT ''
+            )
+        ''')
+        self.db_connection.execute("CREATE INDEX IF NOT EXISTS files_by_name ON files (file_name)")
+        columns = {row[1] for row in self.db_connection.execute("PRAGMA table_info(files)")}
+        if 'merkle_root' not in columns:
+            self.db_connection.execute("ALTER TABLE files ADD COLUMN merkle_root TEXT NOT NULL DEFAULT ''")
+        if not listed:
+            self.db_connection.execute(f'''
+                INSERT OR IGNORE INTO files ({FILE_COLUMNS})
+                SELECT {FILE_COLUMNS} FROM file_chunks GROUP BY file_id
+            ''')
+
+    def migrate_blob(self, chunk_hash: str, data: bytes):
+        if self.db_connection.execute("SELECT 1 FROM chunk_data WHERE chunk_hash = (?)", (chunk_hash,)).fetchone():
+            return
+        (pack, offset) = self.blobs.append(data)
+        self.db_connection.execute(
+            "INSERT INTO chunk_data (chunk_hash, pack, pack_offset, stored_size) VALUES (?, ?, ?, ?)",
+            (chunk_hash, pack, offset, len(data))
+        )
 
     def process_peer(self, client_socket: socket.socket):
         client_ip, client_port = client_socket.getpeername()
-        print(f"Incoming connection from {client_ip}:{client_port}")
-        node = Node(IPv4Address(client_ip), 3000)
-        if node not in self.peers:
+        log.debug("Incoming connection from %s:%s.", client_ip, client_port)
+        self.local_nodes.add(Node(IPv4Address(client_socket.getsockname()[0]), self.PORT))
+        node = Node(IPv4Address(client_ip), self.PORT)
+        if node in self.local_nodes:
+            # A client next to us, not a peer.
+            pass
+        elif node in self.peers:
+            # Known peers are added again to note when they were last seen.
             self.peers.add(node)
-            print(f"SERVER: Unrecognized peer {node}. Updating entries.")
+        else:
+            self.probe(node)
         return node
 
-    async def process_connection(self, client_node:Node) -> bytes:
+    def probe(self, node: Node):
+        # Clients connect too, but only addresses with a server listening on
+        # PORT become peers. Uploaders place chunks on a ring of the servers
+        # they found, and ours has to hold the same ones for repairs to go to
+        # the same places.
+        if node in self.local_nodes:
+            return
+        checked = self.probed.get(node)
+        if checked is not None and time.monotonic() - checked < self.PROBE_INTERVAL:
+            return
+        self.probed[node] = time.monotonic()
+        self.spawn(self.check_peer(node))
+
+    def spawn(self, coroutine):
+        # Background work is cancelled when the server shuts down.
+        task = asyncio.create_task(coroutine)
+        self.background.add(task)
+        task.add_done_callback(self.background.discard)
+
+    async def check_peer(self, node: Node):
+        # Every server answers CONNECT with the peers it knows of, which are
+        # checked in turn, so the servers end up with the same ring.
+        gossip = []
+        accepted = []
+        started = time.monotonic()
+        try:
+            async for (command, payload) in self.pool.stream(node, Command.CONNECT.value, node.encode() + encode_codecs(available_codecs()),
+                                                             timeout=self.PROBE_TIMEOUT):
+                if command == Command.PEER.value:
+                    gossip.append(Node.decode(payload))
+                elif command == Command.CONNECT.value:
+                    accepted = decode_codecs(payload)
+                elif command == Command.ERROR.value:
+                    # The server is shutting down.
+                    return
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionRefusedError, OSError):
+            log.debug("No server at %s, not adding it as a peer.", node)
+            return
+        self.probed.pop(node, None)
+        # A seed may be one of our own addresses.
+        if node in self.local_nodes or self.departures.get(node, 0.0) >= started:
+            return
+        self.codecs[node] = accepted
+        if node not in self.peers:
+            log.info("Unrecognized peer %s, updating entries.", node)
+        self.peers.add(node)
+        for peer in gossip:
+            if peer not in self.peers:
+                self.probe(peer)
+
+    async def gossip(self):
+        while True:
+            # Seeds are tried every round until they answer, as servers
+            # often start at about the same time.
+            nodes = [seed for seed in self.seeds if seed not in self.peers and seed not in self.local_nodes]
+            peers = list(self.peers)
+            if peers:
+                nodes.append(random.choice(peers))
+            await asyncio.gather(*(self.check_peer(node) for node in nodes))
+            await asyncio.sleep(self.GOSSIP_INTERVAL)
+
+    @commands.handler(Command.CONNECT)
+    async def process_connection(self, data: bytes, client_node: Node) -> list:
         # Receive connection
         # Offer list of known peers (including self)
         # Maybe selection of chunks?
-        response = b""
-        for peer in self.peers:
-            if peer == client_node:
-                continue
-            response += Command.PEER.value
-            response += peer.encode()
-            response += b"\n"
+        if self.closing:
+            # We are leaving, no one should take us for a peer.
+            return [(Command.ERROR.value, b"")]
+        response = self.peers.peer_replies(exclude=client_node)
 
-        response += Command.TERMINATE.value
+        # After the node, clients list the codecs they can read chunks in,
+        # most preferred first. We answer with the ones we support too;
+        # clients that list none only ever get uncompressed chunks.
+        if len(data) > 6:
+            accepted = decode_codecs(data[6:])
+            self.codecs[client_node] = accepted
+            response.append((Command.CONNECT.value, encode_codecs(accepted)))
 
+        response.append((Command.TERMINATE.value, b""))
+
+        return response
+
+    @commands.handler(Command.UPLOAD, throttled=True)
+    async def process_upload(self, data: bytes, client_node: Node) -> list:
+        return await self.store_chunk(FileChunk.decode(data))
+
+    @commands.handler(Command.TRANSFER, throttled=True)
+    async def process_transfer(self, data: bytes, client_node: Node) -> list:
+        # An upload that is to be passed on: after storing the chunk, we
+        # forward it to its next_node, telling that node the rest of the
+        # chain. The uploader only ever sends each chunk once.
+        (chain, packet) = decode_chain(data)
+        chunk = FileChunk.decode(packet)
+        response = await self.store_chunk(chunk)
+        if response[0][0] == Command.ACKNOWLEDGE.value and chunk.next_node.port:
+            # Waiting on the next replica passes its back-pressure upstream.
+            unreachable = await self.forward(chunk.file_id, chunk.order, chunk.next_node, chain)
+            if unreachable is not None:
+                # Our copy stays. The uploader sends the chunk again with
+                # another peer in place of the one that did not get it.
+                log.warning("Could not replicate chunk %d to %s.", chunk.order, unreachable)
+                return [(Command.ERROR.value, unreachable.encode())]
         return response
 
-    async def process_upload(self, data: bytes) -> bytes:
-        chunk = FileChunk.decode(data)
-        print("Uploading to database...")
+    async def forward(self, file_id: UUID, order: int, target: Node, chain: list[Node]) -> Node | None:
+        # Returns the replica the chunk did not reach, target or one further
+        # down the chain, or None once all of them hold it.
+        entry = await self.load_chunk(file_id, order)
+        if entry is None:
+            return target
+        # The stored copy has the payload even if we were sent a reference.
+        chunk = replace(entry.chunk, next_node=chain[0] if chain else Node.null_node())
+        chunk = await self.readable(chunk, await self.peer_codecs(target))
+        if chain:
+            (command, payload) = (Command.TRANSFER.value, encode_chain(chain[1:]) + chunk.encode())
+        else:
+            (command, payload) = (Command.UPLOAD.value, chunk.encode())
+        try:
+            response = await self.flow.request(target, command, payload)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionRefusedError, OSError):
+            return target
+        if response and response[0][0] == Command.ACKNOWLEDGE.value:
+            return None
+        if response and response[0][0] == Command.ERROR.value and command == Command.TRANSFER.value:
+            return decode_unreachable(response[0][1]) or target
+        return target
 
-        async with aiosqlite.connect(self.DB_FILE) as db:
-            await db.execute('''
-                INSERT OR IGNORE INTO file_chunks (file_id, file_name, size, chunk_order, num_chunks, checksum, next_ip, next_port, data)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (str(chunk.file_id), chunk.file_name, chunk.size, chunk.order, chunk.num_chunks, chunk.file_checksum.hex(), chunk.next_node.ip_address.compressed, chunk.next_node.port, chunk.data))
-            await db.commit()
-        print("Added file chunk to database")
+    async def peer_codecs(self, node: Node) -> list[str]:
+        # The codecs a peer we send chunks to accepts, asked for over
+        # CONNECT the first time.
+        if node not in self.codecs:
+            accepted = []
+            try:
+                async for (command, payload) in self.pool.stream(node, Command.CONNECT.value, node.encode() + encode_codecs(available_codecs())):
+                    if command == Command.CONNECT.value:
+                        accepted = decode_codecs(payload)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionRefusedError, OSError):
+                return []
+            self.codecs[node] = accepted
+        return self.codecs[node]
 
-        return Command.ACKNOWLEDGE.value + chunk.file_id.bytes.hex().encode()
+    async def readable(self, chunk: FileChunk, codecs: list[str]) -> FileChunk:
+        # Chunks stay compressed unless the receiver cannot read their codec.
+        if chunk.is_compressed and codec_name(chunk.flags) not in codecs:
+            return await self.offload(chunk.size, decompress_chunk, chunk)
+        return chunk
 
-    async def process_download(self, data: bytes):
-        print("Downloading file chunk...")
+    async def store_chunk(self, chunk: FileChunk) -> list:
+        chunk_hash = chunk.chunk_hash.hex()
+        statements = []
+        if chunk.is_reference:
+            # The uploader expects us to hold this content already.
+            result = await self.database.fetchone('''
+                SELECT 1 FROM chunk_data WHERE chunk_hash = (?)
+            ''', (chunk_hash,))
+            if result is None:
+                return [(Command.ERROR.value, chunk.chunk_hash)]
+        else:
+            # Compressed chunks are checked against the content they expand
+            # to, but stored and later sent as they came.
+            try:
+                digest = await self.offload(chunk.size, content_digest, chunk)
+            except ValueError:
+                digest = None
+            if digest != chunk.chunk_hash:
+                return [(Command.ERROR.value, chunk.chunk_hash)]
+            location = await self.store_blob(chunk_hash, chunk.data, chunk.flags & COMPRESSION_FLAGS)
+            if location is not None:
+                statements.append(('''
+                    INSERT OR IGNORE INTO chunk_data (chunk_hash, pack, pack_offset, stored_size, compression) VALUES (?, ?, ?, ?, ?)
+                ''', (chunk_hash, *location)))
+        statements.append((f'''
+            INSERT OR IGNORE INTO file_chunks ({MANIFEST_COLUMNS})
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (str(chunk.file_id), chunk.file_name, chunk.size, chunk.order, chunk.num_chunks, chunk.file_checksum.hex(), chunk.next_node.ip_address.compressed, chunk.next_node.port, chunk.offset, chunk.file_size, chunk_hash, chunk.data_shards, chunk.parity_shards, chunk.merkle_root.hex())))
+        statements.append((f'''
+            INSERT OR IGNORE INTO files ({FILE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (str(chunk.file_id), chunk.file_name, chunk.file_size, chunk.num_chunks, chunk.file_checksum.hex(), chunk.data_shards, chunk.parity_shards, chunk.merkle_root.hex())))
+        # Acknowledged once the batch holding this chunk is committed.
+        try:
+            await self.database.write(statements)
+        finally:
+            self.storing.pop(chunk_hash, None)
+        log.debug("Stored chunk %d of %s.", chunk.order, chunk.file_id)
+        # Rows are never replaced, so other content sent for an order the
+        # file already has was ignored and must not be served from the cache.
+        row = await self.database.fetchone('''
+            SELECT chunk_hash FROM file_chunks WHERE file_id = (?) AND chunk_order = (?)
+        ''', (str(chunk.file_id), chunk.order))
+        if row is not None and row[0] == chunk_hash:
+            # What was just uploaded is likely to be asked for soon. The payload
+            # may differ from the stored copy in compression only, never in content.
+            self.chunk_cache.stored(chunk.file_id, None if chunk.is_reference else chunk)
+        else:
+            self.chunk_cache.invalidate(chunk.file_id, chunk.order)
+
+        return [(Command.ACKNOWLEDGE.value, chunk.file_id.bytes.hex().encode())]
+
+    async def store_blob(self, chunk_hash: str, data: bytes, compression: int):
+        # Appends the payload unless its content is already stored, returning
+        # the location, size and compression to record or None when there is
+        # nothing to record.
+        if chunk_hash in self.storing:
+            return self.storing[chunk_hash]
+        result = await self.database.fetchone('''
+            SELECT 1 FROM chunk_data WHERE chunk_hash = (?)
+        ''', (chunk_hash,))
+        if result is not None:
+            return None
+        if chunk_hash not in self.storing:
+            self.storing[chunk_hash] = (*self.blobs.append(data), len(data), compression)
+        return self.storing[chunk_hash]
+
+    @commands.handler(Command.DOWNLOAD, throttled=True)
+    async def process_download(self, data: bytes, client_node: Node):
+        # Chunks are yielded as rows come off the cursor, so the first one
+        # goes out before the rest of the file is read.
         file_id = unhexlify(data[:32])
         file_uuid = UUID(bytes=file_id)
-        async with aiosqlite.connect(self.DB_FILE) as db:
-            cursor = await db.execute('''
-                SELECT * FROM file_chunks WHERE file_id = (?)
-            ''', (str(file_uuid),))
-            results = await cursor.fetchall()
-
-        response = b""
-        for result in results:
-            (file_id, file_name, size, order, num_chunks, file_checksum, next_ip_address, next_port, data) = result
-            file_id = UUID(file_id)
-            next_node = Node(IPv4Address(next_ip_address), next_port)
-            file_checksum = unhexlify(file_checksum)
-            chunk = FileChunk(
-                file_id,
-                size,
-                order,
-                num_chunks,
-                file_checksum,
-                next_node,
-                file_name,
-                data
-            )
-            response += Command.DATA.value + chunk.encode() + b"\n"
-        response += Command.TERMINATE.value
-        return response
+        log.debug("Sending chunks of %s to %s.", file_uuid, client_node)
+        cached = self.chunk_cache.file(file_uuid)
+        if cached is not None:
+            for entry in cached:
+                yield (Command.DATA.value, entry)
+            yield (Command.TERMINATE.value, b"")
+            return
+        version = self.chunk_cache.version(file_uuid)
+        held = 0
+        async for row in self.database.iterate(f'''
+            SELECT {CHUNK_COLUMNS} FROM file_chunks JOIN chunk_data USING (chunk_hash) WHERE file_id = (?)
+        ''', (str(file_uuid),)):
+            held += 1
+            # Cached chunks still skip reading and encoding the payload.
+            entry = self.chunk_cache.get(file_uuid, row[3]) or self.chunk_cache.put(self.chunk_from_row(row))
+            yield (Command.DATA.value, entry)
+        # Once all of them are cached, the next download needs no query at all.
+        self.chunk_cache.learn(file_uuid, held, version)
+        yield (Command.TERMINATE.value, b"")
 
-    async def process_retry(self, data: bytes):
-        response = b""
-        file_id = UUID(bytes=unhexlify(data[:32]))
-        (order,) = struct.unpack('H', data[32:34])
-        result = self.find_chunk(file_id, order)
-        (file_id, file_name, size, order, num_chunks, file_checksum, next_ip_address, next_port, data) = result
-        file_id = UUID(file_id)
-        next_node = Node(IPv4Address(next_ip_address), next_port)
-        file_checksum = unhexlify(file_checksum)
-        chunk = FileChunk(
-            file_id,
+    @commands.handler(Command.RETRY, throttled=True)
+    async def process_retry(self, data: bytes, client_node: Node):
+        (file_id, order) = decode_retry(data)
+        entry = await self.load_chunk(file_id, order)
+        if entry is not None:
+            yield (Command.DATA.value, entry)
+        yield (Command.TERMINATE.value, b"")
+
+    async def load_chunk(self, file_id: UUID, order: int) -> EncodedChunk | None:
+        # Read through the chunk cache.
+        entry = self.chunk_cache.get(file_id, order)
+        if entry is not None:
+            return entry
+        result = await self.find_chunk(file_id, order)
+        if result is None:
+            return None
+        return self.chunk_cache.put(self.chunk_from_row(result))
+
+    def chunk_from_row(self, row) -> FileChunk:
+        (file_id, file_name, size, order, num_chunks, file_checksum, next_ip_address, next_port, pack, pack_offset, stored_size, compression, offset, file_size, chunk_hash, data_shards, parity_shards, merkle_root) = row
+        return FileChunk(
+            UUID(file_id),
             size,
             order,
             num_chunks,
-            file_checksum,
-            next_node,
+            unhexlify(file_checksum),
+            Node(IPv4Address(next_ip_address), next_port),
             file_name,
-            data
+            self.blobs.read(pack, pack_offset, stored_size),
+            offset,
+            file_size,
+            unhexlify(chunk_hash),
+            compression,
+            data_shards,
+            parity_shards,
+            unhexlify(merkle_root)
         )
-        response += Command.DATA.value + chunk.encode() + b"\n"
-        response += Command.TERMINATE.value
-        return response
 
+    @commands.handler(Command.HAVE)
+    async def process_have(self, data: bytes, client_node: Node) -> list:
+        # Reply with the number of chunks in the file, its erasure code, its
+        # Merkle root and a bitmap of the orders stored here (parity chunks
+        # included), without reading any chunk data.
+        file_id = UUID(bytes=unhexlify(data[:32]))
+        results = await self.database.fetchall('''
+            SELECT chunk_order, num_chunks, data_shards, parity_shards, merkle_root FROM file_chunks WHERE file_id = (?)
+        ''', (str(file_id),))
+
+        if not results:
+            return [(Command.TERMINATE.value, b"")]
+
+        (_, num_chunks, data_shards, parity_shards, merkle_root) = results[0]
+        bitmap = Bitmap(total_chunks(num_chunks, data_shards, parity_shards))
+        for (order, *_) in results:
+            bitmap.add(order)
+        return [
+            (Command.HAVE.value, AVAILABILITY.pack(num_chunks, data_shards, parity_shards, unhexlify(merkle_root)) + bitmap.to_bytes()),
+            (Command.TERMINATE.value, b"")
+        ]
+
+    @commands.handler(Command.HASHES)
+    async def process_hashes(self, data: bytes, client_node: Node) -> list:
+        # Reply with the content hash of every data chunk of the file stored
+        # here, by order, so downloaders can check them against the file's
+        # Merkle root and then check each chunk as it arrives.
+        file_id = UUID(bytes=unhexlify(data[:32]))
+        results = await self.database.fetchall('''
+            SELECT chunk_order, chunk_hash FROM file_chunks WHERE file_id = (?) AND chunk_order < num_chunks
+        ''', (str(file_id),))
+        payload = b"".join(CHUNK_HASH.pack(order, unhexlify(chunk_hash)) for (order, chunk_hash) in results)
+        return [(Command.HASHES.value, payload), (Command.TERMINATE.value, b"")]
+
+    @commands.handler(Command.LIST)
+    async def process_list(self, data: bytes, client_node: Node):
+        # One LIST frame per file whose name starts with the given prefix
+        # (every file for an empty prefix), then TERMINATE. Only the files
+        # table and the manifest index are read, never chunk data.
+        prefix = bytes(data).decode()
+        async for row in self.database.iterate(f'''
+            SELECT {FILE_COLUMNS},
+                (SELECT COUNT(*) FROM file_chunks WHERE file_chunks.file_id = files.file_id)
+            FROM files
+            WHERE file_name >= (?) AND file_name < (?)
+            ORDER BY file_name
+        ''', (prefix, prefix + "\U0010ffff")):
+            (file_id, file_name, file_size, num_chunks, checksum, data_shards, parity_shards, merkle_root, held) = row
+            entry = FileEntry(UUID(file_id), file_name, file_size, num_chunks, unhexlify(checksum), held, data_shards, parity_shards, unhexlify(merkle_root))
+            yield (Command.LIST.value, entry.encode())
+        yield (Command.TERMINATE.value, b"")
+
+    @commands.handler(Command.LOOKUP, throttled=True)
+    async def process_lookup(self, data: bytes, client_node: Node) -> list:
+        # Reply with a bitmap of which of the given content hashes are stored
+        # here, so uploaders can skip sending chunks we already have.
+        hashes = [data[index:index + 32].hex() for index in range(0, min(len(data), self.MAX_LOOKUP * 32), 32)]
+        bitmap = Bitmap(len(hashes))
+        placeholders = ", ".join("?" * len(hashes))
+        results = await self.database.fetchall(f'''
+            SELECT chunk_hash FROM chunk_data WHERE chunk_hash IN ({placeholders})
+        ''', hashes)
+        present = {row[0] for row in results}
+        for (index, chunk_hash) in enumerate(hashes):
+            if chunk_hash in present:
+                bitmap.add(index)
+        return [(Command.HAVE.value, bitmap.to_bytes()), (Command.TERMINATE.value, b"")]
+
+    @commands.handler(Command.DISCONNECT)
+    async def process_disconnect(self, data: bytes, client_node: Node) -> list:
+        # Peers only announce their own departure. The payload may name the
+        # sender, as it did before, but no other node: any client could
+        # otherwise evict any peer and set off a repair of the whole table.
+        if len(data) >= 6 and Node.decode(data) != client_node:
+            log.warning("%s claimed that %s left, ignoring it.", client_node, Node.decode(data))
+            return [(Command.ERROR.value, b"")]
+        departed = client_node
+        if departed not in self.peers:
+            return [(Command.ACKNOWLEDGE.value, b"")]
+        self.peers.discard(departed)
+        self.departures[departed] = time.monotonic()
+        log.info("Peer %s left.", departed)
+        # Acknowledge right away, the copies are restored in the background.
+        if not self.closing:
+            self.spawn(self.rereplicate(departed))
+        return [(Command.ACKNOWLEDGE.value, b"")]
+
+    async def rereplicate(self, departed: Node):
+        # Chunks are placed like the uploader placed them, see placement:
+        # plain chunks on the first REPLICATION_FACTOR nodes clockwise from
+        # their hash, erasure coded ones around their stripe's key. Of the
+        # chunks the departed peer held, each one is copied to the nodes now
+        # placed to hold it by the first surviving holder, so only one holder
+        # sends it. A coded chunk whose only copy left is not copied by
+        # anyone; downloads rebuild it from its stripe's parity.
+        survivors = set(self.peers) | self.local_nodes
+        survivors.discard(departed)
+        before = HashRing(survivors | {departed})
+        after = HashRing(survivors)
+        repairs = []
+        async for row in self.database.iterate('''
+            SELECT file_id, chunk_order, num_chunks, chunk_hash, data_shards, parity_shards FROM file_chunks
+        '''):
+            (file_id, order, num_chunks, chunk_hash, data_shards, parity_shards) = row
+            (key, position) = placement(UUID(file_id), order, num_chunks, unhexlify(chunk_hash), data_shards, parity_shards)
+            if data_shards:
+                (spread, count) = (data_shards + parity_shards, self.ERASURE_REPLICATION_FACTOR)
+            else:
+                (spread, count) = (self.replication_factor, self.replication_factor)
+            placed = holders(before, key, position, spread, count)
+            if departed not in placed:
+                continue
+            surviving = [node for node in placed if node != departed]
+            if not surviving or surviving[0] not in self.local_nodes:
+                continue
+            for target in holders(after, key, position, spread, count):
+                if target not in placed:
+                    repairs.append((UUID(file_id), order, target))
+
+        repaired = 0
+        for (file_id, order, target) in repairs:
+            if await self.forward(file_id, order, target, []) is None:
+                repaired += 1
+        log.info("Re-replicated %d/%d chunks after %s left.", repaired, len(repairs), departed)
+
+    async def leave(self):
+        # Only a server shutting down announces its departure. Its peers
+        # know it by the address it connects from, and restore the copies
+        # it held.
+        self.closing = True
+        await asyncio.gather(*(self.say_goodbye(peer) for peer in self.peers))
 
-    async def process_disconnect(self, client_node: Node):
-        # Disconnect should notify first,
-        # then round robin distribute hashes,
-        # then terminate.
-        # Iterate through known peers, removing node
-        pass
+    async def say_goodbye(self, peer: Node):
+        try:
+            await self.pool.request(peer, Command.DISCONNECT.value, timeout=self.PROBE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionRefusedError, OSError):
+            pass
+
+    @commands.handler(Command.PING)
+    async def process_ping(self, data: bytes, client_node: Node) -> list:
+        return [(Command.ACKNOWLEDGE.value, b"")]
 
     async def process_command(self, command: bytes, data: bytes, client_node: Node):
-        if command.hex() == Command.CONNECT.value.hex():
-            return await self.process_connection(client_node)
-        elif command.hex() == Command.UPLOAD.value.hex():
-            return await self.process_upload(data)
-        elif command.hex() == Command.DOWNLOAD.value.hex():
-            return await self.process_download(data)
-        elif command.hex() == Command.RETRY.value.hex():
-            return await self.process_retry(data)
-        return Command.ERROR.value
-
-    async def start_workers(self, num_workers):
-        workers = []
-        for i in range(num_workers):
-            worker_task = asyncio.create_task(self.worker(f"Worker-{i}"))
-            workers.append(worker_task)
-        self.workers = workers
-
-    async def worker(self, name):
-        while True:
-            (reader, writer, node) = await self.task_queue.get()
-            while not reader.at_eof():
-                command = await reader.read(4)
-                data = await reader.readline()
-                response = await self.process_command(command, data, node)
-                writer.write(response + b"\n")
+        # Yields the reply one frame at a time.
+        handler = commands.get(command)
+        if handler is None:
+            yield (Command.ERROR.value, b"")
+            return
+        async for reply in handler.run(self, data, client_node):
+            yield reply
+
+    async def offload(self, size: int, function, *args):
+        # Small jobs are cheaper to run inline than to hand to a thread.
+        if size < self.OFFLOAD_SIZE:
+            return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def admit(self, node: Node) -> bool:
+        if self.peer_connections.get(node, 0) >= self.max_connections_per_peer:
+            return False
+        if self.connection_slots.locked():
+            if self.waiting >= self.max_waiting:
+                return False
+            self.waiting += 1
+            try:
+                await self.connection_slots.acquire()
+            finally:
+                self.waiting -= 1
+        else:
+            await self.connection_slots.acquire()
+        self.peer_connections[node] = self.peer_connections.get(node, 0) + 1
+        CONNECTIONS.inc()
+        return True
+
+    def release(self, node: Node):
+        self.connection_slots.release()
+        CONNECTIONS.dec()
+        self.peer_connections[node] -= 1
+        if not self.peer_connections[node]:
+            del self.peer_connections[node]
+
+    async def reject(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # Answer the first request in whichever format it came in, so the
+        # client sees an ERROR rather than a connection reset.
+        try:
+            (_, request_id, _, legacy) = await asyncio.wait_for(read_frame(reader), self.REJECT_TIMEOUT)
+            writer.write(encode_frame(Command.ERROR.value, b"", request_id, legacy))
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+    async def serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, node: Node):
+        requests = set()
+        received = BYTES_RECEIVED.labels(str(node))
+        while not reader.at_eof():
+            try:
+                (command, request_id, data, legacy) = await read_frame(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            received.inc(FRAME_OVERHEAD + len(data))
+            if legacy:
+                await self.respond(writer, command, request_id, data, node, legacy)
+                continue
+            # Framed clients multiplex requests over one connection,
+            # so each request is answered as soon as it is ready.
+            task = asyncio.create_task(self.respond(writer, command, request_id, data, node, legacy))
+            requests.add(task)
+            task.add_done_callback(requests.discard)
+        if requests:
+            await asyncio.gather(*requests, return_exceptions=True)
+        writer.close()
+
+    async def respond(self, writer: asyncio.StreamWriter, command: bytes, request_id: int, data: bytes, node: Node, legacy: bool):
+        try:
+            await self.send_replies(writer, command, request_id, data, node, legacy)
+        except (ConnectionError, OSError):
+            # The client is gone; serve_connection notices on its next read.
+            pass
+        except Exception as e:
+            # Handlers answer their own failures, see Handler.run. This is
+            # for replies that could not be encoded, so the client still
+            # gets an answer with its request id.
+            log.warning("Could not answer %s from %s: %r", command, node, e)
+            try:
+                writer.writelines([encode_frame(Command.ERROR.value, b"", request_id, legacy),
+                                   encode_frame(Command.TERMINATE.value, b"", request_id, legacy)])
                 await writer.drain()
-            writer.close()
-            self.task_queue.task_done()
+            except (ConnectionError, OSError):
+                pass
+
+    async def send_replies(self, writer: asyncio.StreamWriter, command: bytes, request_id: int, data: bytes, node: Node, legacy: bool):
+        handler = commands.get(command)
+        if handler is None or not handler.throttled:
+            replies = self.process_command(command, data, node)
+        elif self.in_flight >= self.MAX_IN_FLIGHT and not legacy:
+            # Legacy clients would not understand BUSY, they wait their turn instead.
+            retry_after = RETRY_AFTER.pack(int(self.BUSY_RETRY_AFTER * 1000))
+            BUSY_REPLIES.inc()
+            writer.write(encode_frame(Command.BUSY.value, retry_after, request_id))
+            await writer.drain()
+            return
+        else:
+            replies = self.process_throttled(command, data, node)
+        sent = BYTES_SENT.labels(str(node))
+        async for (reply, payload) in replies:
+            if isinstance(payload, EncodedChunk):
+                # The encoded header only fits the chunk as stored.
+                chunk = await self.readable(payload.chunk, [] if legacy else self.codecs.get(node, []))
+                if legacy or chunk is not payload.chunk:
+                    payload = chunk
+            elif isinstance(payload, FileChunk):
+                payload = await self.readable(payload, [] if legacy else self.codecs.get(node, []))
+            if legacy and isinstance(payload, FileChunk):
+                payload = await self.offload(payload.size, payload.encode_legacy)
+            # Each frame goes out in a single call, so replies to concurrent
+            # requests interleave only between whole frames. Waiting on drain
+            # stops a slow reader from making us buffer the whole reply.
+            frames = self.encode_reply(reply, payload, request_id, legacy)
+            sent.inc(sum(len(frame) for frame in frames))
+            writer.writelines(frames)
+            await writer.drain()
+
+    async def process_throttled(self, command: bytes, data: bytes, node: Node):
+        self.in_flight += 1
+        IN_FLIGHT.inc()
+        try:
+            async for reply in self.process_command(command, data, node):
+                yield reply
+        finally:
+            self.in_flight -= 1
+            IN_FLIGHT.dec()
+
+    def encode_reply(self, command: bytes, payload, request_id: int, legacy: bool) -> list:
+        # Clients that spoke the legacy protocol get their reply in kind,
+        # so they keep working during a rolling upgrade.
+        if isinstance(payload, EncodedChunk):
+            return [frame_header(command, request_id, payload.size), payload.header, payload.chunk.data]
+        if isinstance(payload, FileChunk):
+            if legacy:
+                payload = payload.encode_legacy()
+            else:
+                # Chunk payloads are views into the blob store and are
+                # handed to the transport as they are.
+                (header, data) = payload.encode_parts()
+                return [frame_header(command, request_id, len(header) + len(data)), header, data]
+        return [encode_frame(command, payload, request_id, legacy)]
 
     async def handle_client_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-        request = None
+        # asyncio.start_server runs this in a new task for every connection.
         client_socket: socket.socket = writer.transport.get_extra_info('socket')
         node = self.process_peer(client_socket)
-        await self.task_queue.put((reader, writer, node))
+        if not await self.admit(node):
+            log.warning("Too many connections, rejecting %s.", node)
+            REJECTED_CONNECTIONS.inc()
+            await self.reject(reader, writer)
+            return
+        try:
+            await self.serve_connection(reader, writer, node)
+        finally:
+            self.release(node)
 
 
     async def run_server(self):
-        self.task_queue = asyncio.Queue()
-        await self.start_workers(3)
-        server = await asyncio.start_server(self.handle_client_connection, '0.0.0.0', 3000)
-        async with server:
-            print("Server online at 0.0.0.0:3000.")
-            await server.serve_forever()
+        await self.database.open()
+        self.connection_slots = asyncio.Semaphore(self.max_connections)
+        loop = asyncio.get_running_loop()
+        # Answer discovery beacons on the same port number, over UDP.
+        (beacon_transport, _) = await loop.create_datagram_endpoint(
+            lambda: BeaconResponder(self.PORT),
+            local_addr=(self.host, self.PORT),
+            allow_broadcast=True
+        )
+        server = await asyncio.start_server(self.handle_client_connection, self.host, self.PORT, backlog=self.backlog)
+        self.spawn(self.gossip())
+        metrics = MetricsServer(self.metrics_address) if self.metrics_address else None
+        try:
+            if metrics is not None:
+                try:
+                    await metrics.start()
+                    log.info("Metrics served at %s.", self.metrics_address)
+                except OSError as e:
+                    # Serving chunks matters more than reporting on it.
+                    log.warning("Metrics unavailable at %s: %s", self.metrics_address, e)
+            async with server:
+                log.info("Server online at %s:%d.", self.host, self.PORT)
+                await server.serve_forever()
+        finally:
+            beacon_transport.close()
+            if metrics is not None:
+                await metrics.close()
+            await self.leave()
+            for task in self.background:
+                task.cancel()
+            await self.pool.close()
+            await self.database.close()
+            self.print_stats()
+
+    def print_stats(self):
+        cache = self.chunk_cache
+        if cache.hits or cache.misses:
+            log.info("Chunk cache: %d hits, %d misses, %d bytes held", cache.hits, cache.misses, cache.size)
+        for (command, stats) in commands.stats().items():
+            if stats.calls:
+                log.info("%s: %d calls, %d errors, %.2f ms mean, %.2f ms max", command.name, stats.calls, stats.errors,
+                         stats.mean_time * 1000, stats.max_time * 1000)
 
     def close(self):
         self.db_connection.close()
+        self.blobs.close()
+        self.executor.shutdown()
 
     async def find_chunk(self, file_id: UUID, order: int):
-        async with aiosqlite.connect(self.DB_FILE) as db:
-            cursor = await db.execute('''
-                SELECT * FROM file_chunks WHERE file_id = (?) AND chunk_order = (?)
-            ''', (str(file_id), order,))
-            result = await cursor.fetchone()
-        return result
+        return await self.database.fetchone(f'''
+            SELECT {CHUNK_COLUMNS} FROM file_chunks JOIN chunk_data USING (chunk_hash) WHERE file_id = (?) AND chunk_order = (?)
+        ''', (str(file_id), order,))
 
 def main():
+    configure_logging()
     server = Server()
     try:
         asyncio.run(server.run_server())
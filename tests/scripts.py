@@ -0,0 +1,13 @@
+import importlib.util
+import os
+
+def load_script(name: str):
+    # The server and client are scripts with dashes in their names.
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'p2p', name)
+    spec = importlib.util.spec_from_file_location(name.removesuffix('.py').replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+server_script = load_script('p2p-server.py')
+client_script = load_script('p2p-client.py')
@@ -0,0 +1,22 @@
+from p2p.lib.bitmap import Bitmap
+
+def test_round_trip():
+    bitmap = Bitmap(20)
+    for order in (0, 7, 8, 19):
+        bitmap.add(order)
+    decoded = Bitmap(20, bitmap.to_bytes())
+    assert list(decoded) == [0, 7, 8, 19]
+    assert len(decoded) == 4
+    assert list(decoded.missing())[:3] == [1, 2, 3]
+
+def test_padding_bits_are_ignored():
+    # A peer that sets every bit of the last byte only holds orders 8 and 9.
+    bitmap = Bitmap(10, b"\x00\xff")
+    assert list(bitmap) == [8, 9]
+    assert len(bitmap) == 2
+    assert 10 not in bitmap
+
+def test_extra_bytes_are_ignored():
+    bitmap = Bitmap(8, b"\x01\xff\xff")
+    assert list(bitmap) == [0]
+    assert bitmap.to_bytes() == b"\x01"
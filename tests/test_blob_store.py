@@ -0,0 +1,52 @@
+from p2p.lib.blob_store import BlobStore
+
+def test_append_and_read(tmp_path):
+    store = BlobStore(str(tmp_path / "chunks"))
+    try:
+        locations = [store.append(data) for data in (b"first", b"", b"second")]
+        assert locations == [(0, 0), (0, 5), (0, 5)]
+        assert bytes(store.read(0, 0, 5)) == b"first"
+        assert bytes(store.read(0, 5, 0)) == b""
+        assert bytes(store.read(0, 5, 6)) == b"second"
+    finally:
+        store.close()
+
+def test_read_after_growth_remaps(tmp_path):
+    store = BlobStore(str(tmp_path / "chunks"))
+    try:
+        store.append(b"a" * 100)
+        old_view = store.read(0, 0, 100)
+        (pack, offset) = store.append(b"b" * 5000)
+        # The pack grew past the old map, which stays valid for its views.
+        assert bytes(store.read(pack, offset, 5000)) == b"b" * 5000
+        assert bytes(old_view) == b"a" * 100
+        del old_view
+    finally:
+        store.close()
+
+def test_new_pack_when_full(tmp_path):
+    store = BlobStore(str(tmp_path / "chunks"))
+    store.PACK_SIZE = 10
+    try:
+        assert store.append(b"12345678") == (0, 0)
+        assert store.append(b"abcdef") == (1, 0)
+        # A payload larger than a pack still fits in a pack of its own.
+        assert store.append(b"x" * 20) == (2, 0)
+        assert bytes(store.read(1, 0, 6)) == b"abcdef"
+    finally:
+        store.close()
+
+def test_reopen_appends_to_last_pack(tmp_path):
+    store = BlobStore(str(tmp_path / "chunks"))
+    store.PACK_SIZE = 10
+    store.append(b"12345678")
+    store.append(b"abc")
+    store.close()
+
+    store = BlobStore(str(tmp_path / "chunks"))
+    try:
+        assert store.append(b"def") == (1, 3)
+        assert bytes(store.read(0, 0, 8)) == b"12345678"
+        assert bytes(store.read(1, 0, 6)) == b"abcdef"
+    finally:
+        store.close()
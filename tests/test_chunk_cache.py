@@ -0,0 +1,73 @@
+import hashlib
+from uuid import uuid4
+
+from p2p.lib.chunk_cache import ChunkCache
+from p2p.lib.file_chunk import FileChunk
+from p2p.lib.node import Node
+
+def make_chunk(file_id, order: int, data: bytes, num_chunks: int = 4) -> FileChunk:
+    return FileChunk(file_id, len(data), order, num_chunks, hashlib.sha256(b"file").digest(), Node.null_node(), "file.bin", data)
+
+def entry_cost(data: bytes) -> int:
+    chunk = make_chunk(uuid4(), 0, data)
+    return len(chunk.encode_parts()[0]) + len(data) + ChunkCache.ENTRY_OVERHEAD
+
+def test_get_and_put():
+    file_id = uuid4()
+    cache = ChunkCache(1 << 20)
+    assert cache.get(file_id, 0) is None
+    entry = cache.put(make_chunk(file_id, 0, b"a" * 100))
+    assert cache.get(file_id, 0) is entry
+    assert bytes(entry.chunk.data) == b"a" * 100
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_least_recently_used_is_evicted():
+    file_id = uuid4()
+    cache = ChunkCache(entry_cost(b"x" * 100) * 2)
+    cache.put(make_chunk(file_id, 0, b"a" * 100))
+    cache.put(make_chunk(file_id, 1, b"b" * 100))
+    cache.get(file_id, 0)
+    cache.put(make_chunk(file_id, 2, b"c" * 100))
+    assert cache.get(file_id, 1) is None
+    assert cache.get(file_id, 0) is not None
+    assert cache.get(file_id, 2) is not None
+    assert cache.size <= cache.max_bytes
+
+def test_oversized_chunks_are_not_cached():
+    file_id = uuid4()
+    cache = ChunkCache(0)
+    entry = cache.put(make_chunk(file_id, 0, b"a" * 100))
+    assert entry.chunk.data == b"a" * 100
+    assert cache.get(file_id, 0) is None
+    assert cache.size == 0
+
+def test_invalidate():
+    file_id = uuid4()
+    cache = ChunkCache(1 << 20)
+    cache.put(make_chunk(file_id, 0, b"a" * 100))
+    cache.invalidate(file_id, 0)
+    cache.invalidate(file_id, 1)
+    assert cache.get(file_id, 0) is None
+    assert cache.size == 0
+
+def test_whole_file_needs_every_chunk():
+    file_id = uuid4()
+    cache = ChunkCache(1 << 20)
+    version = cache.version(file_id)
+    for order in range(2):
+        cache.put(make_chunk(file_id, order, bytes((order,)) * 10, num_chunks=2))
+    assert cache.file(file_id) is None
+    cache.learn(file_id, 2, version)
+    assert [entry.chunk.order for entry in cache.file(file_id)] == [0, 1]
+    cache.invalidate(file_id, 1)
+    assert cache.file(file_id) is None
+
+def test_stored_forgets_the_chunk_count():
+    file_id = uuid4()
+    cache = ChunkCache(1 << 20)
+    version = cache.version(file_id)
+    cache.put(make_chunk(file_id, 0, b"a", num_chunks=2))
+    # A chunk stored while the file was being read makes that count stale.
+    cache.stored(file_id, make_chunk(file_id, 1, b"b", num_chunks=2))
+    cache.learn(file_id, 1, version)
+    assert cache.file(file_id) is None
@@ -0,0 +1,52 @@
+import hashlib
+import io
+import random
+
+import pytest
+
+from p2p.lib.chunking import ContentDefinedChunker, FixedChunker, scan_file
+from p2p.lib.merkle import merkle_root
+
+def random_bytes(size: int, seed: int = 0) -> bytes:
+    return random.Random(seed).randbytes(size)
+
+def cuts(chunker, data: bytes) -> list[tuple[int, int]]:
+    return [(offset, len(chunk)) for (offset, chunk) in chunker.chunks(io.BytesIO(data))]
+
+def test_fixed_chunks():
+    data = random_bytes(1300)
+    assert cuts(FixedChunker(512), data) == [(0, 512), (512, 512), (1024, 276)]
+
+def test_cdc_sizes():
+    chunker = ContentDefinedChunker(256, 1024, 4096)
+    data = random_bytes(200_000)
+    chunks = list(chunker.chunks(io.BytesIO(data)))
+    assert b"".join(chunk for (_, chunk) in chunks) == data
+    # Only the last chunk may be shorter than the minimum.
+    for (_, chunk) in chunks[:-1]:
+        assert 256 < len(chunk) <= 4096
+
+def test_cdc_vectorized_matches_python():
+    pytest.importorskip("numpy")
+    # Small reads put chunk boundaries across buffer refills.
+    data = random_bytes(300_000, seed=1) + bytes(20_000) + random_bytes(50_000, seed=2)
+    vectorized = ContentDefinedChunker(256, 1024, 4096)
+    vectorized.read_size = 5000
+    python = ContentDefinedChunker(256, 1024, 4096)
+    python.vectorized = False
+    assert cuts(vectorized, data) == cuts(python, data)
+
+def test_cdc_edit_keeps_other_chunks():
+    chunker = ContentDefinedChunker(256, 1024, 4096)
+    data = random_bytes(100_000, seed=3)
+    edited = data[:50_000] + b"edit" + data[50_000:]
+    before = {chunk for (_, chunk) in chunker.chunks(io.BytesIO(data))}
+    after = {chunk for (_, chunk) in chunker.chunks(io.BytesIO(edited))}
+    assert len(before & after) >= len(before) - 3
+
+def test_scan_file(tmp_path):
+    data = random_bytes(2000)
+    path = tmp_path / "data.bin"
+    path.write_bytes(data)
+    leaves = [hashlib.sha256(data[offset:offset + 512]).digest() for offset in range(0, 2000, 512)]
+    assert scan_file(str(path), FixedChunker(512)) == (hashlib.sha256(data).digest(), 2000, 4, merkle_root(leaves))
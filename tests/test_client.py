@@ -0,0 +1,51 @@
+import asyncio
+import hashlib
+from ipaddress import IPv4Address
+from uuid import uuid4
+
+import pytest
+
+from p2p.lib.commands import Command
+from p2p.lib.file_chunk import FLAG_ZLIB, FileChunk
+from p2p.lib.node import Node
+from tests.scripts import client_script
+
+PEER = Node(IPv4Address("10.0.0.1"), 3000)
+
+class CannedFlow:
+    # Answers every request with the same frames.
+    def __init__(self, replies: list[tuple[bytes, bytes]]):
+        self.replies = replies
+
+    async def request(self, node: Node, command: bytes, payload: bytes = b"", timeout: float = 30) -> list[tuple[bytes, bytes]]:
+        return self.replies
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    client = client_script.Client(host="127.0.0.1", journal_file="client.db")
+    yield client
+    client.journal.close()
+    client.hash_index.close()
+    client.executor.shutdown()
+
+def fetch(client, replies: list[tuple[bytes, bytes]], order: int = 0) -> FileChunk | None:
+    client.flow = CannedFlow(replies + [(Command.TERMINATE.value, b"")])
+    return asyncio.run(client.fetch_chunk(PEER, uuid4(), order))
+
+def test_fetch_chunk(client):
+    data = b"chunk data"
+    chunk = FileChunk(uuid4(), len(data), 0, 1, hashlib.sha256(data).digest(), Node.null_node(), "file.txt", data)
+    assert fetch(client, [(Command.DATA.value, chunk.encode())]).data == data
+    assert client.scores.score(PEER) == 1.0
+
+def test_malformed_chunk_fails_the_fetch(client):
+    assert fetch(client, [(Command.DATA.value, b"not a chunk")]) is None
+    assert client.scores.score(PEER) < 1.0
+
+def test_corrupt_compressed_chunk_fails_the_fetch(client):
+    data = b"not zlib"
+    chunk = FileChunk(uuid4(), 100, 0, 1, hashlib.sha256(data).digest(), Node.null_node(), "file.txt", data,
+                      chunk_hash=bytes(32), flags=FLAG_ZLIB)
+    assert fetch(client, [(Command.DATA.value, chunk.encode())]) is None
+    assert client.scores.score(PEER) < 1.0
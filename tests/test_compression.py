@@ -0,0 +1,57 @@
+import hashlib
+import os
+from uuid import uuid4
+import zlib
+
+import pytest
+
+from p2p.lib.compression import (available_codecs, codec_name, compress, compress_chunk, content_digest, decode_codecs, decompress,
+                                 decompress_chunk, encode_codecs)
+from p2p.lib.file_chunk import FLAG_ZLIB, FileChunk
+from p2p.lib.node import Node
+
+TEXT = b"fun text for the compression tests, lorem ipsum dolor sit amet\n" * 200
+
+def make_chunk(data: bytes) -> FileChunk:
+    return FileChunk(uuid4(), len(data), 0, 1, hashlib.sha256(data).digest(), Node.null_node(), "file.txt", data)
+
+def test_negotiation():
+    assert "zlib" in available_codecs()
+    assert decode_codecs(encode_codecs(available_codecs())) == available_codecs()
+    # Codecs this peer does not know are never picked.
+    assert decode_codecs(encode_codecs(["brotli", "zlib", "lz4"])) == ["zlib"]
+    assert decode_codecs(b"") == []
+    assert decode_codecs(b"\xff\xfe") == []
+
+def test_chunk_round_trip():
+    chunk = make_chunk(TEXT)
+    compressed = compress_chunk(chunk, "zlib")
+    assert compressed.is_compressed
+    assert codec_name(compressed.flags) == "zlib"
+    assert len(compressed.data) < len(TEXT)
+    # The hash and size still name the uncompressed content.
+    assert (compressed.chunk_hash, compressed.size) == (chunk.chunk_hash, chunk.size)
+    assert content_digest(compressed) == chunk.chunk_hash
+    restored = decompress_chunk(compressed)
+    assert restored.data == TEXT
+    assert not restored.is_compressed
+    # Compressing twice does nothing.
+    assert compress_chunk(compressed, "zlib") is compressed
+
+def test_incompressible_data_stays_raw():
+    data = os.urandom(8192)
+    assert compress(data, "zlib") is None
+    chunk = make_chunk(data)
+    assert compress_chunk(chunk, "zlib") is chunk
+    assert decompress_chunk(chunk) is chunk
+
+def test_corrupt_payloads():
+    with pytest.raises(ValueError):
+        decompress(b"not zlib at all", FLAG_ZLIB, 100)
+    # A payload that expands past the size in its header.
+    with pytest.raises(ValueError):
+        decompress(zlib.compress(TEXT), FLAG_ZLIB, 100)
+    # Or that falls short of it.
+    with pytest.raises(ValueError):
+        decompress(zlib.compress(TEXT), FLAG_ZLIB, len(TEXT) + 1)
+    assert decompress(zlib.compress(TEXT), FLAG_ZLIB, len(TEXT)) == TEXT
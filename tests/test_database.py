@@ -0,0 +1,77 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from p2p.lib.database import ChunkDatabase
+
+INSERT = "INSERT INTO chunks (chunk_order, data) VALUES (?, ?)"
+
+async def open_database(file_name: str) -> ChunkDatabase:
+    database = ChunkDatabase(file_name)
+    await database.open()
+    await database.db.execute("CREATE TABLE IF NOT EXISTS chunks (chunk_order INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+    await database.db.commit()
+    return database
+
+def count_commits(database: ChunkDatabase) -> list[int]:
+    commits = [0]
+    commit = database.db.commit
+    async def counted():
+        commits[0] += 1
+        await commit()
+    database.db.commit = counted
+    return commits
+
+def test_concurrent_writes_share_a_transaction(tmp_path):
+    async def scenario():
+        database = await open_database(str(tmp_path / "chunks.db"))
+        commits = count_commits(database)
+        try:
+            await asyncio.gather(*(database.write([(INSERT, (order, "x"))]) for order in range(100)))
+            rows = await database.fetchall("SELECT chunk_order FROM chunks ORDER BY chunk_order")
+        finally:
+            await database.close()
+        assert [order for (order,) in rows] == list(range(100))
+        assert commits[0] < 10
+    asyncio.run(scenario())
+
+def test_failed_batch_is_rolled_back(tmp_path):
+    async def scenario():
+        database = await open_database(str(tmp_path / "chunks.db"))
+        try:
+            await database.write([(INSERT, (0, "x"))])
+            # The duplicate fails the whole batch it lands in, and every
+            # writer in it hears about it; nothing of the batch is kept.
+            results = await asyncio.gather(database.write([(INSERT, (1, "x"))]), database.write([(INSERT, (0, "y"))]),
+                                           return_exceptions=True)
+            assert all(isinstance(result, sqlite3.IntegrityError) for result in results)
+            assert await database.fetchall("SELECT chunk_order, data FROM chunks") == [(0, "x")]
+            # Later writes go through as before.
+            await database.write([(INSERT, (2, "z"))])
+            assert await database.fetchone("SELECT data FROM chunks WHERE chunk_order = 2") == ("z",)
+        finally:
+            await database.close()
+    asyncio.run(scenario())
+
+def test_statements_of_a_write_apply_together(tmp_path):
+    async def scenario():
+        database = await open_database(str(tmp_path / "chunks.db"))
+        try:
+            with pytest.raises(sqlite3.IntegrityError):
+                await database.write([(INSERT, (5, "a")), (INSERT, (5, "b"))])
+            assert await database.fetchall("SELECT * FROM chunks") == []
+        finally:
+            await database.close()
+    asyncio.run(scenario())
+
+def test_close_waits_for_queued_writes(tmp_path):
+    async def scenario():
+        database = await open_database(str(tmp_path / "chunks.db"))
+        writes = [asyncio.create_task(database.write([(INSERT, (order, "x"))])) for order in range(10)]
+        await asyncio.sleep(0)
+        await database.close()
+        await asyncio.gather(*writes)
+    asyncio.run(scenario())
+    with sqlite3.connect(tmp_path / "chunks.db") as connection:
+        assert connection.execute("SELECT COUNT(*) FROM chunks").fetchone() == (10,)
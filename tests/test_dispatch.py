@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from p2p.lib.commands import Command
+from p2p.lib.dispatch import CommandRegistry
+
+class Owner:
+    def __init__(self):
+        self.calls = []
+
+registry = CommandRegistry()
+
+@registry.handler(Command.PING)
+async def returns_reply(owner, data: bytes, client_node) -> list:
+    owner.calls.append(data)
+    return [(Command.ACKNOWLEDGE.value, data)]
+
+@registry.handler(Command.LIST, throttled=True)
+async def streams_reply(owner, data: bytes, client_node):
+    for index in range(3):
+        yield (Command.LIST.value, bytes([index]))
+    yield (Command.TERMINATE.value, b"")
+
+@registry.handler(Command.UPLOAD)
+async def fails(owner, data: bytes, client_node) -> list:
+    raise ValueError("malformed chunk")
+
+async def collect(handler, data: bytes = b"") -> list:
+    return [reply async for reply in handler.run(Owner(), data, None)]
+
+def test_lookup():
+    assert registry.get(Command.PING.value).function is returns_reply
+    assert registry.get(Command.LIST.value).throttled
+    assert not registry.get(Command.PING.value).throttled
+    assert registry.get(Command.HAVE.value) is None
+
+def test_duplicate_handler():
+    with pytest.raises(ValueError):
+        registry.handler(Command.PING)(returns_reply)
+
+def test_replies():
+    assert asyncio.run(collect(registry.get(Command.PING.value), b"x")) == [(Command.ACKNOWLEDGE.value, b"x")]
+    assert asyncio.run(collect(registry.get(Command.LIST.value))) == [
+        (Command.LIST.value, b"\x00"), (Command.LIST.value, b"\x01"), (Command.LIST.value, b"\x02"), (Command.TERMINATE.value, b"")
+    ]
+
+def test_failed_handler_answers_error():
+    handler = registry.get(Command.UPLOAD.value)
+    assert asyncio.run(collect(handler)) == [(Command.ERROR.value, b""), (Command.TERMINATE.value, b"")]
+    stats = registry.stats()[Command.UPLOAD]
+    assert (stats.calls, stats.errors) == (1, 1)
@@ -0,0 +1,54 @@
+from itertools import combinations
+import random
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from p2p.lib.erasure import ReedSolomon, gf_inv, gf_mul, parity_order, stripe_count, total_chunks
+
+def test_field_inverse():
+    for value in range(1, 256):
+        assert gf_mul(value, gf_inv(value)) == 1
+
+def test_layout():
+    # 5 data chunks in stripes of 2 with 1 parity chunk each.
+    assert stripe_count(5, 2) == 3
+    assert total_chunks(5, 2, 1) == 8
+    assert [parity_order(5, 1, stripe, 0) for stripe in range(3)] == [5, 6, 7]
+    assert total_chunks(5, 0, 0) == 5
+
+@pytest.mark.parametrize("data_shards, parity_shards", [(1, 1), (2, 1), (3, 2), (4, 3)])
+def test_recovers_from_every_tolerated_erasure(data_shards, parity_shards):
+    width = 64
+    rng = random.Random(data_shards * 10 + parity_shards)
+    data = [rng.randbytes(width) for _ in range(data_shards)]
+    codec = ReedSolomon(data_shards, parity_shards)
+    blocks = data + codec.encode(data, width)
+    for lost in range(parity_shards + 1):
+        for erased in combinations(range(data_shards + parity_shards), lost):
+            available = {index: block for (index, block) in enumerate(blocks) if index not in erased}
+            assert codec.decode(available, width) == data, erased
+
+def test_too_many_erasures():
+    codec = ReedSolomon(3, 1)
+    blocks = codec.encode([b"a" * 8, b"b" * 8, b"c" * 8], 8)
+    with pytest.raises(ValueError):
+        codec.decode({0: b"a" * 8, 3: blocks[0]}, 8)
+
+def test_short_last_stripe():
+    # The last stripe of a file may have fewer data chunks, and its last
+    # chunk may be short; both count as zero padding.
+    codec = ReedSolomon(3, 2)
+    data = [b"first block!", b"end"]
+    parity = codec.encode(data, 12)
+    available = {1: data[1], 2: b"", 3: parity[0], 4: parity[1]}
+    decoded = codec.decode(available, 12)
+    assert decoded[0] == data[0]
+    assert decoded[1][:3] == data[1]
+
+def test_unsupported_codes():
+    with pytest.raises(ValueError):
+        ReedSolomon(0, 1)
+    with pytest.raises(ValueError):
+        ReedSolomon(200, 100)
@@ -0,0 +1,43 @@
+import hashlib
+from ipaddress import IPv4Address
+from uuid import uuid4
+
+import pytest
+
+from p2p.lib.file_chunk import FileChunk
+from p2p.lib.node import Node
+
+def test_legacy_encoding_refuses_large_chunks():
+    data = b"1" * 65536
+    chunk = FileChunk(uuid4(), len(data), 0, 1, hashlib.sha256(data).digest(), Node(IPv4Address("127.0.0.1"), 3000), "big.dat", data)
+    with pytest.raises(ValueError):
+        chunk.encode_legacy()
+
+def test_round_trip():
+    next_node = Node(IPv4Address("127.0.0.1"), 12345)
+    data = b"0" * 512
+    checksum = hashlib.sha256(data).digest()
+    chunk = FileChunk(uuid4(), 512, 1, 1, checksum, next_node, "test.dat", data)
+    test_chunk = FileChunk.decode(chunk.encode())
+
+    assert test_chunk.next_node.ip_address == chunk.next_node.ip_address
+    assert str(test_chunk.next_node.ip_address) == "127.0.0.1"
+    assert test_chunk.next_node.port == chunk.next_node.port
+    assert test_chunk.file_id == chunk.file_id
+    assert test_chunk.num_chunks == chunk.num_chunks == 1
+    assert test_chunk.file_name == chunk.file_name
+    assert test_chunk.file_checksum == chunk.file_checksum
+    assert test_chunk.size == chunk.size
+    assert test_chunk.order == chunk.order
+    assert test_chunk.data == chunk.data
+
+    # Payloads may contain the old \x1f delimiter now that they are sent raw.
+    binary_chunk = FileChunk(uuid4(), 4, 0, 1, checksum, next_node, "test.bin", b"\x1f\n\x00\xfc")
+    assert FileChunk.decode(binary_chunk.encode()).data == binary_chunk.data
+
+def test_legacy_round_trip():
+    data = b"0" * 512
+    chunk = FileChunk(uuid4(), 512, 1, 1, hashlib.sha256(data).digest(), Node(IPv4Address("127.0.0.1"), 12345), "test.dat", data)
+    legacy_chunk = FileChunk.decode(chunk.encode_legacy())
+    assert legacy_chunk.file_id == chunk.file_id
+    assert legacy_chunk.data == chunk.data
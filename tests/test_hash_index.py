@@ -0,0 +1,73 @@
+import hashlib
+import os
+
+from p2p.lib.chunking import FixedChunker, scan_file
+from p2p.lib.hash_index import WHOLE_FILE, HashIndex, hash_whole_file
+
+class CountingScan:
+    def __init__(self, compute):
+        self.compute = compute
+        self.calls = 0
+
+    def __call__(self, path: str):
+        self.calls += 1
+        return self.compute(path)
+
+def write(path, data: bytes):
+    with open(path, 'wb') as data_file:
+        data_file.write(data)
+
+def test_unchanged_file_is_not_hashed_again(tmp_path):
+    path = tmp_path / "file.bin"
+    write(path, b"a" * 1000)
+    index = HashIndex(str(tmp_path / "hash_index.db"))
+    scan = CountingScan(hash_whole_file)
+    try:
+        first = index.cached(str(path), WHOLE_FILE, scan)
+        assert first == (hashlib.sha256(b"a" * 1000).digest(), 1000, 0, b"")
+        assert index.cached(str(path), WHOLE_FILE, scan) == first
+        assert scan.calls == 1
+    finally:
+        index.close()
+    # The index outlives the process.
+    index = HashIndex(str(tmp_path / "hash_index.db"))
+    try:
+        assert index.cached(str(path), WHOLE_FILE, scan) == first
+        assert scan.calls == 1
+    finally:
+        index.close()
+
+def test_changed_file_is_hashed_again(tmp_path):
+    path = tmp_path / "file.bin"
+    write(path, b"a" * 1000)
+    index = HashIndex(str(tmp_path / "hash_index.db"))
+    scan = CountingScan(hash_whole_file)
+    try:
+        index.cached(str(path), WHOLE_FILE, scan)
+        # Same size, new content and mtime.
+        write(path, b"b" * 1000)
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        assert index.cached(str(path), WHOLE_FILE, scan)[0] == hashlib.sha256(b"b" * 1000).digest()
+        # A file replaced by another one under the same name.
+        replacement = tmp_path / "replacement.bin"
+        write(replacement, b"c" * 1000)
+        os.utime(replacement, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns))
+        os.replace(replacement, path)
+        assert index.cached(str(path), WHOLE_FILE, scan)[0] == hashlib.sha256(b"c" * 1000).digest()
+        assert scan.calls == 3
+    finally:
+        index.close()
+
+def test_entries_are_kept_per_chunker(tmp_path):
+    path = tmp_path / "file.bin"
+    write(path, os.urandom(5000))
+    index = HashIndex(str(tmp_path / "hash_index.db"))
+    try:
+        (small, large) = (FixedChunker(512), FixedChunker(4096))
+        assert index.cached(str(path), small.key, lambda name: scan_file(name, small))[2] == 10
+        assert index.cached(str(path), large.key, lambda name: scan_file(name, large))[2] == 2
+        assert index.lookup(str(path), small.key)[2] == 10
+        assert index.lookup(str(path), "cdc:1:2:3") is None
+    finally:
+        index.close()
@@ -0,0 +1,86 @@
+import hashlib
+from uuid import uuid4
+
+from p2p.lib.assembler import FileAssembler
+from p2p.lib.bitmap import Bitmap
+from p2p.lib.file_chunk import FileChunk
+from p2p.lib.journal import DOWNLOAD, UPLOAD, JournalEntry, TransferJournal
+from p2p.lib.merkle import ChunkVerifier
+from p2p.lib.node import Node
+
+BLOCKS = [b"aaaa", b"bbbb", b"cccc", b"dd"]
+DATA = b"".join(BLOCKS)
+
+def chunk(file_id, order: int) -> FileChunk:
+    return FileChunk(file_id, len(BLOCKS[order]), order, len(BLOCKS), hashlib.sha256(DATA).digest(), Node.null_node(), "file.txt",
+                     BLOCKS[order], offset=4 * order, file_size=len(DATA))
+
+def download_entry(file_id) -> JournalEntry:
+    return JournalEntry(DOWNLOAD, str(file_id), file_id, "file.txt", hashlib.sha256(DATA).digest(), len(BLOCKS), len(DATA), Bitmap(len(BLOCKS)))
+
+def test_save_and_load(tmp_path):
+    journal = TransferJournal(str(tmp_path / "journal.db"))
+    file_id = uuid4()
+    entry = download_entry(file_id)
+    entry.add(0, 0, 4)
+    entry.add(2, 8, 4)
+    journal.save(entry)
+    entry.discard(2)
+    entry.add(3, 12, 2)
+    journal.save(entry)
+    journal.close()
+
+    journal = TransferJournal(str(tmp_path / "journal.db"))
+    loaded = journal.load(DOWNLOAD, str(file_id))
+    assert loaded.file_id == file_id
+    assert loaded.checksum == entry.checksum
+    assert list(loaded.completed) == [0, 3]
+    assert loaded.extents == {0: (0, 4), 3: (12, 2)}
+    assert journal.load(UPLOAD, str(file_id)) is None
+    journal.remove(loaded)
+    assert journal.load(DOWNLOAD, str(file_id)) is None
+    journal.close()
+
+def test_resume_after_truncation(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    journal = TransferJournal("journal.db")
+    file_id = uuid4()
+    entry = download_entry(file_id)
+    assembler = FileAssembler("file.txt", entry.checksum, len(BLOCKS), len(DATA), entry)
+    for order in (0, 1, 2):
+        assembler.write(chunk(file_id, order))
+    assembler.flush()
+    journal.save(entry)
+    # The client dies, and the end of the .part file is lost with it.
+    assembler.file.close()
+    journal.close()
+    with open("file.txt.part", "r+b") as part:
+        part.truncate(6)
+
+    journal = TransferJournal("journal.db")
+    entry = journal.load(DOWNLOAD, str(file_id))
+    assembler = FileAssembler("file.txt", entry.checksum, len(BLOCKS), len(DATA), entry)
+    assert 0 in assembler and 2 in assembler
+    verifier = ChunkVerifier(leaves=[hashlib.sha256(block).digest() for block in BLOCKS])
+    assert assembler.recheck(verifier.matches) == [1, 2]
+    assert list(entry.completed) == [0]
+    for order in (1, 2, 3):
+        assert assembler.write(chunk(file_id, order))
+    assert assembler.finish()
+    with open("file.txt", "rb") as result:
+        assert result.read() == DATA
+    journal.close()
+
+def test_missing_part_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    file_id = uuid4()
+    entry = download_entry(file_id)
+    entry.add(0, 0, 4)
+    entry.extents = dict(entry.added)
+    # Nothing on disk backs the journal, so the download starts over.
+    assembler = FileAssembler("file.txt", entry.checksum, len(BLOCKS), len(DATA), entry)
+    assert 0 not in assembler
+    assert list(entry.completed) == []
+    for order in range(len(BLOCKS)):
+        assembler.write(chunk(file_id, order))
+    assert assembler.finish()
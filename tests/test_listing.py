@@ -0,0 +1,67 @@
+import asyncio
+from binascii import hexlify
+import hashlib
+from uuid import uuid4
+
+from p2p.lib.bitmap import Bitmap
+from p2p.lib.commands import Command
+from p2p.lib.file_chunk import FileChunk
+from p2p.lib.manifest import AVAILABILITY, FileEntry
+from p2p.lib.merkle import merkle_root
+from p2p.lib.node import Node
+from tests.scripts import server_script
+
+def file_chunks(file_name: str, blocks: list[bytes]) -> list[FileChunk]:
+    file_id = uuid4()
+    data = b"".join(blocks)
+    root = merkle_root([hashlib.sha256(block).digest() for block in blocks])
+    chunks = []
+    offset = 0
+    for (order, block) in enumerate(blocks):
+        chunks.append(FileChunk(file_id, len(block), order, len(blocks), hashlib.sha256(data).digest(), Node.null_node(), file_name, block,
+                                offset, len(data), merkle_root=root))
+        offset += len(block)
+    return chunks
+
+async def answers(tmp_path) -> dict:
+    server = server_script.Server(host="127.0.0.1", db_file=str(tmp_path / "file_chunks.db"), blob_dir=str(tmp_path / "chunks"),
+                                  metrics_address="")
+    await server.database.open()
+    try:
+        notes = file_chunks("notes.txt", [b"first", b"second", b"third"])
+        photo = file_chunks("photo.png", [b"\x89PNG"])
+        # Only some chunks of a file need to be held here.
+        for chunk in (notes[0], notes[2], photo[0]):
+            await server.store_chunk(chunk)
+
+        async def run(handler, data: bytes) -> list:
+            return [reply async for reply in server_script.commands.get(handler.value).run(server, data, Node.null_node())]
+        return {
+            "notes": notes,
+            "photo": photo,
+            "have": await run(Command.HAVE, hexlify(notes[0].file_id.bytes)),
+            "have_unknown": await run(Command.HAVE, hexlify(uuid4().bytes)),
+            "list_all": await run(Command.LIST, b""),
+            "list_prefix": await run(Command.LIST, b"note"),
+            "list_none": await run(Command.LIST, b"zzz"),
+        }
+    finally:
+        await server.database.close()
+        server.close()
+
+def test_have_and_list(tmp_path):
+    result = asyncio.run(answers(tmp_path))
+    notes = result["notes"]
+
+    [(command, payload), (final, _)] = result["have"]
+    assert (command, final) == (Command.HAVE.value, Command.TERMINATE.value)
+    assert AVAILABILITY.unpack_from(payload) == (3, 0, 0, notes[0].merkle_root)
+    assert list(Bitmap(3, payload[AVAILABILITY.size:])) == [0, 2]
+    assert result["have_unknown"] == [(Command.TERMINATE.value, b"")]
+
+    entries = [FileEntry.decode(payload) for (command, payload) in result["list_all"] if command == Command.LIST.value]
+    assert result["list_all"][-1] == (Command.TERMINATE.value, b"")
+    assert [(entry.file_name, entry.held, entry.num_chunks) for entry in entries] == [("notes.txt", 2, 3), ("photo.png", 1, 1)]
+    assert (entries[0].file_id, entries[0].checksum, entries[0].file_size) == (notes[0].file_id, notes[0].file_checksum, 16)
+    assert [FileEntry.decode(payload).file_name for (command, payload) in result["list_prefix"] if command == Command.LIST.value] == ["notes.txt"]
+    assert result["list_none"] == [(Command.TERMINATE.value, b"")]
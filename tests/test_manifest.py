@@ -0,0 +1,14 @@
+from binascii import hexlify
+from uuid import uuid4
+
+from p2p.lib.manifest import LEGACY_RETRY_ORDER, decode_retry, encode_retry
+
+def test_retry_order_round_trip():
+    file_id = uuid4()
+    for order in (0, 1, 65535, 65536, 70000, 2**32 - 1):
+        assert decode_retry(encode_retry(file_id, order)) == (file_id, order)
+
+def test_legacy_retry_order():
+    # Peers from before four byte orders still get their chunk.
+    file_id = uuid4()
+    assert decode_retry(hexlify(file_id.bytes) + LEGACY_RETRY_ORDER.pack(513)) == (file_id, 513)
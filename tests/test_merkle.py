@@ -0,0 +1,65 @@
+import hashlib
+from dataclasses import replace
+from uuid import uuid4
+
+from p2p.lib.file_chunk import FileChunk
+from p2p.lib.merkle import NODE_PREFIX, ChunkVerifier, merkle_root
+from p2p.lib.node import Node
+
+def sha256(data: bytes) -> bytes:
+    return hashlib.sha256(data).digest()
+
+def make_chunks(blocks: list[bytes]) -> list[FileChunk]:
+    file_id = uuid4()
+    leaves = [sha256(block) for block in blocks]
+    root = merkle_root(leaves)
+    return [FileChunk(file_id, len(block), order, len(blocks), bytes(32), Node.null_node(), "file.txt", block, merkle_root=root)
+            for (order, block) in enumerate(blocks)]
+
+def test_root_shapes():
+    (a, b, c) = (sha256(b"a"), sha256(b"b"), sha256(b"c"))
+    assert merkle_root([]) == sha256(b"")
+    assert merkle_root([a]) == a
+    ab = sha256(NODE_PREFIX + a + b)
+    assert merkle_root([a, b]) == ab
+    # The odd leaf moves up unchanged.
+    assert merkle_root([a, b, c]) == sha256(NODE_PREFIX + ab + c)
+
+def test_root_depends_on_order():
+    leaves = [sha256(bytes([index])) for index in range(7)]
+    assert merkle_root(leaves) != merkle_root(leaves[::-1])
+    assert merkle_root(leaves) != merkle_root(leaves[:-1])
+
+def test_verify_good_chunks():
+    blocks = [b"first", b"second", b"third"]
+    chunks = make_chunks(blocks)
+    leaves = [sha256(block) for block in blocks]
+    verifier = ChunkVerifier(merkle_root(leaves), leaves)
+    for chunk in chunks:
+        assert verifier.verify(chunk, chunk.order)
+    # Without the leaves a chunk is still checked against its own hash.
+    assert ChunkVerifier(merkle_root(leaves)).verify(chunks[1], 1)
+
+def test_verify_rejects_bad_chunks():
+    blocks = [b"first", b"second", b"third"]
+    chunks = make_chunks(blocks)
+    leaves = [sha256(block) for block in blocks]
+    verifier = ChunkVerifier(merkle_root(leaves), leaves)
+    # Asked for another order.
+    assert not verifier.verify(chunks[0], 1)
+    # Data that does not match the hash it was sent with.
+    assert not verifier.verify(replace(chunks[0], data=b"tampered"), 0)
+    # Consistent data and hash, but not the chunk of that order.
+    forged = replace(chunks[0], data=b"forged", chunk_hash=sha256(b"forged"))
+    assert not verifier.verify(forged, 0)
+    # A chunk of another file.
+    assert not verifier.verify(make_chunks([b"other", b"second", b"third"])[1], 1)
+
+def test_matches():
+    leaves = [sha256(b"first"), sha256(b"second")]
+    verifier = ChunkVerifier(merkle_root(leaves), leaves)
+    assert verifier.matches(1, b"second")
+    assert not verifier.matches(1, b"first")
+    # Orders past the known leaves, and verifiers without leaves, pass.
+    assert verifier.matches(5, b"anything")
+    assert ChunkVerifier().matches(0, b"anything")
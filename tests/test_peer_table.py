@@ -0,0 +1,86 @@
+from array import array
+from ipaddress import IPv4Address
+import random
+
+import pytest
+
+from IpAddressConverter import IP4sToUInts, IP4ToUInt, uIntsToIP4s, uIntToIP4
+from p2p.lib.commands import Command
+from p2p.lib.node import Node
+from p2p.lib.peer_table import PEER_RECORD, PeerTable, encode_peers
+
+NODES = [Node(IPv4Address(f"10.0.0.{index}"), 3000 + index) for index in range(1, 5)]
+
+def test_membership():
+    table = PeerTable(NODES)
+    assert len(table) == 4
+    assert list(table) == NODES
+    assert NODES[0] in table
+    assert Node(NODES[0].ip_address, 1) not in table
+    # Adding a known peer keeps a single row.
+    table.add(NODES[0])
+    assert len(table) == 4
+
+def test_discard_moves_last_row():
+    table = PeerTable(NODES)
+    table.add(NODES[3], rtt=0.25)
+    table.discard(NODES[1])
+    table.discard(Node(IPv4Address("10.9.9.9"), 3000))
+    assert list(table) == [NODES[0], NODES[3], NODES[2]]
+    assert NODES[1] not in table
+    # The moved row keeps its columns.
+    assert table.rtt(NODES[3]) == 0.25
+    for node in list(table):
+        table.discard(node)
+    assert len(table) == 0 and list(table) == []
+
+def test_rtt_and_seen():
+    table = PeerTable()
+    assert table.rtt(NODES[0]) is None and table.seen(NODES[0]) is None
+    table.add(NODES[0], rtt=0.5)
+    assert table.rtt(NODES[0]) == 0.5
+    assert table.seen(NODES[0]) > 0
+    # A later sighting without a measurement keeps the last round trip time.
+    table.add(NODES[0])
+    assert table.rtt(NODES[0]) == 0.5
+
+def test_encode():
+    table = PeerTable(NODES)
+    assert table.encode() == b"".join(node.encode() for node in NODES)
+
+def test_encode_peers_matches_record_by_record():
+    rng = random.Random(25)
+    ips = array('I', (rng.getrandbits(32) for _ in range(1000)))
+    ports = array('H', (rng.getrandbits(16) for _ in range(1000)))
+    assert encode_peers(ips, ports) == b"".join(map(PEER_RECORD.pack, ips, ports))
+    assert encode_peers(array('I'), array('H')) == b""
+
+def test_peer_replies():
+    table = PeerTable(NODES)
+    replies = table.peer_replies()
+    assert replies == [(Command.PEER.value, node.encode()) for node in NODES]
+    assert table.peer_replies(exclude=NODES[2]) == [(Command.PEER.value, node.encode()) for node in NODES if node != NODES[2]]
+    # Callers get their own list, and the cache follows changes to the table.
+    replies.clear()
+    assert len(table.peer_replies()) == 4
+    table.discard(NODES[0])
+    assert table.peer_replies() == [(Command.PEER.value, node.encode()) for node in table]
+
+def test_ip_address_converter():
+    addresses = ["0.0.0.0", "127.0.0.1", "192.168.1.1", "255.255.255.255"]
+    assert IP4ToUInt("192.168.1.1") == 3232235777
+    assert uIntToIP4(3232235777) == "192.168.1.1"
+    packed = IP4sToUInts(addresses)
+    assert packed.itemsize == 4
+    assert list(packed) == [IP4ToUInt(address) for address in addresses]
+    assert uIntsToIP4s(packed) == addresses
+
+def test_ip_address_converter_bulk():
+    rng = random.Random(25)
+    integers = [rng.getrandbits(32) for _ in range(1000)]
+    addresses = [uIntToIP4(integer) for integer in integers]
+    assert list(IP4sToUInts(addresses)) == integers
+    assert uIntsToIP4s(integers) == addresses
+    assert IP4sToUInts([]) == array('I') and uIntsToIP4s([]) == []
+    with pytest.raises(ValueError):
+        IP4sToUInts(["192.168.1"])
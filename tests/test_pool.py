@@ -0,0 +1,105 @@
+import asyncio
+from ipaddress import IPv4Address
+import struct
+
+from p2p.lib.commands import Command
+from p2p.lib.frame import encode_frame, read_frame
+from p2p.lib.node import Node
+from p2p.lib.pool import ConnectionPool
+
+class EchoServer:
+    # Echoes each request as DATA after the delay (in milliseconds) its
+    # payload starts with, answering concurrent requests out of order.
+    def __init__(self):
+        self.connections = 0
+        self.server = None
+
+    async def start(self) -> Node:
+        self.server = await asyncio.start_server(self.serve, "127.0.0.1", 0)
+        port = self.server.sockets[0].getsockname()[1]
+        return Node(IPv4Address("127.0.0.1"), port)
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        replies = set()
+        try:
+            while True:
+                (command, request_id, payload, _) = await read_frame(reader)
+                task = asyncio.create_task(self.reply(writer, command, request_id, payload))
+                replies.add(task)
+                task.add_done_callback(replies.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+    async def reply(self, writer: asyncio.StreamWriter, command: bytes, request_id: int, payload: bytes):
+        if command == Command.PING.value:
+            writer.write(encode_frame(Command.ACKNOWLEDGE.value, b"", request_id))
+            return
+        (delay,) = struct.unpack(">H", payload[:2])
+        await asyncio.sleep(delay / 1000)
+        writer.writelines([encode_frame(Command.DATA.value, payload, request_id), encode_frame(Command.TERMINATE.value, b"", request_id)])
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+def request(delay: int, tag: bytes) -> bytes:
+    return struct.pack(">H", delay) + tag
+
+def test_requests_share_a_connection():
+    async def scenario():
+        echo = EchoServer()
+        node = await echo.start()
+        pool = ConnectionPool()
+        try:
+            # The slow request is answered last, and every reply still
+            # reaches the request it belongs to.
+            replies = await asyncio.gather(
+                pool.request(node, Command.RETRY.value, request(100, b"slow")),
+                pool.request(node, Command.RETRY.value, request(0, b"fast")),
+                pool.request(node, Command.RETRY.value, request(50, b"middle")),
+            )
+            assert [reply[0] for reply in replies] == [(Command.DATA.value, request(100, b"slow")),
+                                                       (Command.DATA.value, request(0, b"fast")),
+                                                       (Command.DATA.value, request(50, b"middle"))]
+            assert all(reply[-1][0] == Command.TERMINATE.value for reply in replies)
+            assert echo.connections == 1
+            assert len(pool.connections[node]) == 1
+        finally:
+            await pool.close()
+            await echo.close()
+    asyncio.run(scenario())
+
+def test_busy_connections_open_another():
+    async def scenario():
+        echo = EchoServer()
+        node = await echo.start()
+        pool = ConnectionPool(max_connections_per_node=2)
+        pool.MAX_IN_FLIGHT = 1
+        try:
+            await asyncio.gather(*(pool.request(node, Command.RETRY.value, request(50, b"%d" % index)) for index in range(4)))
+            assert echo.connections == 2
+        finally:
+            await pool.close()
+            await echo.close()
+    asyncio.run(scenario())
+
+def test_idle_connections_are_evicted():
+    async def scenario():
+        echo = EchoServer()
+        node = await echo.start()
+        pool = ConnectionPool()
+        pool.IDLE_TIMEOUT = 0.2
+        try:
+            await pool.request(node, Command.RETRY.value, request(0, b"once"))
+            connection = pool.connections[node][0]
+            await asyncio.sleep(0.5)
+            assert node not in pool.connections
+            assert connection.closed
+            # The next request connects again.
+            await pool.request(node, Command.RETRY.value, request(0, b"again"))
+            assert echo.connections == 2
+        finally:
+            await pool.close()
+            await echo.close()
+    asyncio.run(scenario())
@@ -0,0 +1,76 @@
+import asyncio
+from ipaddress import IPv4Address
+import os
+import sqlite3
+import sys
+import time
+
+import pytest
+
+from p2p.lib.node import Node
+from tests.scripts import client_script, server_script
+
+# Servers listen on 127.0.0.1, 127.0.0.2, ... as in the benchmark; other
+# loopback addresses than 127.0.0.1 are only routed on Linux.
+pytestmark = pytest.mark.skipif(sys.platform != "linux", reason="needs 127.0.0.0/8 on loopback")
+
+NODES = [Node(IPv4Address(f"127.0.0.{index + 1}"), server_script.Server.PORT) for index in range(4)]
+
+async def wait_for(condition, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.05)
+
+def copies(servers, file_id) -> dict[int, int]:
+    counts = {}
+    for server in servers:
+        with sqlite3.connect(server.db_file) as connection:
+            for (order,) in connection.execute("SELECT chunk_order FROM file_chunks WHERE file_id = (?)", (str(file_id),)):
+                counts[order] = counts.get(order, 0) + 1
+    return counts
+
+async def repair_scenario():
+    servers = []
+    for (index, node) in enumerate(NODES):
+        os.makedirs(f"server{index}")
+        # Every server only knows the first one, and learns the rest by gossip.
+        server = server_script.Server(host=str(node.ip_address), db_file=f"server{index}/file_chunks.db", blob_dir=f"server{index}/chunks",
+                                      replication_factor=2, metrics_address="", seeds={NODES[0]})
+        server.GOSSIP_INTERVAL = 0.1
+        servers.append(server)
+    tasks = [asyncio.create_task(server.run_server()) for server in servers]
+    client = client_script.Client(host="127.0.0.1", journal_file="client.db")
+    client.CHUNK_SIZE = 1024
+    try:
+        await wait_for(lambda: all(len(server.peers) == len(NODES) - 1 for server in servers))
+        for node in NODES:
+            assert await client.attempt_connection(node) is not None
+        with open("input.bin", "wb") as input_file:
+            input_file.write(os.urandom(32 * 1024))
+        file_id = await client.upload_file("input.bin", replication_factor=2)
+        counts = copies(servers, file_id)
+        assert len(counts) == 32 and min(counts.values()) == 2
+        departed = servers[-1]
+        assert copies([departed], file_id)
+
+        # The last server shuts down, and its peers copy what it held to
+        # the servers now placed to hold it.
+        tasks[-1].cancel()
+        await asyncio.gather(tasks[-1], return_exceptions=True)
+        assert all(NODES[-1] not in server.peers for server in servers[:-1])
+        await wait_for(lambda: min(copies(servers[:-1], file_id).values()) == 2 and len(copies(servers[:-1], file_id)) == 32)
+    finally:
+        await client.pool.close()
+        client.journal.close()
+        client.hash_index.close()
+        client.executor.shutdown()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for server in servers:
+            server.close()
+
+def test_disconnect_copies_chunks_to_new_holders(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    asyncio.run(repair_scenario())
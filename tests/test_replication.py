@@ -0,0 +1,51 @@
+from ipaddress import IPv4Address
+from uuid import uuid4
+
+from p2p.lib.node import Node
+from p2p.lib.replication import HashRing, decode_chain, decode_unreachable, encode_chain, holders, placement
+
+NODES = [Node(IPv4Address(f"10.0.0.{index}"), 3000) for index in range(1, 6)]
+
+def test_replicas_are_distinct_and_stable():
+    ring = HashRing(NODES)
+    replicas = ring.replicas(b"chunk", 3)
+    assert len(set(replicas)) == 3
+    assert HashRing(reversed(NODES)).replicas(b"chunk", 3) == replicas
+
+def test_leaving_node_only_moves_its_chunks():
+    before = HashRing(NODES)
+    after = HashRing(NODES[:-1])
+    for index in range(200):
+        key = index.to_bytes(8, 'big')
+        if NODES[-1] not in before.replicas(key, 1):
+            assert after.replicas(key, 1) == before.replicas(key, 1)
+
+def test_chain_round_trip():
+    (chain, packet) = decode_chain(encode_chain(NODES[:2]) + b"chunk")
+    assert chain == NODES[:2]
+    assert packet == b"chunk"
+
+def test_unreachable_replica():
+    assert decode_unreachable(NODES[0].encode()) == NODES[0]
+    # Other ERROR replies carry nothing or a chunk hash.
+    assert decode_unreachable(b"") is None
+    assert decode_unreachable(bytes(32)) is None
+
+def test_plain_chunks_are_placed_by_content():
+    file_id = uuid4()
+    assert placement(file_id, 5, 10, b"hash") == (b"hash", 0)
+    ring = HashRing(NODES)
+    assert holders(ring, b"hash", 0, 3, 3) == ring.replicas(b"hash", 3)
+
+def test_stripe_members_share_a_key():
+    # A 2+1 code over 5 data chunks: stripes {0, 1}, {2, 3} and {4}, whose
+    # parity chunks are orders 5, 6 and 7.
+    file_id = uuid4()
+    stripes = [placement(file_id, order, 5, b"", 2, 1) for order in range(8)]
+    (key, _) = stripes[2]
+    assert [position for (_, position) in stripes] == [0, 1, 0, 1, 0, 2, 2, 2]
+    assert stripes[3][0] == stripes[6][0] == key
+    assert len({key for (key, _) in stripes}) == 3
+    # One stripe member per node while there are enough nodes.
+    ring = HashRing(NODES)
+    assert len({holders(ring, key, position, 3, 1)[0] for position in range(3)}) == 3
@@ -0,0 +1,81 @@
+import asyncio
+from ipaddress import IPv4Address
+
+from p2p.lib.commands import Command
+from p2p.lib.frame import read_frame
+from p2p.lib.node import Node
+from p2p.lib.peer_table import PeerTable
+from tests.scripts import server_script
+
+PEERS = [Node(IPv4Address(f"10.0.0.{index}"), 3000) for index in range(1, 4)]
+
+def make_server(tmp_path):
+    server = server_script.Server(host="127.0.0.1", db_file=str(tmp_path / "file_chunks.db"), blob_dir=str(tmp_path / "chunks"),
+                                  metrics_address="")
+    server.peers = PeerTable(PEERS)
+    return server
+
+async def disconnect(server, data: bytes, client_node: Node) -> list:
+    await server.database.open()
+    try:
+        reply = await server.process_disconnect(data, client_node)
+        await asyncio.gather(*server.background)
+        return reply
+    finally:
+        await server.database.close()
+
+def test_disconnect_of_another_node_is_refused(tmp_path):
+    server = make_server(tmp_path)
+    try:
+        reply = asyncio.run(disconnect(server, PEERS[0].encode(), PEERS[1]))
+        assert reply[0][0] == Command.ERROR.value
+        assert list(server.peers) == PEERS
+    finally:
+        server.close()
+
+def test_peers_announce_their_own_departure(tmp_path):
+    server = make_server(tmp_path)
+    try:
+        assert asyncio.run(disconnect(server, b"", PEERS[0]))[0][0] == Command.ACKNOWLEDGE.value
+        assert asyncio.run(disconnect(server, PEERS[1].encode(), PEERS[1]))[0][0] == Command.ACKNOWLEDGE.value
+        assert list(server.peers) == [PEERS[2]]
+        # Addresses that are not peers, such as clients, change nothing.
+        assert asyncio.run(disconnect(server, b"", Node(IPv4Address("10.9.9.9"), 3000)))[0][0] == Command.ACKNOWLEDGE.value
+        assert list(server.peers) == [PEERS[2]]
+    finally:
+        server.close()
+
+class RecordingWriter:
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data: bytes):
+        self.data += data
+
+    def writelines(self, frames):
+        for frame in frames:
+            self.data += frame
+
+    async def drain(self):
+        pass
+
+async def replies(server, command: bytes, data: bytes, request_id: int) -> list:
+    writer = RecordingWriter()
+    await server.respond(writer, command, request_id, data, PEERS[0], False)
+    reader = asyncio.StreamReader()
+    reader.feed_data(bytes(writer.data))
+    reader.feed_eof()
+    frames = []
+    while not reader.at_eof():
+        frames.append(await read_frame(reader))
+    return frames
+
+def test_malformed_request_is_answered(tmp_path):
+    server = make_server(tmp_path)
+    try:
+        frames = asyncio.run(replies(server, Command.UPLOAD.value, b"not a chunk", 7))
+        assert [(command, request_id) for (command, request_id, _, _) in frames] == [(Command.ERROR.value, 7), (Command.TERMINATE.value, 7)]
+        frames = asyncio.run(replies(server, b"NOPE", b"", 8))
+        assert [(command, request_id) for (command, request_id, _, _) in frames] == [(Command.ERROR.value, 8)]
+    finally:
+        server.close()